@@ -0,0 +1,195 @@
+import collections
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+BLOQUE = 1024 * 1024
+# Cuantas sumas de archivos se recuerdan en memoria
+MAX_SUMAS_CONOCIDAS = 100000
+# Segundos despues de los cuales un enlace temporal se considera abandonado
+ANTIGUEDAD_ENLACE = 3600
+
+
+class EscrituraConSuma:
+    """Envuelve un archivo abierto para escritura y va calculando el SHA-256"""
+
+    def __init__(self, archivo):
+        self.archivo = archivo
+        self.suma = hashlib.sha256()
+
+    def write(self, datos):
+        self.suma.update(datos)
+        return self.archivo.write(datos)
+
+    def hexdigest(self):
+        return self.suma.hexdigest()
+
+
+def copiar_con_suma(origen, destino):
+    """Copia de un archivo abierto a otro y devuelve el SHA-256 de lo copiado"""
+    escritura = EscrituraConSuma(destino)
+    shutil.copyfileobj(origen, escritura, BLOQUE)
+    return escritura.hexdigest()
+
+
+class AlmacenContenido:
+    """Almacen direccionado por contenido para procesados.
+
+    Cada contenido distinto se guarda una sola vez como blob en
+    directorio/ab/abcdef... (su SHA-256) y los nombres de procesados son
+    hardlinks a ese blob, asi que el servidor y el demonio los leen como
+    cualquier archivo. Guardar un contenido que ya existe es solo crear un
+    enlace. El contador de referencias de cada blob es el st_nlink que ya
+    lleva el sistema de archivos: un blob con st_nlink == 1 no tiene ningun
+    nombre y recolectar() lo borra.
+
+    Los blobs quedan de solo lectura porque todos los nombres comparten el
+    mismo inodo; servidor y demonio nunca escriben encima de un archivo de
+    procesados, siempre lo reemplazan con os.replace.
+    """
+
+    def __init__(self, directorio):
+        self.directorio = directorio
+        self.mutex = threading.Lock()
+        # (dispositivo, inodo, tamano, mtime) -> suma; si el archivo cambia, cambia la clave
+        self._sumas = collections.OrderedDict()
+        self.enlaces = 0
+        self.blobs_nuevos = 0
+        self.bytes_ahorrados = 0
+        os.makedirs(directorio, exist_ok=True)
+
+    def ruta_blob(self, suma):
+        return os.path.join(self.directorio, suma[:2], suma)
+
+    @staticmethod
+    def _clave(estado):
+        return (estado.st_dev, estado.st_ino, estado.st_size, estado.st_mtime_ns)
+
+    def recordar(self, ruta, suma):
+        """Anota la suma del contenido actual de ruta"""
+        clave = self._clave(os.stat(ruta))
+        with self.mutex:
+            self._sumas[clave] = suma
+            self._sumas.move_to_end(clave)
+            while len(self._sumas) > MAX_SUMAS_CONOCIDAS:
+                self._sumas.popitem(last=False)
+
+    def suma_conocida(self, ruta):
+        """La suma de ruta si ya se calculo antes y el archivo no cambio, si no None"""
+        try:
+            clave = self._clave(os.stat(ruta))
+        except FileNotFoundError:
+            return None
+        with self.mutex:
+            return self._sumas.get(clave)
+
+    def suma_de(self, ruta):
+        suma = self.suma_conocida(ruta)
+        if suma is None:
+            calculo = hashlib.sha256()
+            with open(ruta, "rb") as f:
+                while True:
+                    bloque = f.read(BLOQUE)
+                    if not bloque:
+                        break
+                    calculo.update(bloque)
+            suma = calculo.hexdigest()
+            self.recordar(ruta, suma)
+        return suma
+
+    def contiene(self, ruta, suma):
+        """True si ruta ya es un nombre del blob de esa suma"""
+        try:
+            return os.path.samefile(ruta, self.ruta_blob(suma))
+        except FileNotFoundError:
+            return False
+
+    def _enlazar(self, suma, destino):
+        enlace = os.path.join(self.directorio, f"{uuid.uuid4().hex}.enlace")
+        try:
+            os.link(self.ruta_blob(suma), enlace)
+        except FileNotFoundError:
+            return False
+        try:
+            os.replace(enlace, destino)
+        finally:
+            # Si destino ya era un enlace al mismo blob, rename no hace nada y deja el origen
+            if os.path.lexists(enlace):
+                os.remove(enlace)
+        self.recordar(destino, suma)
+        return True
+
+    def enlazar(self, suma, destino):
+        """Hace que destino apunte al blob (reemplazandolo con os.replace).
+
+        Devuelve False si no hay blob con esa suma.
+        """
+        if not self._enlazar(suma, destino):
+            return False
+        with self.mutex:
+            self.enlaces += 1
+            self.bytes_ahorrados += os.path.getsize(destino)
+        return True
+
+    def guardar(self, ruta_temporal, destino, suma=None):
+        """Guarda el contenido de ruta_temporal y deja destino apuntando a el.
+
+        ruta_temporal se consume: si el contenido es nuevo pasa a ser el blob
+        (sin copiar nada) y si ya existia se descarta. Devuelve True si el
+        contenido ya estaba en el almacen.
+        """
+        if suma is None:
+            suma = self.suma_de(ruta_temporal)
+        try:
+            if self.enlazar(suma, destino):
+                return True
+            blob = self.ruta_blob(suma)
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.chmod(ruta_temporal, 0o444)
+            try:
+                os.link(ruta_temporal, blob)
+                with self.mutex:
+                    self.blobs_nuevos += 1
+            except FileExistsError:
+                pass  # otro hilo o proceso guardo el mismo contenido recien
+            if not self._enlazar(suma, destino):
+                # El recolector lo borro justo en el medio: queda sin deduplicar
+                os.replace(ruta_temporal, destino)
+            return False
+        finally:
+            if os.path.lexists(ruta_temporal):
+                os.remove(ruta_temporal)
+
+    def recolectar(self):
+        """Borra los blobs que ya no tienen ningun nombre; devuelve (blobs, bytes)"""
+        borrados = liberados = 0
+        for prefijo in os.listdir(self.directorio):
+            carpeta = os.path.join(self.directorio, prefijo)
+            if not os.path.isdir(carpeta):
+                # Enlaces temporales que quedaron de una caida. Crear un enlace
+                # actualiza el ctime del inodo, asi que uno viejo ya no esta en uso
+                try:
+                    if prefijo.endswith(".enlace") and time.time() - os.stat(carpeta).st_ctime > ANTIGUEDAD_ENLACE:
+                        os.remove(carpeta)
+                except FileNotFoundError:
+                    pass
+                continue
+            for nombre in os.listdir(carpeta):
+                ruta = os.path.join(carpeta, nombre)
+                try:
+                    estado = os.stat(ruta)
+                    if estado.st_nlink == 1:
+                        os.remove(ruta)
+                        borrados += 1
+                        liberados += estado.st_size
+                except FileNotFoundError:
+                    continue
+        return borrados, liberados
+
+    def estadisticas(self):
+        with self.mutex:
+            return {"enlaces": self.enlaces, "blobs_nuevos": self.blobs_nuevos,
+                    "bytes_ahorrados": self.bytes_ahorrados, "sumas_conocidas": len(self._sumas)}
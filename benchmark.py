@@ -0,0 +1,611 @@
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import protocolo
+from cliente import ClienteArchivos
+
+# Pruebas de carga del servidor y del demonio.
+#
+# Cada escenario corre contra un servidor (o un demonio) nuevo, en otro
+# proceso y con un HOME temporal, asi no toca ~/servidor_archivos y la
+# memoria que se mide es solo la de ese escenario. Los clientes son hilos de
+# este proceso, cada uno con su propia conexion, que eligen operaciones al
+# azar segun la mezcla pedida. Los resultados se guardan en JSON para
+# comparar corridas entre versiones (ver el subcomando comparar).
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+
+OPERACIONES = ("listar", "leer", "subir", "descargar", "copiar")
+MEZCLA_POR_DEFECTO = "listar=1,leer=4,descargar=3,subir=1,copiar=1"
+TAMANOS_POR_DEFECTO = "1K,64K,1M"
+CLIENTES_POR_DEFECTO = "1,8,32"
+ARCHIVOS_POR_DEFECTO = "100"
+DURACION = 10.0
+# Archivos del tamano pedido que se dejan en entrada (el resto del directorio son archivos chicos)
+OBJETIVOS = 4
+# LEER devuelve todo en una trama: con archivos mas grandes que esto se omite
+MAXIMO_LEER = 16 * 1024 * 1024
+# Lo que pueden ocupar en disco los archivos de un escenario
+PRESUPUESTO_DISCO = 4 * 1024 ** 3
+ESPERA_ARRANQUE = 15.0
+# Cada cuanto se mira procesados en el escenario del demonio
+SONDEO_DEMONIO = 0.005
+PERCENTILES = (0.5, 0.99)
+UNIDADES = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parsear_tamano(texto):
+    """'64K' -> 65536; acepta sufijos K, M y G"""
+    texto = texto.strip().upper().rstrip("B")
+    sufijo = texto[-1:] if texto[-1:] in UNIDADES else ""
+    return int(float(texto[:len(texto) - len(sufijo)]) * UNIDADES[sufijo])
+
+
+def mostrar_tamano(cantidad):
+    for sufijo in ("G", "M", "K"):
+        if cantidad >= UNIDADES[sufijo] and cantidad % UNIDADES[sufijo] == 0:
+            return f"{cantidad // UNIDADES[sufijo]}{sufijo}"
+    return str(cantidad)
+
+
+def parsear_lista(texto, convertir=int):
+    return [convertir(valor) for valor in texto.split(",") if valor.strip()]
+
+
+def parsear_mezcla(texto):
+    """'leer=4,subir=1' -> {'leer': 4.0, 'subir': 1.0}"""
+    mezcla = {}
+    for parte in texto.split(","):
+        operacion, _, peso = parte.partition("=")
+        operacion = operacion.strip().lower()
+        if operacion not in OPERACIONES:
+            raise ValueError(f"Operacion desconocida: {operacion} ({', '.join(OPERACIONES)})")
+        mezcla[operacion] = float(peso or 1)
+    if not any(mezcla.values()):
+        raise ValueError("La mezcla no tiene ninguna operacion con peso")
+    return mezcla
+
+
+def percentil(valores, p):
+    """Percentil p (0 a 1) de una lista ya ordenada, por el metodo del rango mas cercano"""
+    if not valores:
+        return 0.0
+    return valores[min(len(valores) - 1, max(0, int(p * len(valores) + 0.5) - 1))]
+
+
+def resumir_latencias(latencias, segundos):
+    latencias = sorted(latencias)
+    resumen = {"operaciones": len(latencias), "por_segundo": round(len(latencias) / segundos, 2)}
+    for p in PERCENTILES:
+        resumen[f"p{int(p * 100)}_ms"] = round(percentil(latencias, p) * 1000, 3)
+    resumen["promedio_ms"] = round(sum(latencias) / len(latencias) * 1000, 3) if latencias else 0.0
+    resumen["maximo_ms"] = round(latencias[-1] * 1000, 3) if latencias else 0.0
+    return resumen
+
+
+def puerto_libre():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def memoria_maxima(pid):
+    """Pico de memoria residente (VmHWM) en bytes del proceso y sus hijos, o None fuera de Linux"""
+    total = None
+    pendientes = [pid]
+    while pendientes:
+        actual = pendientes.pop()
+        try:
+            with open(f"/proc/{actual}/status") as f:
+                for linea in f:
+                    if linea.startswith("VmHWM:"):
+                        total = (total or 0) + int(linea.split()[1]) * 1024
+            with open(f"/proc/{actual}/task/{actual}/children") as f:
+                pendientes.extend(int(hijo) for hijo in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def version_codigo():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=DIRECTORIO, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def escribir_archivo(ruta, tamano, aleatorio=False):
+    """Crea un archivo de tamano bytes: texto repetido (comprimible) o bytes al azar"""
+    bloque = os.urandom(1024 * 1024) if aleatorio else (b"linea de prueba del benchmark 0123456789\n" * 25600)
+    with open(ruta, "wb") as f:
+        restante = tamano
+        while restante > 0:
+            f.write(bloque[:restante])
+            restante -= len(bloque)
+
+
+@contextlib.contextmanager
+def silencio():
+    """El cliente imprime cada conexion y cada error: en una prueba de carga eso no se muestra"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def avisar(mensaje):
+    print(mensaje, file=sys.stderr, flush=True)
+
+
+class Proceso:
+    """Un servidor o demonio en otro proceso con HOME en un directorio temporal"""
+
+    def __init__(self, comando, home):
+        self.comando = comando
+        self.home = home
+        self.proceso = None
+
+    def iniciar(self):
+        entorno = dict(os.environ, HOME=self.home, PYTHONUNBUFFERED="1")
+        # En su propia sesion, para poder terminar tambien los procesos de las etapas
+        self.proceso = subprocess.Popen(self.comando, cwd=DIRECTORIO, env=entorno, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def esperar(self, listo, tiempo=ESPERA_ARRANQUE):
+        limite = time.monotonic() + tiempo
+        while time.monotonic() < limite:
+            if self.proceso.poll() is not None:
+                raise RuntimeError(f"El proceso termino al arrancar (codigo {self.proceso.returncode})")
+            if listo():
+                return
+            time.sleep(0.05)
+        raise RuntimeError(f"El proceso no estuvo listo en {tiempo:.0f} s")
+
+    def memoria(self):
+        return memoria_maxima(self.proceso.pid) if self.proceso else None
+
+    def detener(self):
+        if self.proceso is None or self.proceso.poll() is not None:
+            return
+        with contextlib.suppress(ProcessLookupError):
+            os.killpg(self.proceso.pid, signal.SIGINT)
+        try:
+            self.proceso.wait(5)
+        except subprocess.TimeoutExpired:
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(self.proceso.pid, signal.SIGKILL)
+            self.proceso.wait()
+
+
+def acepta_conexiones(puerto):
+    try:
+        with socket.create_connection(("127.0.0.1", puerto), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def correr_servidor(args):
+    """Subcomando interno: el proceso del servidor de un escenario"""
+    import servidor
+    servidor.HOST = "127.0.0.1"
+    servidor.PORT = args.puerto
+    if args.modo == "async":
+        import servidor_async
+        servidor_async.iniciar_servidor_async(args.hilos)
+    elif args.modo == "procesos":
+        import servidor_procesos
+        servidor_procesos.iniciar_servidor_procesos(args.procesos or servidor_procesos.PROCESOS, args.hilos, args.cola)
+    else:
+        servidor.iniciar_servidor(args.hilos, args.cola)
+
+
+class Escenario:
+    """Lo que comparten los clientes de un escenario del servidor"""
+
+    def __init__(self, puerto, objetivos, fuente, locales, tamano):
+        self.puerto = puerto
+        self.objetivos = objetivos
+        self.fuente = fuente
+        self.locales = locales
+        self.tamano = tamano
+
+
+# Cada operacion devuelve (ok, bytes transferidos); None es que se corto la conexion
+def op_listar(cliente, escenario, numero):
+    respuesta = cliente.enviar_comando(protocolo.OP_LISTAR)
+    return respuesta and (respuesta[0], len(respuesta[1]))
+
+
+def op_leer(cliente, escenario, numero):
+    respuesta = cliente.enviar_comando(protocolo.OP_LEER, random.choice(escenario.objetivos))
+    return respuesta and (respuesta[0], len(respuesta[1]))
+
+
+def op_descargar(cliente, escenario, numero):
+    destino = os.path.join(escenario.locales, f"descarga-{numero}")
+    respuesta = cliente.descargar(random.choice(escenario.objetivos), destino)
+    return respuesta and (respuesta[0], respuesta[1] if respuesta[0] else 0)
+
+
+def op_subir(cliente, escenario, numero):
+    # Siempre el mismo nombre por cliente: se reemplaza en lugar de llenar el disco
+    respuesta = cliente.subir(escenario.fuente, f"bench-subida-{numero}.txt", por_diferencias=False)
+    return respuesta and (respuesta[0], respuesta[2] if respuesta[0] else 0)
+
+
+def op_copiar(cliente, escenario, numero):
+    respuesta = cliente.enviar_comando(protocolo.OP_COPIAR, random.choice(escenario.objetivos))
+    return respuesta and (respuesta[0], 0)
+
+
+FUNCIONES = {"listar": op_listar, "leer": op_leer, "descargar": op_descargar, "subir": op_subir,
+             "copiar": op_copiar}
+
+
+def generar_carga(escenario, clientes, mezcla, duracion):
+    """Corre `clientes` hilos durante `duracion` segundos y devuelve lo que midio cada operacion"""
+    operaciones = [op for op, peso in mezcla.items() if peso > 0]
+    pesos = [mezcla[op] for op in operaciones]
+    resultados = {op: {"latencias": [], "errores": 0, "bytes": 0} for op in operaciones}
+    mutex = threading.Lock()
+    conectados = []
+    barrera = threading.Barrier(clientes + 1)
+    fin = [0.0]
+
+    def cliente_de_carga(numero):
+        cliente = ClienteArchivos("127.0.0.1", escenario.puerto)
+        propios = {op: {"latencias": [], "errores": 0, "bytes": 0} for op in operaciones}
+        conectado = cliente.conectar()
+        barrera.wait()
+        try:
+            while conectado and time.monotonic() < fin[0]:
+                operacion = random.choices(operaciones, pesos)[0]
+                inicio = time.perf_counter()
+                try:
+                    respuesta = FUNCIONES[operacion](cliente, escenario, numero)
+                except Exception:
+                    respuesta = None
+                segundos = time.perf_counter() - inicio
+                medido = propios[operacion]
+                if respuesta and respuesta[0]:
+                    medido["latencias"].append(segundos)
+                    medido["bytes"] += respuesta[1]
+                else:
+                    medido["errores"] += 1
+                    if cliente.conexion is None:
+                        conectado = cliente.conectar()
+        finally:
+            cliente.cerrar()
+        with mutex:
+            conectados.append(conectado)
+            for op, medido in propios.items():
+                resultados[op]["latencias"].extend(medido["latencias"])
+                resultados[op]["errores"] += medido["errores"]
+                resultados[op]["bytes"] += medido["bytes"]
+
+    hilos = [threading.Thread(target=cliente_de_carga, args=(i,), name=f"carga-{i}", daemon=True)
+             for i in range(clientes)]
+    with silencio():
+        for hilo in hilos:
+            hilo.start()
+        # Todos conectados (o rechazados) antes de empezar a contar
+        fin[0] = time.monotonic() + duracion
+        barrera.wait()
+        inicio = time.monotonic()
+        for hilo in hilos:
+            hilo.join()
+    return resultados, time.monotonic() - inicio, conectados.count(False)
+
+
+def preparar_directorio(entrada, tamano, archivos):
+    """Llena entrada con los archivos objetivo (del tamano pedido) y archivos chicos hasta `archivos`"""
+    objetivos = max(1, min(OBJETIVOS, archivos, PRESUPUESTO_DISCO // max(tamano, 1)))
+    nombres = []
+    for i in range(objetivos):
+        nombre = f"objetivo-{i}.txt"
+        escribir_archivo(os.path.join(entrada, nombre), tamano)
+        nombres.append(nombre)
+    for i in range(archivos - objetivos):
+        with open(os.path.join(entrada, f"relleno-{i:06d}.txt"), "wb") as f:
+            f.write(b"relleno %d\n" % i)
+    return nombres
+
+
+def escenario_servidor(args, tamano, clientes, archivos, mezcla):
+    home = tempfile.mkdtemp(prefix="benchmark-", dir=args.temporal)
+    try:
+        entrada = os.path.join(home, "servidor_archivos", "entrada")
+        locales = os.path.join(home, "cliente")
+        os.makedirs(entrada)
+        os.makedirs(locales)
+        objetivos = preparar_directorio(entrada, tamano, archivos)
+        fuente = os.path.join(locales, "fuente.txt")
+        escribir_archivo(fuente, tamano)
+        omitidas = []
+        if tamano > MAXIMO_LEER and mezcla.get("leer"):
+            mezcla = dict(mezcla, leer=0)
+            omitidas.append("leer")
+
+        puerto = puerto_libre()
+        servidor = Proceso([sys.executable, os.path.abspath(__file__), "proceso-servidor", "--puerto", str(puerto),
+                            "--modo", args.modo, "--hilos", str(args.hilos), "--cola", str(args.cola),
+                            "--procesos", str(args.procesos or 0)], home)
+        servidor.iniciar()
+        try:
+            servidor.esperar(lambda: acepta_conexiones(puerto))
+            escenario = Escenario(puerto, objetivos, fuente, locales, tamano)
+            resultados, segundos, rechazados = generar_carga(escenario, clientes, mezcla, args.duracion)
+            estadisticas = pedir_estadisticas(puerto)
+            memoria = servidor.memoria()
+        finally:
+            servidor.detener()
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    todas = []
+    operaciones = {}
+    transferidos = errores = 0
+    for op, medido in resultados.items():
+        operaciones[op] = resumir_latencias(medido["latencias"], segundos)
+        operaciones[op].update({"errores": medido["errores"], "bytes": medido["bytes"]})
+        todas.extend(medido["latencias"])
+        transferidos += medido["bytes"]
+        errores += medido["errores"]
+    total = resumir_latencias(todas, segundos)
+    total.update({"errores": errores, "bytes": transferidos,
+                  "mb_por_segundo": round(transferidos / segundos / 1024 / 1024, 2)})
+    return {"tipo": "servidor", "modo": args.modo, "tamano": tamano, "clientes": clientes, "archivos": archivos,
+            "segundos": round(segundos, 3), "clientes_rechazados": rechazados, "omitidas": omitidas,
+            "total": total, "operaciones": operaciones, "memoria_maxima_servidor": memoria,
+            "estadisticas_servidor": estadisticas}
+
+
+def pedir_estadisticas(puerto):
+    """Las metricas del propio servidor (STATS en JSON), o None si no respondio"""
+    with silencio():
+        cliente = ClienteArchivos("127.0.0.1", puerto, codecs=None)
+        if not cliente.conectar():
+            return None
+        try:
+            respuesta = cliente.enviar_comando(protocolo.OP_STATS, payload=b"formato=json")
+        finally:
+            cliente.cerrar()
+    if not respuesta or not respuesta[0]:
+        return None
+    return json.loads(respuesta[1])
+
+
+def escenario_demonio(args, tamano, archivos):
+    """Latencia de punta a punta del demonio: desde que un archivo aparece en entrada hasta que esta en procesados"""
+    home = tempfile.mkdtemp(prefix="benchmark-", dir=args.temporal)
+    try:
+        base = os.path.join(home, "servidor_archivos")
+        entrada = os.path.join(base, "entrada")
+        procesados = os.path.join(base, "procesados")
+        rechazados = os.path.join(base, "rechazados")
+        # Mismo disco que entrada, para que aparezcan de una con os.replace
+        preparados = os.path.join(base, "preparados")
+        os.makedirs(preparados)
+        nombres = [f"bench-{i:06d}.txt" for i in range(archivos)]
+        for nombre in nombres:
+            escribir_archivo(os.path.join(preparados, nombre), tamano)
+
+        demonio = Proceso([sys.executable, os.path.join(DIRECTORIO, "demonio.py"), "--etapas", args.etapas], home)
+        demonio.iniciar()
+        registro = os.path.join(base, "logs", "registro.log")
+        try:
+            demonio.esperar(lambda: _contiene(registro, "Vigilando"))
+            llegadas, salidas, rechazos, segundos = _alimentar_demonio(nombres, preparados, entrada, procesados,
+                                                                       rechazados, args.ritmo, args.espera)
+            memoria = demonio.memoria()
+        finally:
+            demonio.detener()
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+
+    latencias = [salidas[nombre] - llegadas[nombre] for nombre in salidas]
+    resumen = resumir_latencias(latencias, segundos)
+    resumen["por_segundo"] = round(len(salidas) / segundos, 2) if salidas else 0.0
+    return {"tipo": "demonio", "etapas": args.etapas, "tamano": tamano, "archivos": archivos,
+            "ritmo": args.ritmo, "segundos": round(segundos, 3), "procesados": len(salidas),
+            "rechazados": rechazos, "sin_terminar": archivos - len(salidas) - rechazos,
+            "mb_por_segundo": round(len(salidas) * tamano / segundos / 1024 / 1024, 2),
+            "latencia": resumen, "memoria_maxima_demonio": memoria}
+
+
+def _contiene(ruta, texto):
+    try:
+        with open(ruta, encoding="utf-8", errors="replace") as f:
+            return texto in f.read()
+    except FileNotFoundError:
+        return False
+
+
+def _raiz(nombre):
+    # Las etapas pueden agregar extensiones (.gz) o renombrar con fecha (nombre_fecha.txt)
+    return nombre.split(".")[0].split("_")[0]
+
+
+def _alimentar_demonio(nombres, preparados, entrada, procesados, rechazados, ritmo, espera):
+    """Deja los archivos en entrada (de golpe o `ritmo` por segundo) y anota cuando sale cada uno"""
+    llegadas, salidas = {}, {}
+    pendientes = {_raiz(nombre): nombre for nombre in nombres}
+    vistos_rechazados = set()
+
+    def revisar():
+        ahora = time.monotonic()
+        for directorio, destino in ((procesados, salidas), (rechazados, None)):
+            for nombre in os.listdir(directorio):
+                raiz = _raiz(nombre)
+                if raiz in pendientes and pendientes[raiz] in llegadas:
+                    original = pendientes.pop(raiz)
+                    if destino is None:
+                        vistos_rechazados.add(original)
+                    else:
+                        destino[original] = ahora
+
+    inicio = time.monotonic()
+    for i, nombre in enumerate(nombres):
+        if ritmo:
+            while time.monotonic() < inicio + i / ritmo:
+                revisar()
+                time.sleep(SONDEO_DEMONIO)
+        llegadas[nombre] = time.monotonic()
+        os.replace(os.path.join(preparados, nombre), os.path.join(entrada, nombre))
+    limite = time.monotonic() + espera
+    while pendientes and time.monotonic() < limite:
+        revisar()
+        time.sleep(SONDEO_DEMONIO)
+    final = max(salidas.values(), default=time.monotonic())
+    return llegadas, salidas, len(vistos_rechazados), max(final - inicio, 1e-6)
+
+
+def entorno():
+    return {"fecha": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "version": version_codigo(),
+            "protocolo": protocolo.VERSION_PROTOCOLO, "python": platform.python_version(),
+            "sistema": platform.platform(), "nucleos": os.cpu_count()}
+
+
+def mostrar_servidor(r):
+    t = r["total"]
+    avisar(f"  {r['modo']:<6}{mostrar_tamano(r['tamano']):>6}{r['clientes']:>6} clientes{r['archivos']:>8} archivos:"
+           f" {t['por_segundo']:>9.1f} op/s {t['mb_por_segundo']:>9.2f} MB/s  p50 {t['p50_ms']:.2f} ms"
+           f"  p99 {t['p99_ms']:.2f} ms  errores {t['errores']}  memoria "
+           f"{(r['memoria_maxima_servidor'] or 0) / 1024 / 1024:.0f} MB")
+
+
+def mostrar_demonio(r):
+    l = r["latencia"]
+    avisar(f"  {r['etapas']:<20}{mostrar_tamano(r['tamano']):>6}{r['archivos']:>7} archivos: "
+           f"{l['por_segundo']:>8.1f} archivos/s  p50 {l['p50_ms']:.1f} ms  p99 {l['p99_ms']:.1f} ms"
+           f"  sin terminar {r['sin_terminar']}  memoria {(r['memoria_maxima_demonio'] or 0) / 1024 / 1024:.0f} MB")
+
+
+def guardar(resultado, ruta):
+    with open(ruta, "w", encoding="utf-8") as f:
+        json.dump(resultado, f, ensure_ascii=False, indent=2)
+    avisar(f"Resultados en {ruta}")
+
+
+def benchmark_servidor(args):
+    mezcla = parsear_mezcla(args.mezcla)
+    resultado = {"entorno": entorno(), "parametros": {"mezcla": mezcla, "duracion": args.duracion,
+                                                      "modo": args.modo, "hilos": args.hilos, "cola": args.cola,
+                                                      "procesos": args.procesos},
+                 "escenarios": []}
+    combinaciones = itertools.product(parsear_lista(args.tamanos, parsear_tamano), parsear_lista(args.clientes),
+                                      parsear_lista(args.archivos))
+    for tamano, clientes, archivos in combinaciones:
+        r = escenario_servidor(args, tamano, clientes, archivos, mezcla)
+        resultado["escenarios"].append(r)
+        mostrar_servidor(r)
+        # Se guarda despues de cada escenario: una corrida larga cortada no pierde lo que ya midio
+        guardar(resultado, args.salida)
+
+
+def benchmark_demonio(args):
+    resultado = {"entorno": entorno(), "parametros": {"etapas": args.etapas, "ritmo": args.ritmo},
+                 "escenarios": []}
+    for tamano, archivos in itertools.product(parsear_lista(args.tamanos, parsear_tamano),
+                                              parsear_lista(args.archivos)):
+        r = escenario_demonio(args, tamano, archivos)
+        resultado["escenarios"].append(r)
+        mostrar_demonio(r)
+        guardar(resultado, args.salida)
+
+
+def _clave(r):
+    if r["tipo"] == "servidor":
+        return (r["tipo"], r["modo"], r["tamano"], r["clientes"], r["archivos"])
+    return (r["tipo"], r["etapas"], r["tamano"], r["archivos"], r["ritmo"])
+
+
+def comparar(args):
+    """Muestra cuanto cambio cada escenario entre dos corridas"""
+    with open(args.anterior, encoding="utf-8") as f:
+        anterior = json.load(f)
+    with open(args.actual, encoding="utf-8") as f:
+        actual = json.load(f)
+    previos = {_clave(r): r for r in anterior["escenarios"]}
+    print(f"{anterior['entorno'].get('version')} -> {actual['entorno'].get('version')}")
+    for r in actual["escenarios"]:
+        previo = previos.get(_clave(r))
+        if previo is None:
+            continue
+        medida = "total" if r["tipo"] == "servidor" else "latencia"
+        antes, ahora = previo[medida], r[medida]
+        cambios = []
+        for campo in ("por_segundo", "p50_ms", "p99_ms"):
+            if antes[campo]:
+                cambios.append(f"{campo} {antes[campo]} -> {ahora[campo]} ({(ahora[campo] / antes[campo] - 1) * 100:+.1f}%)")
+        print(" ".join(str(v) for v in _clave(r)[1:]) + ": " + ", ".join(cambios))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pruebas de carga del servidor de archivos y del demonio")
+    subcomandos = parser.add_subparsers(dest="subcomando", required=True)
+
+    p = subcomandos.add_parser("servidor", help="clientes concurrentes contra un servidor local")
+    p.add_argument("--tamanos", default=TAMANOS_POR_DEFECTO, help="tamanos de archivo, ej: 1K,1M,100M,1G")
+    p.add_argument("--clientes", default=CLIENTES_POR_DEFECTO, help="clientes concurrentes, ej: 1,8,32,128")
+    p.add_argument("--archivos", default=ARCHIVOS_POR_DEFECTO, help="archivos en entrada, ej: 100,10000")
+    p.add_argument("--mezcla", default=MEZCLA_POR_DEFECTO,
+                   help=f"peso de cada operacion ({', '.join(OPERACIONES)})")
+    p.add_argument("--duracion", type=float, default=DURACION, help="segundos de carga por escenario")
+    p.add_argument("--modo", choices=["hilos", "async", "procesos"], default="hilos")
+    p.add_argument("--hilos", type=int, default=32)
+    p.add_argument("--cola", type=int, default=64)
+    p.add_argument("--procesos", type=int, help="procesos del servidor en modo procesos (por defecto uno por nucleo)")
+    p.add_argument("--salida", default="benchmark-servidor.json")
+    p.add_argument("--temporal", default=None, help="donde crear los directorios de cada escenario")
+    p.set_defaults(funcion=benchmark_servidor)
+
+    p = subcomandos.add_parser("demonio", help="latencia de ingesta del demonio, de entrada a procesados")
+    p.add_argument("--tamanos", default="4K,1M", help="tamanos de archivo, ej: 4K,1M")
+    p.add_argument("--archivos", default="200", help="archivos por escenario")
+    p.add_argument("--etapas", default="validar,suma", help="etapas del demonio")
+    p.add_argument("--ritmo", type=float, default=0, help="archivos por segundo (0: todos de golpe)")
+    p.add_argument("--espera", type=float, default=120, help="segundos maximos esperando que termine")
+    p.add_argument("--salida", default="benchmark-demonio.json")
+    p.add_argument("--temporal", default=None, help="donde crear los directorios de cada escenario")
+    p.set_defaults(funcion=benchmark_demonio)
+
+    p = subcomandos.add_parser("comparar", help="compara dos resultados (por ejemplo de dos versiones)")
+    p.add_argument("anterior")
+    p.add_argument("actual")
+    p.set_defaults(funcion=comparar)
+
+    # Uso interno: el proceso del servidor de cada escenario
+    p = subcomandos.add_parser("proceso-servidor")
+    p.add_argument("--puerto", type=int, required=True)
+    p.add_argument("--modo", choices=["hilos", "async", "procesos"], default="hilos")
+    p.add_argument("--hilos", type=int, default=32)
+    p.add_argument("--cola", type=int, default=64)
+    p.add_argument("--procesos", type=int, help="procesos del servidor en modo procesos (por defecto uno por nucleo)")
+    p.set_defaults(funcion=correr_servidor)
+
+    args = parser.parse_args()
+    try:
+        args.funcion(args)
+    except ValueError as e:
+        parser.error(str(e))
+    except KeyboardInterrupt:
+        avisar("Interrumpido")
+
+
+if __name__ == "__main__":
+    main()
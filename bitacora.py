@@ -0,0 +1,156 @@
+import collections
+import itertools
+import json
+import os
+import threading
+
+# Estados de un archivo en la cola del demonio
+ENCOLADO = "E"
+INICIADO = "I"
+MOVIENDO = "M"  # lleva el destino y el inodo del original: el rename puede haberse hecho o no
+COMPLETADO = "C"
+
+
+class Bitacora:
+    """Bitacora de solo agregado con el estado de cada archivo de la cola.
+
+    Cada cambio de estado es una linea JSON [estado, archivo, destino, inodo]. Como
+    en registro.py, anotar() solo encola la linea y un hilo escritor junta
+    todo lo pendiente, lo escribe con un solo os.write y hace un fdatasync
+    por lote, asi miles de archivos por segundo cuestan unos pocos fsync.
+    Quien necesita que su linea ya este en disco antes de seguir (el paso a
+    MOVIENDO) espera con esperar(), que devuelve False si el lote de su
+    linea no se pudo escribir; el siguiente lote reescribe la bitacora
+    entera para no dejar huecos.
+
+    Al abrirla se lee el archivo y se arma el estado de cada archivo que no
+    llego a COMPLETADO; despues se reescribe solo con eso. Tambien se
+    compacta sola cuando pasa de `tamano_maximo`. Una ultima linea cortada
+    por una caida se ignora.
+    """
+
+    def __init__(self, ruta, tamano_maximo=8 * 1024 * 1024):
+        self.ruta = ruta
+        self.tamano_maximo = tamano_maximo
+        self._cola = collections.deque()
+        self._contador = itertools.count(1)
+        self._mutex = threading.Lock()
+        self._escritos = 0
+        # Numero de la ultima anotacion de un lote que fallo al escribirse
+        self._fallido = 0
+        self._incompleta = False
+        self._despertar = threading.Event()
+        self._escrito = threading.Condition()
+        self.estados = self._leer()  # archivo -> (estado, destino, inodo), sin los completados
+        self.fsyncs = 0
+        self._compactar()
+        self._hilo = threading.Thread(target=self._escritor, name="bitacora", daemon=True)
+        self._hilo.start()
+
+    def _leer(self):
+        estados = {}
+        try:
+            with open(self.ruta, "rb") as f:
+                for linea in f:
+                    try:
+                        estado, archivo, destino, inodo = json.loads(linea)
+                    except ValueError:
+                        continue  # linea cortada por una caida
+                    if estado == COMPLETADO:
+                        estados.pop(archivo, None)
+                    else:
+                        estados[archivo] = (estado, destino, inodo)
+        except FileNotFoundError:
+            pass
+        return estados
+
+    @staticmethod
+    def _linea(estado, archivo, destino=None, inodo=None):
+        return json.dumps([estado, archivo, destino, inodo], ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def _compactar(self):
+        """Reescribe la bitacora solo con los archivos pendientes (rename atomico)"""
+        temporal = self.ruta + ".compactando"
+        with open(temporal, "wb") as f:
+            f.write(b"".join(self._linea(estado, archivo, destino, inodo)
+                             for archivo, (estado, destino, inodo) in self.estados.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.ruta)
+        directorio = os.open(os.path.dirname(self.ruta) or ".", os.O_RDONLY)
+        try:
+            os.fsync(directorio)
+        finally:
+            os.close(directorio)
+        if getattr(self, "_fd", None) is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.ruta, os.O_WRONLY | os.O_APPEND)
+        self._tamano = os.fstat(self._fd).st_size
+
+    def pendientes(self):
+        """Archivos que quedaron a medias la ultima vez: {archivo: (estado, destino, inodo)}"""
+        return dict(self.estados)
+
+    def anotar(self, estado, archivo, destino=None, inodo=None):
+        """Encola un cambio de estado; devuelve un numero para esperar()"""
+        # El numero tiene que seguir el orden de la cola
+        with self._mutex:
+            self._cola.append((estado, archivo, destino, inodo))
+            numero = next(self._contador)
+        self._despertar.set()
+        return numero
+
+    def esperar(self, numero, timeout=10.0):
+        """Espera a que la anotacion `numero` este escrita y sincronizada.
+
+        False si no termino en `timeout` segundos o si su lote fallo.
+        """
+        with self._escrito:
+            if not self._escrito.wait_for(lambda: self._escritos >= numero, timeout):
+                return False
+            return numero > self._fallido
+
+    def _escritor(self):
+        while True:
+            self._despertar.wait()
+            self._despertar.clear()
+            # Lo que se anota mientras dura un fsync sale todo junto en el siguiente
+            cambios = []
+            while True:
+                try:
+                    cambios.append(self._cola.popleft())
+                except IndexError:
+                    break
+            if not cambios:
+                continue
+            try:
+                self._escribir_lote(cambios)
+                fallo = False
+            except Exception as e:
+                print(f"Error al escribir la bitacora: {str(e)}")
+                # Lo que quedo en disco puede estar cortado: se compacta en el proximo lote
+                self._incompleta = fallo = True
+            with self._escrito:
+                self._escritos += len(cambios)
+                if fallo:
+                    self._fallido = self._escritos
+                self._escrito.notify_all()
+
+    def _escribir_lote(self, cambios):
+        for estado, archivo, destino, inodo in cambios:
+            if estado == COMPLETADO:
+                self.estados.pop(archivo, None)
+            else:
+                self.estados[archivo] = (estado, destino, inodo)
+        if self._tamano > self.tamano_maximo or self._incompleta:
+            # El snapshot ya incluye este lote (y los que fallaron antes)
+            self._compactar()
+            self._incompleta = False
+            self.fsyncs += 1
+            return
+        datos = memoryview(b"".join(self._linea(*cambio) for cambio in cambios))
+        self._tamano += len(datos)
+        while datos:
+            datos = datos[os.write(self._fd, datos):]
+        os.fdatasync(self._fd)
+        self.fsyncs += 1
@@ -0,0 +1,196 @@
+import fcntl
+import os
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+# Archivos de lock para coordinar varios procesos: cada ruta cae en una de
+# estas franjas (dos rutas de la misma franja se excluyen de mas, sin error)
+FRANJAS = 1024
+
+
+class LockLecturaEscritura:
+    """Lock que deja entrar a varios lectores a la vez o a un solo escritor.
+
+    Si hay un escritor esperando no se dejan entrar lectores nuevos, asi una
+    rafaga de lecturas no puede dejar al escritor esperando para siempre.
+    """
+
+    def __init__(self):
+        self._condicion = threading.Condition(threading.Lock())
+        self._lectores = 0
+        self._escribiendo = False
+        self._escritores_esperando = 0
+        # Cuantos hilos estan usando o esperando este lock (lo maneja el gestor)
+        self.referencias = 0
+
+    def adquirir_lectura(self):
+        """Devuelve True si tuvo que esperar"""
+        with self._condicion:
+            espero = False
+            while self._escribiendo or self._escritores_esperando:
+                espero = True
+                self._condicion.wait()
+            self._lectores += 1
+            return espero
+
+    def liberar_lectura(self):
+        with self._condicion:
+            self._lectores -= 1
+            if self._lectores == 0:
+                self._condicion.notify_all()
+
+    def adquirir_escritura(self):
+        """Devuelve True si tuvo que esperar"""
+        with self._condicion:
+            espero = False
+            self._escritores_esperando += 1
+            try:
+                while self._escribiendo or self._lectores:
+                    espero = True
+                    self._condicion.wait()
+            finally:
+                self._escritores_esperando -= 1
+            self._escribiendo = True
+            return espero
+
+    def liberar_escritura(self):
+        with self._condicion:
+            self._escribiendo = False
+            self._condicion.notify_all()
+
+
+class GestorBloqueos:
+    """Entrega un lock de lectura/escritura por cada ruta de archivo.
+
+    Los locks se crean cuando alguien los pide y se borran cuando nadie los
+    usa (conteo de referencias), asi que la tabla no crece con la cantidad
+    de archivos del servidor. Operaciones sobre archivos distintos nunca
+    compiten entre si.
+
+    Con un directorio, ademas de los locks del proceso se toma un flock
+    sobre el archivo de la franja de cada ruta, asi varios procesos del
+    servidor se excluyen entre si. Cada adquisicion abre su propio
+    descriptor: los flock de dos hilos del mismo proceso tambien compiten.
+    """
+
+    def __init__(self, directorio=None, franjas=FRANJAS):
+        self._mutex = threading.Lock()
+        self._locks = {}
+        self._estadisticas_mutex = threading.Lock()
+        self.adquisiciones = 0
+        self.contenciones = 0
+        self.tiempo_espera = 0.0
+        self.directorio = directorio
+        self.franjas = franjas
+        self.contenciones_procesos = 0
+        self.tiempo_espera_procesos = 0.0
+        if directorio is not None:
+            os.makedirs(directorio, exist_ok=True)
+
+    def _tomar(self, ruta):
+        with self._mutex:
+            lock = self._locks.get(ruta)
+            if lock is None:
+                lock = self._locks[ruta] = LockLecturaEscritura()
+            lock.referencias += 1
+            return lock
+
+    def _soltar(self, ruta, lock):
+        with self._mutex:
+            lock.referencias -= 1
+            if lock.referencias == 0:
+                del self._locks[ruta]
+
+    def _contar(self, espero, inicio):
+        with self._estadisticas_mutex:
+            self.adquisiciones += 1
+            if espero:
+                self.contenciones += 1
+                self.tiempo_espera += time.perf_counter() - inicio
+
+    def _franja(self, ruta):
+        # crc32 y no hash(): tiene que dar lo mismo en todos los procesos
+        return zlib.crc32(ruta.encode("utf-8", "surrogateescape")) % self.franjas
+
+    def _bloquear_franja(self, franja, escritura):
+        """flock sobre el archivo de la franja; devuelve el descriptor (cerrarlo lo libera)"""
+        fd = os.open(os.path.join(self.directorio, f"{franja:04d}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        modo = fcntl.LOCK_EX if escritura else fcntl.LOCK_SH
+        try:
+            try:
+                fcntl.flock(fd, modo | fcntl.LOCK_NB)
+            except BlockingIOError:
+                inicio = time.perf_counter()
+                fcntl.flock(fd, modo)
+                with self._estadisticas_mutex:
+                    self.contenciones_procesos += 1
+                    self.tiempo_espera_procesos += time.perf_counter() - inicio
+        except BaseException:
+            os.close(fd)
+            raise
+        return fd
+
+    @contextmanager
+    def bloquear(self, lecturas=(), escrituras=()):
+        """Toma locks de lectura y de escritura sobre varias rutas.
+
+        Se adquieren siempre en orden de ruta para que dos operaciones que
+        piden las mismas rutas no se bloqueen mutuamente. Los flock entre
+        procesos se toman despues de todos los locks del proceso, en orden de
+        franja y uno solo por franja.
+        """
+        modos = {ruta: False for ruta in lecturas}
+        modos.update({ruta: True for ruta in escrituras})
+        tomados = []
+        descriptores = []
+        try:
+            for ruta in sorted(modos):
+                lock = self._tomar(ruta)
+                inicio = time.perf_counter()
+                try:
+                    if modos[ruta]:
+                        espero = lock.adquirir_escritura()
+                    else:
+                        espero = lock.adquirir_lectura()
+                except BaseException:
+                    self._soltar(ruta, lock)
+                    raise
+                tomados.append((ruta, lock, modos[ruta]))
+                self._contar(espero, inicio)
+            if self.directorio is not None:
+                franjas = {}
+                for ruta, escritura in modos.items():
+                    franja = self._franja(ruta)
+                    franjas[franja] = franjas.get(franja, False) or escritura
+                for franja in sorted(franjas):
+                    descriptores.append(self._bloquear_franja(franja, franjas[franja]))
+            yield
+        finally:
+            for fd in reversed(descriptores):
+                os.close(fd)
+            for ruta, lock, escritura in reversed(tomados):
+                if escritura:
+                    lock.liberar_escritura()
+                else:
+                    lock.liberar_lectura()
+                self._soltar(ruta, lock)
+
+    def lectura(self, ruta):
+        return self.bloquear(lecturas=(ruta,))
+
+    def escritura(self, ruta):
+        return self.bloquear(escrituras=(ruta,))
+
+    def estadisticas(self):
+        with self._estadisticas_mutex:
+            return {
+                "adquisiciones": self.adquisiciones,
+                "contenciones": self.contenciones,
+                "tiempo_espera": self.tiempo_espera,
+                "locks_activos": len(self._locks),
+                "entre_procesos": self.directorio is not None,
+                "contenciones_procesos": self.contenciones_procesos,
+                "tiempo_espera_procesos": self.tiempo_espera_procesos,
+            }
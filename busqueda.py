@@ -0,0 +1,345 @@
+import array
+import bisect
+import concurrent.futures
+import fnmatch
+import mmap
+import os
+import re
+import threading
+
+# Busqueda de texto en los archivos de entrada y procesados (comando BUSCAR).
+#
+# Cada archivo se recorre mapeado con mmap, sin copiarlo a memoria, en un
+# pool de hilos compartido por todas las busquedas; las lineas que coinciden
+# se devuelven a medida que termina cada archivo. Con un IndiceTrigramas,
+# cada archivo leido recuerda que secuencias de 3 bytes contiene: si no tiene
+# todas las del texto buscado se salta sin abrirlo. El indice se mantiene de
+# a poco: solo se vuelve a leer un archivo cuando cambia su inodo, su tamano
+# o su mtime.
+
+HILOS = min(8, max(4, os.cpu_count() or 1))
+LIMITE_POR_DEFECTO = 1000
+LIMITE_MAXIMO = 10000
+# Bytes que se devuelven de una linea larga (alrededor de la coincidencia)
+LARGO_MAXIMO_LINEA = 512
+# Un archivo con un byte nulo al comienzo se considera binario y no se busca en el
+MUESTRA_BINARIO = 8192
+BLOQUE_SALIDA = 64 * 1024
+# Si en este tiempo no termino ningun archivo se entrega None (ver Conexion.enviar_flujo)
+ESPERA = 1.0
+# Archivos mas grandes que esto no se indexan: se recorren siempre
+TAMANO_MAXIMO_INDEXADO = 8 * 1024 * 1024
+PRESUPUESTO_INDICE = 256 * 1024 * 1024
+
+OPCIONES_VALIDAS = ("texto", "directorio", "patron", "tamano_min", "tamano_max", "limite", "por_archivo",
+                    "ignorar_mayusculas")
+
+
+class ErrorBusqueda(Exception):
+    """Opciones de busqueda invalidas"""
+
+
+def parsear_opciones(texto, directorios):
+    """Convierte "clave=valor" (una por linea) en un diccionario validado"""
+    opciones = {"texto": None, "directorio": None, "patron": None, "tamano_min": 0, "tamano_max": None,
+                "limite": LIMITE_POR_DEFECTO, "por_archivo": None, "ignorar_mayusculas": False}
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        clave, separador, valor = linea.partition("=")
+        clave = clave.strip()
+        if not separador or clave not in OPCIONES_VALIDAS:
+            raise ErrorBusqueda(f"Opcion desconocida: {linea}")
+        if clave in ("tamano_min", "tamano_max", "limite", "por_archivo"):
+            try:
+                valor = int(valor)
+            except ValueError:
+                raise ErrorBusqueda(f"{clave} debe ser un numero")
+            if valor < 0:
+                raise ErrorBusqueda(f"{clave} no puede ser negativo")
+        elif clave == "ignorar_mayusculas":
+            valor = valor.strip().lower() in ("1", "si", "true")
+        elif clave == "directorio":
+            valor = valor.strip()
+            if valor not in directorios and valor != "todos":
+                raise ErrorBusqueda(f"Directorio desconocido: {valor}")
+        elif clave == "patron":
+            valor = valor.strip()
+        opciones[clave] = valor
+    # El texto se toma tal cual, con espacios: es lo que se busca
+    if not opciones["texto"]:
+        raise ErrorBusqueda("Falta el texto a buscar (texto=...)")
+    opciones["texto"] = opciones["texto"].encode("utf-8")
+    if not 1 <= opciones["limite"] <= LIMITE_MAXIMO:
+        raise ErrorBusqueda(f"limite debe estar entre 1 y {LIMITE_MAXIMO}")
+    if opciones["directorio"] in (None, "todos"):
+        opciones["directorio"] = None
+    return opciones
+
+
+def trigramas(datos):
+    """Trigramas distintos de unos bytes, como enteros de 24 bits ordenados"""
+    vistos = set(zip(datos, datos[1:], datos[2:]))
+    return array.array("I", sorted((a << 16) | (b << 8) | c for a, b, c in vistos))
+
+
+class IndiceTrigramas:
+    """Que trigramas (secuencias de 3 bytes, en minusculas) tiene cada archivo ya leido.
+
+    Cada entrada guarda la firma de la version que se leyo (inodo, tamano y
+    mtime): si el archivo cambia la entrada deja de servir y se vuelve a
+    indexar la proxima vez que se lo recorra. Los trigramas van en un array
+    ordenado de enteros de 4 bytes, y el total no pasa de `presupuesto`
+    bytes: los archivos que ya no entran se recorren siempre.
+    """
+
+    def __init__(self, presupuesto=PRESUPUESTO_INDICE, tamano_maximo=TAMANO_MAXIMO_INDEXADO):
+        self.presupuesto = presupuesto
+        self.tamano_maximo = tamano_maximo
+        self.mutex = threading.Lock()
+        self.archivos = {}  # (directorio, nombre) -> (firma, trigramas, o None si es binario)
+        self.bytes = 0
+        self.indexados = 0
+        self.sin_lugar = 0
+
+    def descarta(self, clave, firma, consulta):
+        """True si el archivo, en esta version, seguro no contiene los trigramas de la consulta"""
+        with self.mutex:
+            entrada = self.archivos.get(clave)
+        if entrada is None or entrada[0] != firma:
+            return False
+        conocidos = entrada[1]
+        if conocidos is None:
+            return True
+        for trigrama in consulta:
+            i = bisect.bisect_left(conocidos, trigrama)
+            if i == len(conocidos) or conocidos[i] != trigrama:
+                return True
+        return False
+
+    def necesita(self, clave, firma, tamano):
+        """True si conviene indexar esta version del archivo"""
+        if tamano > self.tamano_maximo:
+            return False
+        with self.mutex:
+            entrada = self.archivos.get(clave)
+        return entrada is None or entrada[0] != firma
+
+    def agregar(self, clave, firma, datos, binario):
+        """Indexa el contenido de un archivo (bytes o mmap) con la firma de esa version"""
+        conocidos = None if binario else trigramas(datos[:].lower())
+        tamano = len(conocidos) * conocidos.itemsize if conocidos is not None else 0
+        with self.mutex:
+            anterior = self.archivos.pop(clave, None)
+            if anterior is not None and anterior[1] is not None:
+                self.bytes -= len(anterior[1]) * anterior[1].itemsize
+            if self.bytes + tamano > self.presupuesto:
+                self.sin_lugar += 1
+                return
+            self.archivos[clave] = (firma, conocidos)
+            self.bytes += tamano
+            self.indexados += 1
+
+    def conservar(self, directorio, nombres):
+        """Olvida los archivos de un directorio que ya no estan en `nombres`"""
+        with self.mutex:
+            for clave in [c for c in self.archivos if c[0] == directorio and c[1] not in nombres]:
+                _, conocidos = self.archivos.pop(clave)
+                if conocidos is not None:
+                    self.bytes -= len(conocidos) * conocidos.itemsize
+
+    def estadisticas(self):
+        with self.mutex:
+            return {"archivos": len(self.archivos), "bytes": self.bytes, "presupuesto": self.presupuesto,
+                    "indexados": self.indexados, "sin_lugar": self.sin_lugar}
+
+
+def _recortar(datos, inicio, fin, posicion):
+    """La linea [inicio, fin) de datos, o un tramo alrededor de posicion si es muy larga"""
+    if fin - inicio > LARGO_MAXIMO_LINEA:
+        inicio = max(inicio, min(posicion - LARGO_MAXIMO_LINEA // 4, fin - LARGO_MAXIMO_LINEA))
+        fin = inicio + LARGO_MAXIMO_LINEA
+    return datos[inicio:fin].rstrip(b"\r")
+
+
+def coincidencias(datos, texto, expresion=None, maximo=None, detener=None):
+    """Lineas de datos (bytes o mmap) que contienen texto: [(numero de linea, linea), ...].
+
+    Con una expresion (para ignorar mayusculas) se usa esa en lugar de
+    texto. Cada linea aparece una vez aunque tenga varias coincidencias; los
+    numeros de linea empiezan en 1.
+    """
+    lineas = []
+    desde = 0
+    numero = 1
+    contado_hasta = 0
+    while maximo is None or len(lineas) < maximo:
+        if detener is not None and detener.is_set():
+            break
+        if expresion is not None:
+            encontrada = expresion.search(datos, desde)
+            posicion = encontrada.start() if encontrada else -1
+        else:
+            posicion = datos.find(texto, desde)
+        if posicion < 0:
+            break
+        inicio = datos.rfind(b"\n", 0, posicion) + 1
+        fin = datos.find(b"\n", posicion)
+        if fin < 0:
+            fin = len(datos)
+        numero += datos[contado_hasta:inicio].count(b"\n")
+        contado_hasta = inicio
+        lineas.append((numero, _recortar(datos, inicio, fin, posicion)))
+        desde = fin + 1
+    return lineas
+
+
+class Buscador:
+    """Pool de hilos para las busquedas y, opcionalmente, su indice de trigramas"""
+
+    def __init__(self, hilos=HILOS, indice=None):
+        self.hilos = hilos
+        self.indice = indice
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="busqueda")
+        self.mutex = threading.Lock()
+        self.busquedas = 0
+        self.archivos_leidos = 0
+        self.archivos_saltados = 0
+        self.bytes_leidos = 0
+        self.coincidencias = 0
+        self.errores = 0
+
+    def _candidatos(self, fuentes, opciones, consulta, saltados):
+        """(directorio, objeto Directorio, nombre, firma) de los archivos que hay que recorrer.
+
+        Cuenta en saltados[0] los que el indice descarto.
+        """
+        for etiqueta, indice_directorio in fuentes:
+            archivos = indice_directorio.copia()
+            if self.indice is not None:
+                self.indice.conservar(etiqueta, archivos)
+            nombres = sorted(archivos)
+            if opciones["patron"] and opciones["patron"] != "*":
+                nombres = [n for n in nombres if fnmatch.fnmatchcase(n, opciones["patron"])]
+            for nombre in nombres:
+                tamano, mtime, inodo = archivos[nombre]
+                if tamano < opciones["tamano_min"] or (opciones["tamano_max"] is not None
+                                                       and tamano > opciones["tamano_max"]):
+                    continue
+                firma = (inodo, tamano, mtime)
+                if self.indice is not None and self.indice.descarta((etiqueta, nombre), firma, consulta):
+                    saltados[0] += 1
+                    continue
+                yield etiqueta, indice_directorio.directorio, nombre, firma
+
+    def _buscar_en_archivo(self, candidato, abrir, opciones, expresion, maximo, detener):
+        etiqueta, directorio, nombre, _ = candidato
+        if detener.is_set():
+            return etiqueta, nombre, []
+        try:
+            archivo = abrir(directorio, nombre)
+            if archivo is None:
+                return etiqueta, nombre, []
+            with archivo:
+                estado = os.fstat(archivo.fileno())
+                if not estado.st_size:
+                    return etiqueta, nombre, []
+                with mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+                    binario = b"\0" in datos[:MUESTRA_BINARIO]
+                    firma = (estado.st_ino, estado.st_size, estado.st_mtime)
+                    if self.indice is not None and self.indice.necesita((etiqueta, nombre), firma, estado.st_size):
+                        self.indice.agregar((etiqueta, nombre), firma, datos, binario)
+                    lineas = [] if binario else coincidencias(datos, opciones["texto"], expresion, maximo, detener)
+            with self.mutex:
+                self.archivos_leidos += 1
+                self.bytes_leidos += estado.st_size
+            return etiqueta, nombre, lineas
+        except (OSError, ValueError):
+            # Se borro o se trunco mientras lo recorriamos
+            with self.mutex:
+                self.errores += 1
+            return etiqueta, nombre, []
+
+    def buscar(self, fuentes, opciones, abrir):
+        """Generador de bloques de bytes con las lineas que coinciden.
+
+        fuentes es [(nombre, IndiceDirectorio), ...] y abrir(directorio,
+        nombre) abre un archivo (o devuelve None si ya no esta). Cada linea
+        del resultado es "directorio<TAB>nombre<TAB>numero<TAB>linea"; al final
+        va una linea "# ..." con el resumen. Si pasa ESPERA sin que termine
+        ningun archivo entrega None, para que quien envia pueda ver si el
+        cliente corto.
+        """
+        texto = opciones["texto"]
+        expresion = re.compile(re.escape(texto), re.IGNORECASE) if opciones["ignorar_mayusculas"] else None
+        consulta = trigramas(texto.lower()) if self.indice is not None else None
+        limite = opciones["limite"]
+        maximo = min(limite, opciones["por_archivo"]) if opciones["por_archivo"] else limite
+        with self.mutex:
+            self.busquedas += 1
+
+        detener = threading.Event()
+        saltados = [0]
+        candidatos = self._candidatos(fuentes, opciones, consulta, saltados)
+        pendientes = set()
+        agotados = False
+        encontradas = archivos = revisados = 0
+        try:
+            while True:
+                # Pocos archivos en vuelo a la vez: asi el limite corta rapido
+                # y una busqueda no acapara el pool
+                while not agotados and len(pendientes) < 2 * self.hilos:
+                    candidato = next(candidatos, None)
+                    if candidato is None:
+                        agotados = True
+                        break
+                    pendientes.add(self.pool.submit(self._buscar_en_archivo, candidato, abrir, opciones,
+                                                    expresion, maximo, detener))
+                if not pendientes:
+                    break
+                hechos, pendientes = concurrent.futures.wait(pendientes, ESPERA,
+                                                             concurrent.futures.FIRST_COMPLETED)
+                if not hechos:
+                    yield None
+                    continue
+                salida, tamano = [], 0
+                for futuro in hechos:
+                    etiqueta, nombre, lineas = futuro.result()
+                    revisados += 1
+                    if lineas and encontradas < limite:
+                        archivos += 1
+                    prefijo = f"{etiqueta}\t{nombre}\t".encode("utf-8", "surrogateescape")
+                    for numero, linea in lineas[:limite - encontradas]:
+                        salida.append(b"%s%d\t%s\n" % (prefijo, numero, linea))
+                        tamano += len(salida[-1])
+                        encontradas += 1
+                        if tamano >= BLOQUE_SALIDA:
+                            yield b"".join(salida)
+                            salida, tamano = [], 0
+                if salida:
+                    yield b"".join(salida)
+                if encontradas >= limite:
+                    break
+        finally:
+            detener.set()
+            for futuro in pendientes:
+                futuro.cancel()
+            candidatos.close()
+            with self.mutex:
+                self.coincidencias += encontradas
+                self.archivos_saltados += saltados[0]
+
+        resumen = f"# {encontradas} coincidencias en {archivos} archivos ({revisados} revisados"
+        if self.indice is not None:
+            resumen += f", {saltados[0]} descartados por el indice"
+        resumen += ")" + (", se alcanzo el limite" if encontradas >= limite else "")
+        yield resumen.encode("utf-8") + b"\n"
+
+    def estadisticas(self):
+        with self.mutex:
+            estadisticas = {"busquedas": self.busquedas, "archivos_leidos": self.archivos_leidos,
+                            "archivos_saltados": self.archivos_saltados, "bytes_leidos": self.bytes_leidos,
+                            "coincidencias": self.coincidencias, "errores": self.errores}
+        if self.indice is not None:
+            estadisticas.update({f"indice_{clave}": valor for clave, valor in self.indice.estadisticas().items()})
+        return estadisticas
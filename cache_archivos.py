@@ -0,0 +1,107 @@
+import collections
+import mmap
+import os
+import threading
+
+# Cache del contenido de los archivos mas leidos (LEER y DESCARGAR).
+#
+# Cada entrada guarda el contenido de una ruta junto con el inodo, el tamano
+# y el mtime que tenia al leerla; antes de usarla se compara con un stat de
+# la ruta, asi un archivo reemplazado o movido por otro proceso nunca se
+# sirve viejo. Lo que cambia el propio servidor (SUBIR, COPIAR) y lo que el
+# indice ve desaparecer de entrada (el demonio) se invalida directamente.
+# Los archivos grandes se mapean con mmap en lugar de copiarse al heap: las
+# paginas las comparte el cache del sistema operativo. Entrada y procesados
+# siempre se reemplazan con os.replace, nunca se truncan, asi que un mmap
+# sigue viendo la version que se leyo.
+
+PRESUPUESTO = 64 * 1024 * 1024
+UMBRAL_MMAP = 256 * 1024
+# Un archivo que ocupa mas de esta fraccion del presupuesto no se guarda
+FRACCION_MAXIMA = 0.25
+
+
+def _firma(estado):
+    return (estado.st_ino, estado.st_size, estado.st_mtime_ns)
+
+
+class CacheArchivos:
+    """Contenido de archivos por ruta, con un presupuesto de bytes y desalojo LRU"""
+
+    def __init__(self, presupuesto=PRESUPUESTO, umbral_mmap=UMBRAL_MMAP):
+        self.presupuesto = presupuesto
+        self.umbral_mmap = umbral_mmap
+        self.mutex = threading.Lock()
+        self._entradas = collections.OrderedDict()  # ruta -> (contenido, estado)
+        self.ocupado = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.desalojos = 0
+        self.invalidaciones = 0
+
+    def obtener(self, ruta):
+        """Contenido guardado de la ruta si sigue siendo el del disco.
+
+        Devuelve (contenido, estado) con el contenido en bytes o una vista de
+        un mmap y el stat del archivo que se leyo, o None si no esta (o ya no
+        vale).
+        Lanza FileNotFoundError si la ruta no existe, como open().
+        """
+        estado = os.stat(ruta)
+        with self.mutex:
+            entrada = self._entradas.get(ruta)
+            if entrada is not None and _firma(entrada[1]) == _firma(estado):
+                self._entradas.move_to_end(ruta)
+                self.aciertos += 1
+                return entrada
+            self.fallos += 1
+            if entrada is not None:
+                self._quitar(ruta)
+                self.invalidaciones += 1
+        return None
+
+    def leer(self, archivo, ruta):
+        """Lee un archivo ya abierto y lo guarda para la ruta.
+
+        Devuelve (contenido, estado) como obtener(), o None (sin leer nada)
+        si el archivo es demasiado grande para la cache.
+        """
+        estado = os.fstat(archivo.fileno())
+        if estado.st_size > self.presupuesto * FRACCION_MAXIMA:
+            return None
+        if estado.st_size >= self.umbral_mmap:
+            # Se guarda una vista: se envia como cualquier bytes y se puede
+            # recortar sin copiar
+            contenido = memoryview(mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ))
+        else:
+            contenido = archivo.read()
+        if len(contenido) == estado.st_size:
+            with self.mutex:
+                if ruta in self._entradas:
+                    self._quitar(ruta)
+                self._entradas[ruta] = (contenido, estado)
+                self.ocupado += len(contenido)
+                while self.ocupado > self.presupuesto:
+                    self._quitar(next(iter(self._entradas)))
+                    self.desalojos += 1
+        return contenido, estado
+
+    def _quitar(self, ruta):
+        # Un mmap no se cierra a mano: puede estar enviandose todavia, se
+        # libera solo cuando nadie lo usa
+        contenido, _ = self._entradas.pop(ruta)
+        self.ocupado -= len(contenido)
+
+    def invalidar(self, ruta):
+        with self.mutex:
+            if ruta in self._entradas:
+                self._quitar(ruta)
+                self.invalidaciones += 1
+
+    def estadisticas(self):
+        with self.mutex:
+            consultas = self.aciertos + self.fallos
+            return {"archivos": len(self._entradas), "bytes": self.ocupado, "presupuesto": self.presupuesto,
+                    "aciertos": self.aciertos, "fallos": self.fallos,
+                    "tasa_aciertos": self.aciertos / consultas if consultas else 0.0,
+                    "desalojos": self.desalojos, "invalidaciones": self.invalidaciones}
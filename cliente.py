@@ -1,34 +1,85 @@
+import argparse
+import hashlib
+import io
+import itertools
+import random
 import socket
 import os
+import sys
+import threading
 from pathlib import Path
 import ipaddress
 import time
 
+import compresion
+import delta
+import protocolo
+
+# Archivos desde este tamano se suben por diferencias si el servidor ya tiene una version
+UMBRAL_DELTA = 1024 * 1024
+# Si mas de esta fraccion del archivo no esta en la copia del servidor, se sube completo
+MAX_NUEVO_DELTA = 0.5
+# Y lo mismo pasados estos bytes: buscar coincidencias byte a byte en lo que
+# cambio anda a ~1 MB/s, asi que con muchos cambios es mas rapido mandar todo
+LIMITE_NUEVO_DELTA = 4 * 1024 * 1024
+# Solicitudes que se mandan sin esperar respuesta antes de leer alguna
+VENTANA_PIPELINE = 64
+
 class ClienteArchivos:
-    def __init__(self, host=None, port=None):
+    def __init__(self, host=None, port=None, codecs="zlib", nivel=None):
         self.host = host
         self.port = port
+        # Compresion que se pide al conectar ("zlib", "lzma", "lzma,zlib"... o None)
+        self.codecs = codecs
+        self.nivel = nivel
         self.socket = None
+        self.conexion = None
         self.buffer_size = 4096
+        self.espera_sugerida = None
 
     def conectar(self):
-        """Establece conexion con el servidor"""
+        """Establece conexion con el servidor y negocia el protocolo binario"""
         try:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((self.host, self.port))
-            print(f"Conectado al servidor {self.host}:{self.port}")
+            protocolo.configurar_socket(self.socket)
+            self.conexion = protocolo.Conexion(self.socket)
+            version = protocolo.negociar_cliente(self.conexion)
+            if self.codecs:
+                self._negociar_compresion()
+            codec = self.conexion.compresion[0] if self.conexion.compresion else "sin compresion"
+            print(f"Conectado al servidor {self.host}:{self.port} (protocolo v{version}, {codec})")
             return True
+        except protocolo.ServidorOcupado as e:
+            print(f"Error al conectar: {e}")
+            self.espera_sugerida = e.reintentar_en
+            self.socket.close()
+            self.socket = None
+            return False
         except Exception as e:
             print(f"Error al conectar: {e}")
+            if self.socket:
+                self.socket.close()
+                self.socket = None
             return False
 
-    def _reconectar(self, max_intentos=5, espera=8):
-        """Intenta reconectar hasta max_intentos veces"""
+    def _reconectar(self, max_intentos=5, espera=0.5, espera_maxima=30):
+        """Intenta reconectar hasta max_intentos veces.
+
+        Entre intentos la espera se duplica (espera, 2*espera, ... hasta
+        espera_maxima) y se elige al azar entre la mitad y el total, asi
+        muchos clientes que se cortaron juntos no vuelven todos a la vez.
+        """
         for intento in range(1, max_intentos + 1):
             print(f"Reintentando conexion ({intento}/{max_intentos})...")
             if self.conectar():
                 return True
-            time.sleep(espera)
+            if intento == max_intentos:
+                break
+            tope = min(espera_maxima, espera * 2 ** (intento - 1))
+            # Si el servidor estaba ocupado nos dice cuanto esperar
+            time.sleep(self.espera_sugerida or random.uniform(tope / 2, tope))
+            self.espera_sugerida = None
         return False
 
     def cerrar(self):
@@ -36,13 +87,13 @@ class ClienteArchivos:
         if self.socket:
             self.socket.close()
             self.socket = None
+            self.conexion = None
             print("Conexion cerrada")
 
-    def enviar_comando(self, comando):
-        """Envia un comando; si falla, intenta reconectar y reintentar una vez"""
+    def _con_reintento(self, operacion, *args):
+        """Ejecuta operacion; si falla, intenta reconectar y reintentar una vez"""
         try:
-            self.socket.sendall(comando.encode('utf-8'))
-            return self.socket.recv(self.buffer_size).decode('utf-8')
+            return operacion(*args)
         except Exception as e:
             print(f"Error en comunicacion: {e}")
             if not self._reconectar():
@@ -50,56 +101,569 @@ class ClienteArchivos:
                 self.cerrar()
                 return None
             try:
-                self.socket.sendall(comando.encode('utf-8'))
-                return self.socket.recv(self.buffer_size).decode('utf-8')
+                return operacion(*args)
             except Exception as e2:
                 print(f"Error tras reconexion: {e2}")
                 self.cerrar()
                 return None
 
+    def _negociar_compresion(self):
+        """Pide comprimir las transferencias; un servidor sin compresion responde con un error"""
+        pedido = {"codecs": self.codecs}
+        if self.nivel is not None:
+            pedido["nivel"] = self.nivel
+        ok, datos = self._solicitud(protocolo.OP_COMPRESION, "", protocolo.empaquetar_info(pedido))
+        info = protocolo.desempaquetar_info(datos) if ok else {}
+        if info.get("codec") in compresion.CODECS:
+            self.conexion.compresion = (info["codec"], info["nivel"])
+
+    def _solicitud(self, opcode, nombre, payload):
+        self.conexion.enviar_trama(opcode, nombre, payload)
+        return self._recibir_respuesta()
+
+    def _recibir_respuesta(self):
+        trama = self.conexion.recibir_trama()
+        if trama is None:
+            raise ConnectionError("El servidor cerro la conexion")
+        opcode_respuesta, _, datos = trama
+        return opcode_respuesta == protocolo.OP_OK, datos
+
+    def enviar_comando(self, opcode, nombre="", payload=b""):
+        """Envia una solicitud y devuelve (ok, datos) con los datos en bytes,
+        o None si no hubo respuesta"""
+        return self._con_reintento(self._solicitud, opcode, nombre, payload)
+
+    def _solicitar_varios(self, solicitudes, ventana):
+        conexion = self.conexion
+        ids = itertools.count(1)
+        orden = []
+        pendientes = {}  # id -> datos recibidos hasta ahora
+        descompresores = {}
+        resultados = {}
+        solicitudes = iter(solicitudes)
+        agotadas = False
+        try:
+            while True:
+                tramas = []
+                while not agotadas and len(pendientes) < ventana:
+                    try:
+                        opcode, nombre, payload = next(solicitudes)
+                    except StopIteration:
+                        agotadas = True
+                        break
+                    conexion.id_solicitud = next(ids)
+                    tramas.append(conexion.trama(opcode, nombre, payload))
+                    pendientes[conexion.id_solicitud] = bytearray()
+                    orden.append(conexion.id_solicitud)
+                if tramas:
+                    conexion.enviar(b"".join(tramas))
+                if not pendientes:
+                    break
+
+                cabecera = conexion.recibir_cabecera()
+                if cabecera is None:
+                    raise ConnectionError("El servidor cerro la conexion")
+                opcode, flags, _, largo = cabecera
+                # Un servidor v1 no manda ids pero responde en orden
+                id_respuesta = conexion.id_recibido if conexion.version >= 2 else next(iter(pendientes))
+                if id_respuesta not in pendientes:
+                    raise protocolo.ErrorProtocolo(f"Respuesta para una solicitud desconocida: {id_respuesta}")
+                payload = conexion.recibir_exacto(largo)
+                comprimido = flags & protocolo.FLAG_COMPRIMIDO
+                if opcode == protocolo.OP_DATOS:
+                    if not comprimido:
+                        pendientes[id_respuesta] += payload
+                        continue
+                    # Cada respuesta es un flujo comprimido aparte
+                    if id_respuesta not in descompresores:
+                        descompresores[id_respuesta] = conexion.descompresor()
+                    for datos in conexion.descomprimir(payload, descompresor=descompresores[id_respuesta]):
+                        pendientes[id_respuesta] += datos
+                elif comprimido:
+                    payload = b"".join(conexion.descomprimir(payload))
+                if opcode == protocolo.OP_FIN:
+                    descompresores.pop(id_respuesta, None)
+                    resultados[id_respuesta] = (True, bytes(pendientes.pop(id_respuesta)))
+                elif opcode in (protocolo.OP_OK, protocolo.OP_ERROR):
+                    del pendientes[id_respuesta]
+                    resultados[id_respuesta] = (opcode == protocolo.OP_OK, payload)
+        finally:
+            conexion.id_solicitud = 0
+        return [resultados[i] for i in orden]
+
+    def solicitar_varios(self, solicitudes, ventana=VENTANA_PIPELINE):
+        """Envia muchas solicitudes por la conexion sin esperar cada respuesta.
+
+        solicitudes es un iterable de (opcode, nombre, payload). Hay hasta
+        `ventana` en vuelo y las respuestas se emparejan por el id de la
+        solicitud, asi 5000 archivos chicos no cuestan 5000 idas y vueltas.
+        Devuelve una lista de (ok, datos) en el orden de las solicitudes (las
+        respuestas por partes se juntan en memoria), o None si se corto.
+        """
+        return self._con_reintento(self._solicitar_varios, list(solicitudes), ventana)
+
     def listar_archivos(self):
-        respuesta = self.enviar_comando("LISTAR|")
+        respuesta = self.enviar_comando(protocolo.OP_LISTAR)
         if respuesta is not None:
             print("\nArchivos en el servidor:")
-            print(respuesta)
+            print(respuesta[1].decode('utf-8'))
 
     def leer_archivo(self, nombre_archivo):
-        respuesta = self.enviar_comando(f"LEER|{nombre_archivo}")
-        if respuesta is not None:
-            print(f"\nContenido del archivo {nombre_archivo}:")
-            print(respuesta)
+        respuesta = self.enviar_comando(protocolo.OP_LEER, nombre_archivo)
+        if respuesta is None:
+            return
+        ok, datos = respuesta
+        if not ok:
+            print(datos.decode('utf-8'))
+            return
+        print(f"\nContenido del archivo {nombre_archivo}:")
+        print(datos.decode('utf-8', errors='replace'))
+
+    def _subir(self, ruta_archivo, nombre):
+        with open(ruta_archivo, 'rb') as f:
+            self.conexion.enviar_trama(protocolo.OP_SUBIR, nombre, flags=protocolo.FLAG_POR_PARTES)
+            self.conexion.enviar_archivo(f, comprimir=self.conexion.conviene_comprimir(nombre, f))
+        return self._recibir_respuesta()
+
+    def _subir_delta(self, ruta_archivo, nombre):
+        """Sube solo lo que cambio respecto de la copia que tiene el servidor.
+
+        Devuelve (ok, datos, bytes_nuevos), o None si no conviene: el servidor
+        no tiene el archivo, no soporta diferencias o cambio demasiado.
+        """
+        self.conexion.enviar_trama(protocolo.OP_FIRMAS, nombre)
+        info = {}
+        firmas = io.BytesIO()
+        ok, _ = self.conexion.recibir_archivo(firmas, info.update)
+        if not ok or "bloque" not in info:
+            return None
+        tamano = os.path.getsize(ruta_archivo)
+        try:
+            instrucciones, nuevos = delta.calcular_delta(
+                ruta_archivo, delta.leer_firmas(firmas.getvalue()), info["bloque"], info["tamano"],
+                min(int(tamano * MAX_NUEVO_DELTA), LIMITE_NUEVO_DELTA))
+        except delta.DeltaNoConviene:
+            return None
+
+        suma = hashlib.sha256()
+        with open(ruta_archivo, 'rb') as f:
+            for bloque in iter(lambda: f.read(protocolo.BLOQUE_TRANSFERENCIA), b""):
+                suma.update(bloque)
+            cabecera = protocolo.empaquetar_info({"etag": info["etag"], "bloque": info["bloque"],
+                                                  "tamano": tamano, "sha256": suma.hexdigest()})
+            self.conexion.enviar_trama(protocolo.OP_DELTA, nombre, flags=protocolo.FLAG_POR_PARTES)
+            self.conexion.enviar_flujo(delta.codificar(instrucciones, f, cabecera))
+        ok, datos = self._recibir_respuesta()
+        return ok, datos, nuevos
+
+    def subir(self, ruta_archivo, nombre=None, por_diferencias=True):
+        """Sube un archivo por bloques, sin cargarlo entero en memoria ni mostrar nada.
+
+        Si es grande y el servidor ya tiene una version, se manda solo lo que
+        cambio (ver delta.py); si eso no se puede, o con por_diferencias=False,
+        se sube completo. Devuelve (ok, mensaje, bytes_enviados) o None si se
+        corto la conexion.
+        """
+        nombre = nombre or os.path.basename(ruta_archivo)
+        tamano = os.path.getsize(ruta_archivo)
+        if por_diferencias and tamano >= UMBRAL_DELTA:
+            respuesta = self._con_reintento(self._subir_delta, ruta_archivo, nombre)
+            if respuesta is not None and respuesta[0]:
+                return True, respuesta[1].decode('utf-8'), respuesta[2]
+        respuesta = self._con_reintento(self._subir, ruta_archivo, nombre)
+        if respuesta is None:
+            return None
+        return respuesta[0], respuesta[1].decode('utf-8'), tamano
 
     def subir_archivo(self, ruta_archivo):
+        """Sube un archivo y muestra el resultado"""
         if not os.path.exists(ruta_archivo):
             print(f"Error: el archivo {ruta_archivo} no existe")
             return
+        tamano = os.path.getsize(ruta_archivo)
+        respuesta = self.subir(ruta_archivo)
+        if respuesta is not None:
+            print(respuesta[1])
+            if respuesta[0] and respuesta[2] < tamano:
+                print(f"Subida por diferencias: {respuesta[2]} bytes nuevos de {tamano}")
+
+    def _subir_lote(self, rutas):
+        self.conexion.enviar_trama(protocolo.OP_SUBIR_LOTE, flags=protocolo.FLAG_POR_PARTES)
+        envio = protocolo.EnvioAgrupado(self.conexion)
+        for ruta in rutas:
+            with open(ruta, 'rb') as f:
+                envio.agregar_archivo(os.path.basename(ruta), f)
+        envio.agregar(protocolo.OP_FIN)
+        envio.vaciar()
+        return self._recibir_respuesta()
+
+    def subir_directorio(self, directorio):
+        """Sube todos los archivos de un directorio (sin subdirectorios) en una sola solicitud"""
+        if not os.path.isdir(directorio):
+            print(f"Error: {directorio} no es un directorio")
+            return
+        rutas = sorted(os.path.join(directorio, n) for n in os.listdir(directorio)
+                       if os.path.isfile(os.path.join(directorio, n)))
+        if not rutas:
+            print(f"No hay archivos para subir en {directorio}")
+            return
+        inicio = time.monotonic()
+        respuesta = self._con_reintento(self._subir_lote, rutas)
+        if respuesta is not None:
+            print(respuesta[1].decode('utf-8'))
+            if respuesta[0]:
+                print(f"{len(rutas)} archivos subidos en {time.monotonic() - inicio:.2f} s")
+
+    def _descargar_lote(self, nombres, directorio):
+        self.conexion.enviar_trama(protocolo.OP_DESCARGAR_LOTE, payload="\n".join(nombres).encode('utf-8'))
+        descargados, errores = [], []
+        actual = None  # (nombre, ruta, ruta parcial, archivo)
         try:
-            with open(ruta_archivo, 'r') as f:
-                contenido = f.read()
-            nombre = os.path.basename(ruta_archivo)
-            respuesta = self.enviar_comando(f"SUBIR|{nombre}|{contenido}")
-            if respuesta is not None:
-                print(respuesta)
-        except Exception as e:
-            print(f"Error al subir el archivo: {e}")
+            while True:
+                cabecera = self.conexion.recibir_cabecera()
+                if cabecera is None:
+                    raise ConnectionError("El servidor cerro la conexion")
+                opcode, _, nombre, largo = cabecera
+                if opcode == protocolo.OP_INFO and actual is None:
+                    self.conexion.recibir_exacto(largo)
+                    ruta = os.path.join(directorio, os.path.basename(nombre))
+                    actual = (nombre, ruta, ruta + ".parcial", open(ruta + ".parcial", 'wb'))
+                elif opcode == protocolo.OP_DATOS and actual is not None:
+                    self.conexion.recibir_hacia_archivo(actual[3], largo)
+                elif opcode == protocolo.OP_FIN and actual is not None:
+                    self.conexion.recibir_exacto(largo)
+                    actual[3].close()
+                    os.replace(actual[2], actual[1])
+                    descargados.append(actual[0])
+                    actual = None
+                elif opcode == protocolo.OP_ERROR:
+                    mensaje = self.conexion.recibir_exacto(largo)
+                    if not nombre:
+                        return False, mensaje  # fallo el lote entero (o el servidor no lo soporta)
+                    errores.append((nombre, mensaje.decode('utf-8')))
+                elif opcode == protocolo.OP_OK:
+                    self.conexion.recibir_exacto(largo)
+                    return True, (descargados, errores)
+                else:
+                    raise protocolo.ErrorProtocolo(f"Trama inesperada en un lote: {hex(opcode)}")
+        finally:
+            if actual is not None:
+                actual[3].close()
+                os.remove(actual[2])
+
+    def descargar_varios(self, nombres, directorio="."):
+        """Descarga muchos archivos en una sola solicitud (DESCARGAR_LOTE).
+
+        Devuelve (descargados, errores) con errores como (nombre, mensaje), o
+        None si el lote fallo.
+        """
+        nombres = list(nombres)
+        os.makedirs(directorio, exist_ok=True)
+        inicio = time.monotonic()
+        respuesta = self._con_reintento(self._descargar_lote, nombres, directorio)
+        if respuesta is None:
+            return None
+        if not respuesta[0]:
+            print(respuesta[1].decode('utf-8'))
+            return None
+        descargados, errores = respuesta[1]
+        for _, mensaje in errores:
+            print(mensaje)
+        print(f"{len(descargados)} de {len(nombres)} archivos descargados en {time.monotonic() - inicio:.2f} s")
+        return descargados, errores
+
+    def _descargar(self, nombre_archivo, ruta_parcial):
+        """Descarga a ruta_parcial retomando lo que ya tenga.
+
+        Si hay un .parcial con su etag se pide solo lo que falta; si el archivo
+        cambio en el servidor, este lo manda completo y se pisa lo que habia.
+        """
+        ruta_etag = ruta_parcial + ".etag"
+        opciones = {"desde": 0}
+        if os.path.exists(ruta_parcial) and os.path.exists(ruta_etag):
+            with open(ruta_etag) as f:
+                opciones = {"desde": os.path.getsize(ruta_parcial), "si_coincide": f.read().strip()}
+        self.conexion.enviar_trama(protocolo.OP_DESCARGAR, nombre_archivo, protocolo.empaquetar_info(opciones))
+
+        with open(ruta_parcial, 'r+b' if os.path.exists(ruta_parcial) else 'w+b') as f:
+            def al_recibir_info(info):
+                # Lo que llegue se escribe desde donde el servidor dice que empieza
+                with open(ruta_etag, 'w') as e:
+                    e.write(info["etag"])
+                f.seek(info["desde"])
+                if info["desde"]:
+                    print(f"Retomando descarga de {nombre_archivo} desde el byte {info['desde']}")
+
+            # Un servidor sin rangos no manda OP_INFO: los datos empiezan en el byte 0
+            ok, datos = self.conexion.recibir_archivo(f, al_recibir_info)
+            if ok:
+                f.truncate()
+                datos = f.tell()
+        return ok, datos
+
+    def descargar(self, nombre_archivo, destino=None):
+        """Descarga un archivo escribiendo cada bloque a disco a medida que llega.
+
+        Si la conexion se corta, al reconectar se sigue desde lo que ya llego
+        (y lo mismo si se vuelve a pedir despues de un corte): lo recibido
+        queda en destino.parcial. Devuelve (ok, bytes o mensaje de error), o
+        None si no se pudo terminar.
+        """
+        destino = destino or nombre_archivo
+        ruta_parcial = destino + ".parcial"
+        respuesta = self._con_reintento(self._descargar, nombre_archivo, ruta_parcial)
+        if respuesta is None:
+            return None
+        if not respuesta[0]:
+            for ruta in (ruta_parcial, ruta_parcial + ".etag"):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            return False, respuesta[1].decode('utf-8')
+        os.replace(ruta_parcial, destino)
+        if os.path.exists(ruta_parcial + ".etag"):
+            os.remove(ruta_parcial + ".etag")
+        return respuesta
 
     def descargar_archivo(self, nombre_archivo):
-        respuesta = self.enviar_comando(f"DESCARGAR|{nombre_archivo}")
-        if respuesta is None or "Error" in respuesta:
-            print(respuesta or "Error desconocido")
+        """Descarga un archivo al directorio actual y muestra el resultado"""
+        respuesta = self.descargar(nombre_archivo)
+        if respuesta is None:
+            print(f"Descarga incompleta: lo recibido queda en {nombre_archivo}.parcial y se retoma la proxima vez")
+        elif not respuesta[0]:
+            print(respuesta[1])
+        else:
+            print(f"Archivo {nombre_archivo} descargado exitosamente ({respuesta[1]} bytes)")
+
+    def _leer_tramo(self, nombre_archivo, opciones, destino):
+        self.conexion.enviar_trama(protocolo.OP_LEER, nombre_archivo, protocolo.empaquetar_info(opciones))
+        info = {}
+        ok, datos = self.conexion.recibir_archivo(destino, info.update)
+        return ok, (info if ok else datos)
+
+    def leer_tramo(self, nombre_archivo, desde=0, largo=None, si_coincide=None, destino=None):
+        """Pide un tramo de un archivo y lo escribe en destino (un objeto con write).
+
+        Devuelve (ok, info) con el tamano, el etag y el rango enviado, o
+        (False, mensaje) si el servidor respondio con un error.
+        """
+        opciones = {"desde": desde}
+        if largo is not None:
+            opciones["largo"] = largo
+        if si_coincide is not None:
+            opciones["si_coincide"] = si_coincide
+        return self._con_reintento(self._leer_tramo, nombre_archivo, opciones, destino or io.BytesIO())
+
+    def descargar_en_paralelo(self, nombre_archivo, partes=4):
+        """Descarga un archivo grande en `partes` tramos, cada uno por su propia conexion"""
+        respuesta = self.leer_tramo(nombre_archivo, largo=0)
+        if respuesta is None or not respuesta[0]:
+            print(respuesta[1].decode('utf-8') if respuesta else "Error al consultar el archivo")
+            return False
+        tamano, etag = respuesta[1]["tamano"], respuesta[1]["etag"]
+        largo_parte = max(1, -(-tamano // partes))
+        ruta_parcial = nombre_archivo + ".parcial"
+        errores = []
+
+        def bajar(desde):
+            cliente = ClienteArchivos(self.host, self.port, self.codecs, self.nivel)
+            if not cliente.conectar():
+                errores.append(f"sin conexion para el tramo {desde}")
+                return
+            try:
+                destino = EscrituraEnPosicion(fd, desde)
+                r = cliente.leer_tramo(nombre_archivo, desde, largo_parte, etag, destino)
+                if r is None or not r[0]:
+                    errores.append(r[1].decode('utf-8') if r else f"fallo el tramo {desde}")
+                elif r[1]["etag"] != etag:
+                    errores.append("el archivo cambio en el servidor durante la descarga")
+            finally:
+                cliente.cerrar()
+
+        inicio = time.monotonic()
+        fd = os.open(ruta_parcial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, tamano)
+            hilos = [threading.Thread(target=bajar, args=(desde,)) for desde in range(0, tamano, largo_parte)]
+            for hilo in hilos:
+                hilo.start()
+            for hilo in hilos:
+                hilo.join()
+        finally:
+            os.close(fd)
+        if errores:
+            os.remove(ruta_parcial)
+            print(f"Error al descargar {nombre_archivo}: {errores[0]}")
+            return False
+        os.replace(ruta_parcial, nombre_archivo)
+        segundos = time.monotonic() - inicio
+        print(f"Archivo {nombre_archivo} descargado en {len(hilos)} partes ({tamano} bytes, "
+              f"{tamano / max(segundos, 1e-6) / 1024 / 1024:.1f} MB/s)")
+        return True
+
+    def _ver_logs(self, payload, salida):
+        self.conexion.enviar_trama(protocolo.OP_LOGS, payload=payload)
+        return self.conexion.recibir_archivo(salida)
+
+    def ver_logs(self, opciones=None):
+        """Muestra el log del servidor a medida que llega.
+
+        opciones es un diccionario con las opciones de consulta del servidor
+        (ultimas, desde_byte, desde_linea, limite, desde, hasta, contiene,
+        seguir). Con seguir=1 se queda mostrando lineas nuevas hasta Ctrl+C.
+        """
+        payload = "\n".join(f"{clave}={valor}" for clave, valor in (opciones or {}).items())
+        print("\nRegistro de operaciones del servidor:")
+        try:
+            respuesta = self._con_reintento(self._ver_logs, payload.encode('utf-8'), SalidaConsola())
+        except KeyboardInterrupt:
+            # Cortamos el seguimiento; la conexion queda a mitad de una trama,
+            # asi que la rehacemos
+            print("\nSeguimiento de logs detenido")
+            self.cerrar()
+            self.conectar()
             return
+        if respuesta is not None and not respuesta[0]:
+            print(respuesta[1].decode('utf-8'))
+
+    def _buscar(self, payload, salida):
+        self.conexion.enviar_trama(protocolo.OP_BUSCAR, payload=payload)
+        return self.conexion.recibir_archivo(salida)
+
+    def buscar(self, texto, opciones=None, salida=None):
+        """Busca un texto en los archivos del servidor y muestra las coincidencias a medida que llegan.
+
+        opciones es un diccionario con las demas opciones de BUSCAR
+        (directorio, patron, tamano_min, tamano_max, limite, por_archivo,
+        ignorar_mayusculas). Cada linea del resultado es directorio, nombre,
+        numero de linea y linea separados por tabuladores. Con salida (un
+        objeto con write) el resultado se escribe ahi en lugar de mostrarse.
+        """
+        payload = "\n".join(f"{clave}={valor}" for clave, valor in {"texto": texto, **(opciones or {})}.items())
         try:
-            with open(nombre_archivo, 'w') as f:
-                f.write(respuesta)
-            print(f"Archivo {nombre_archivo} descargado exitosamente")
-        except Exception as e:
-            print(f"Error al guardar el archivo: {e}")
+            respuesta = self._con_reintento(self._buscar, payload.encode('utf-8'), salida or SalidaConsola())
+        except KeyboardInterrupt:
+            # Como al seguir logs: la conexion quedo a mitad de la respuesta
+            print("\nBusqueda interrumpida")
+            self.cerrar()
+            self.conectar()
+            return False
+        if respuesta is not None and not respuesta[0]:
+            print(respuesta[1].decode('utf-8'))
+            return False
+        return respuesta is not None
+
+    def vigilar(self, al_evento, opciones=None):
+        """Sigue los cambios de entrada y procesados hasta Ctrl+C.
+
+        al_evento recibe cada evento como diccionario (secuencia, tipo,
+        directorio, nombre, tamano, fecha). opciones puede tener directorio y
+        patron. Si se corta la conexion se reconecta y sigue desde el ultimo
+        evento recibido. Si el servidor ya no tiene esos eventos (se
+        reinicio, o el cliente se atraso mas de lo que guarda) sigue con los
+        nuevos y antes llama a al_evento con un evento de tipo "perdidos":
+        hay que volver a listar para ponerse al dia. Si el servidor esta
+        ocupado espera lo que sugiere y vuelve a pedir.
+        """
+        lector = LectorEventos(al_evento)
+        try:
+            while True:
+                pedido = dict(opciones or {})
+                if lector.secuencia is not None:
+                    pedido.update(desde=lector.secuencia, generacion=lector.generacion)
+                payload = "\n".join(f"{clave}={valor}" for clave, valor in pedido.items())
+                try:
+                    self.conexion.enviar_trama(protocolo.OP_VIGILAR, payload=payload.encode('utf-8'))
+                    ok, datos = self.conexion.recibir_archivo(lector)
+                except (OSError, ConnectionError, protocolo.ErrorProtocolo) as e:
+                    print(f"Error en comunicacion: {e}")
+                    lector.resto = b""
+                    if not self._reconectar():
+                        print("No se pudo reconectar. Desconectando.")
+                        self.cerrar()
+                        return False
+                    continue
+                if ok:
+                    # El servidor corto el flujo porque nos atrasamos: se pide
+                    # de nuevo y, si ya no tiene los eventos, avisa
+                    continue
+                mensaje = datos.decode('utf-8', errors='replace')
+                if lector.secuencia is not None and "eventos perdidos" in mensaje:
+                    lector.perdidos()
+                    continue
+                espera = protocolo.espera_ocupado(mensaje)
+                if espera is not None:
+                    # El servidor tiene el maximo de seguimientos abiertos
+                    print(mensaje)
+                    time.sleep(espera)
+                    continue
+                print(mensaje)
+                return False
+        except KeyboardInterrupt:
+            # Como al seguir logs: la conexion quedo a mitad de la respuesta
+            print("\nVigilancia detenida")
+            self.cerrar()
+            self.conectar()
+            return True
 
-    def ver_logs(self):
-        respuesta = self.enviar_comando("LOGS|")
+    def ver_estadisticas(self, formato="texto"):
+        """Muestra las metricas del servidor (formato texto, json o prometheus)"""
+        respuesta = self.enviar_comando(protocolo.OP_STATS, payload=f"formato={formato}".encode('utf-8'))
         if respuesta is not None:
-            print("\nRegistro de operaciones del servidor:")
-            print(respuesta)
+            print("\nEstadisticas del servidor:")
+            print(respuesta[1].decode('utf-8'))
+
+class EscrituraEnPosicion:
+    """Objeto tipo archivo que escribe en un descriptor a partir de un offset (os.pwrite)"""
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, datos):
+        vista = memoryview(datos)
+        while vista:
+            escritos = os.pwrite(self.fd, vista, self.offset)
+            self.offset += escritos
+            vista = vista[escritos:]
+
+class LectorEventos:
+    """Objeto tipo archivo que arma las lineas de VIGILAR y se las pasa a al_evento como diccionarios.
+
+    Recuerda la secuencia y la generacion del ultimo evento para poder seguir
+    despues de una reconexion.
+    """
+    
+    def __init__(self, al_evento):
+        self.al_evento = al_evento
+        self.secuencia = None
+        self.generacion = None
+        self.resto = b""
+    
+    def write(self, datos):
+        lineas = (self.resto + bytes(datos)).split(b"\n")
+        self.resto = lineas.pop()
+        for linea in lineas:
+            linea = linea.decode('utf-8', errors='replace')
+            if linea.startswith("# secuencia "):
+                _, _, secuencia, _, generacion = linea.split(" ")
+                self.secuencia, self.generacion = int(secuencia), generacion
+            elif linea and not linea.startswith("#"):
+                secuencia, tipo, directorio, nombre, tamano, fecha = linea.split("\t")
+                self.secuencia = int(secuencia)
+                self.al_evento({"secuencia": self.secuencia, "tipo": tipo, "directorio": directorio,
+                                "nombre": nombre, "tamano": int(tamano) if tamano else None, "fecha": fecha})
+    
+    def perdidos(self):
+        self.resto = b""
+        self.secuencia = self.generacion = None
+        self.al_evento({"secuencia": None, "tipo": "perdidos", "directorio": None, "nombre": None,
+                        "tamano": None, "fecha": None})
+
+class SalidaConsola:
+    """Objeto tipo archivo que muestra en pantalla los bytes que recibe"""
+    
+    def write(self, datos):
+        sys.stdout.write(bytes(datos).decode('utf-8', errors='replace'))
+        sys.stdout.flush()
 
 def preguntar_host():
     while True:
@@ -129,14 +693,46 @@ def mostrar_menu():
     print("3. Subir archivo")
     print("4. Descargar archivo")
     print("5. Ver logs")
+    print("6. Seguir logs en vivo")
+    print("7. Descargar archivo grande en paralelo")
+    print("8. Descargar varios archivos")
+    print("9. Subir un directorio")
+    print("10. Ver estadisticas del servidor")
+    print("11. Buscar texto en los archivos del servidor")
+    print("12. Ver cambios en vivo")
     print("0. Salir")
     return input("Seleccione una opcion: ")
 
 def main():
-    host = preguntar_host()
-    port = preguntar_port()
+    parser = argparse.ArgumentParser(description="Cliente de archivos")
+    parser.add_argument("--host", help="IP del servidor (si no se indica se pregunta)")
+    parser.add_argument("--port", type=int, help="Puerto del servidor (si no se indica se pregunta)")
+    parser.add_argument("--sincronizar", choices=("subir", "bajar"),
+                        help="Sincroniza --directorio con el servidor sin menu: subir (local -> servidor) "
+                             "o bajar (servidor -> local)")
+    parser.add_argument("--directorio", default=".", help="Directorio local a sincronizar")
+    parser.add_argument("--conexiones", type=int, default=4, help="Conexiones en paralelo al sincronizar")
+    parser.add_argument("--compresion", default="zlib",
+                        help="Compresion a pedir para las transferencias: zlib, lzma (o varias en orden de "
+                             "preferencia, separadas por coma) o ninguna")
+    parser.add_argument("--nivel", type=int, help="Nivel de compresion (zlib 1-9, lzma 0-9)")
+    args = parser.parse_args()
+    codecs = None if args.compresion == "ninguna" else args.compresion
 
-    cliente = ClienteArchivos(host, port)
+    host = args.host or preguntar_host()
+    port = args.port or preguntar_port()
+
+    if args.sincronizar:
+        import sincronizacion
+        try:
+            resumen = sincronizacion.sincronizar(host, port, args.directorio, args.sincronizar,
+                                                 max(1, args.conexiones), codecs, args.nivel)
+        except (ConnectionError, OSError) as e:
+            print(f"Error al sincronizar: {e}")
+            sys.exit(1)
+        sys.exit(1 if resumen["errores"] else 0)
+
+    cliente = ClienteArchivos(host, port, codecs, args.nivel)
     if not cliente.conectar():
         return
 
@@ -155,7 +751,46 @@ def main():
                 nombre = input("Nombre del archivo a descargar: ")
                 cliente.descargar_archivo(nombre)
             elif opcion == "5":
-                cliente.ver_logs()
+                opciones = {}
+                ultimas = input("Ultimas N lineas (enter = todas): ").strip()
+                if ultimas:
+                    opciones["ultimas"] = ultimas
+                texto = input("Mostrar solo lineas que contengan (enter = todas): ")
+                if texto:
+                    opciones["contiene"] = texto
+                cliente.ver_logs(opciones)
+            elif opcion == "6":
+                print("Mostrando lineas nuevas del log (Ctrl+C para volver al menu)")
+                cliente.ver_logs({"ultimas": 10, "seguir": 1})
+            elif opcion == "7":
+                nombre = input("Nombre del archivo a descargar: ")
+                partes = input("Cantidad de conexiones (enter = 4): ").strip()
+                cliente.descargar_en_paralelo(nombre, int(partes) if partes.isdigit() else 4)
+            elif opcion == "8":
+                nombres = input("Nombres de los archivos (separados por coma): ")
+                destino = input("Directorio de destino (enter = actual): ").strip() or "."
+                cliente.descargar_varios([n.strip() for n in nombres.split(",") if n.strip()], destino)
+            elif opcion == "9":
+                directorio = input("Directorio a subir: ")
+                cliente.subir_directorio(directorio)
+            elif opcion == "10":
+                cliente.ver_estadisticas()
+            elif opcion == "11":
+                texto = input("Texto a buscar: ")
+                opciones = {}
+                patron = input("Solo archivos que coincidan con (enter = todos, ej. *.txt): ").strip()
+                if patron:
+                    opciones["patron"] = patron
+                directorio = input("Directorio (entrada, procesados, enter = ambos): ").strip()
+                if directorio:
+                    opciones["directorio"] = directorio
+                if texto:
+                    cliente.buscar(texto, opciones)
+            elif opcion == "12":
+                print("Mostrando archivos subidos, copiados, procesados y borrados (Ctrl+C para volver al menu)")
+                cliente.vigilar(lambda e: print(
+                    "Eventos perdidos, conviene volver a listar" if e["tipo"] == "perdidos" else
+                    f"[{e['fecha']}] {e['tipo']}: {e['directorio']}/{e['nombre']}"))
             elif opcion == "0":
                 break
             else:
@@ -0,0 +1,144 @@
+import collections
+import math
+import os
+import lzma
+import zlib
+
+# Compresion de los datos en el cable, negociada por conexion.
+#
+# Cada transferencia (una descarga, una subida, una consulta de logs) es un
+# unico flujo comprimido repartido en sus tramas OP_DATOS, asi el compresor
+# aprovecha las repeticiones entre bloques. Una trama suelta (la respuesta
+# de LEER) lleva un flujo completo.
+
+CODECS = ("zlib", "lzma")
+NIVELES = {"zlib": range(1, 10), "lzma": range(0, 10)}
+NIVEL_POR_DEFECTO = {"zlib": 6, "lzma": 1}
+
+# Por debajo de esto no vale la pena
+TAMANO_MINIMO = 1024
+# Estos ya vienen comprimidos: comprimirlos de nuevo gasta CPU y no achica nada
+# (la etapa comprimir del demonio usa la misma lista)
+EXTENSIONES_COMPRIMIDAS = {".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".rar",
+                           ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".pdf"}
+# Bits por byte a partir de los cuales los datos se consideran ya comprimidos o aleatorios
+UMBRAL_ENTROPIA = 7.5
+MUESTRA = 16 * 1024
+# Cuanto descomprimir de una vez (limita lo que ocupa en memoria una trama muy comprimible)
+BLOQUE_SALIDA = 1024 * 1024
+
+
+def entropia(datos):
+    """Entropia de Shannon en bits por byte (0 = todo igual, 8 = aleatorio)"""
+    if not datos:
+        return 0.0
+    total = len(datos)
+    return -sum(n / total * math.log2(n / total) for n in collections.Counter(datos).values())
+
+
+def conviene(nombre, muestra, tamano=None):
+    """Decide si comprimir unos datos por su extension y una muestra de su contenido"""
+    if os.path.splitext(nombre)[1].lower() in EXTENSIONES_COMPRIMIDAS:
+        return False
+    if (len(muestra) if tamano is None else tamano) < TAMANO_MINIMO:
+        return False
+    return entropia(muestra) < UMBRAL_ENTROPIA
+
+
+def conviene_archivo(nombre, archivo, offset=0, cantidad=None):
+    """Como conviene(), tomando muestras del principio, el medio y el final del tramo"""
+    if cantidad is None:
+        cantidad = os.fstat(archivo.fileno()).st_size - offset
+    if cantidad < TAMANO_MINIMO:
+        return False
+    posiciones = {offset, offset + max(0, cantidad // 2 - MUESTRA // 2), offset + max(0, cantidad - MUESTRA)}
+    muestra = b"".join(os.pread(archivo.fileno(), min(MUESTRA, cantidad), p) for p in sorted(posiciones))
+    return conviene(nombre, muestra, cantidad)
+
+
+def elegir(pedido, permitidos=CODECS):
+    """Elige el codec para una conexion a partir de lo que pide el cliente.
+
+    pedido es un diccionario con codecs (en orden de preferencia, separados
+    por coma) y opcionalmente nivel. Devuelve (codec, nivel) o None.
+    """
+    for codec in str(pedido.get("codecs", "")).split(","):
+        codec = codec.strip()
+        if codec in CODECS and codec in permitidos:
+            nivel = pedido.get("nivel", NIVEL_POR_DEFECTO[codec])
+            if nivel not in NIVELES[codec]:
+                nivel = NIVEL_POR_DEFECTO[codec]
+            return codec, nivel
+    return None
+
+
+class Compresor:
+    """Compresor de un flujo con el codec negociado"""
+
+    def __init__(self, codec, nivel):
+        self.codec = codec
+        self.nivel = nivel
+        self._nuevo()
+
+    def _nuevo(self):
+        if self.codec == "zlib":
+            self._compresor = zlib.compressobj(self.nivel)
+        else:
+            self._compresor = lzma.LZMACompressor(preset=self.nivel)
+
+    def comprimir(self, datos):
+        return self._compresor.compress(datos)
+
+    def vaciar(self):
+        """Lo pendiente, de forma que el otro extremo ya pueda descomprimir todo lo enviado"""
+        if self.codec == "zlib":
+            return self._compresor.flush(zlib.Z_SYNC_FLUSH)
+        # lzma no tiene un flush parcial: se cierra el flujo y se empieza otro
+        datos = self._compresor.flush()
+        self._nuevo()
+        return datos
+
+    def terminar(self):
+        return self._compresor.flush()
+
+
+class Descompresor:
+    """Descompresor de un flujo; acepta flujos lzma concatenados (ver Compresor.vaciar)"""
+
+    def __init__(self, codec):
+        self.codec = codec
+        self._nuevo()
+
+    def _nuevo(self):
+        self._descompresor = zlib.decompressobj() if self.codec == "zlib" else lzma.LZMADecompressor()
+
+    def descomprimir(self, datos):
+        """Genera lo descomprimido de a bloques de como mucho BLOQUE_SALIDA bytes"""
+        while True:
+            if self.codec == "zlib":
+                salida = self._descompresor.decompress(datos, BLOQUE_SALIDA)
+                datos = self._descompresor.unconsumed_tail
+                if salida:
+                    yield salida
+                if not datos and len(salida) < BLOQUE_SALIDA:
+                    return
+            else:
+                if self._descompresor.eof:
+                    datos = self._descompresor.unused_data + datos
+                    self._nuevo()
+                    if not datos:
+                        return
+                salida = self._descompresor.decompress(datos, BLOQUE_SALIDA)
+                datos = b""
+                if salida:
+                    yield salida
+                if self._descompresor.eof:
+                    if not self._descompresor.unused_data:
+                        return
+                elif self._descompresor.needs_input:
+                    return
+
+
+def comprimir_todo(codec, nivel, datos):
+    compresor = Compresor(codec, nivel)
+    return compresor.comprimir(datos) + compresor.terminar()
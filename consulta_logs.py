@@ -0,0 +1,304 @@
+import bisect
+import os
+import re
+import threading
+
+# Las lineas del servidor empiezan con "2024-01-31 12:00:00 - ..." y las del
+# demonio con "[2024-01-31 12:00:00] ...". Como el formato es fijo, comparar
+# los timestamps como texto es lo mismo que compararlos como fechas.
+PATRON_TIMESTAMP = re.compile(rb"^\[?(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})")
+PATRON_TIMESTAMP_LINEAS = re.compile(rb"(?m)^\[?(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})")
+
+# Cada cuantos bytes se guarda una entrada en el indice
+PASO_INDICE = 64 * 1024
+# Tamano de lectura y de cada bloque que se devuelve
+BLOQUE_LECTURA = 64 * 1024
+
+OPCIONES_VALIDAS = ("ultimas", "desde_byte", "desde_linea", "limite", "desde", "hasta", "contiene", "seguir")
+
+
+class ErrorConsulta(Exception):
+    """Opciones de consulta invalidas"""
+
+
+def parsear_opciones(texto):
+    """Convierte "clave=valor" (una por linea) en un diccionario validado"""
+    opciones = {}
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        clave, separador, valor = linea.partition("=")
+        clave = clave.strip()
+        if not separador or clave not in OPCIONES_VALIDAS:
+            raise ErrorConsulta(f"Opcion desconocida: {linea}")
+        opciones[clave] = valor
+
+    for clave in ("ultimas", "desde_byte", "desde_linea", "limite"):
+        if clave in opciones:
+            try:
+                opciones[clave] = int(opciones[clave])
+            except ValueError:
+                raise ErrorConsulta(f"{clave} debe ser un numero")
+            if opciones[clave] < 0:
+                raise ErrorConsulta(f"{clave} no puede ser negativo")
+    for clave in ("desde", "hasta"):
+        if clave in opciones:
+            valor = opciones[clave].strip()
+            if not PATRON_TIMESTAMP.match(valor.encode("utf-8")):
+                raise ErrorConsulta(f"{clave} debe tener el formato AAAA-MM-DD HH:MM:SS")
+            opciones[clave] = valor.encode("utf-8")
+    if "contiene" in opciones:
+        opciones["contiene"] = opciones["contiene"].encode("utf-8")
+    opciones["seguir"] = opciones.get("seguir", "0").strip().lower() in ("1", "si", "true")
+    if len({"ultimas", "desde_byte", "desde_linea"} & opciones.keys()) > 1:
+        raise ErrorConsulta("ultimas, desde_byte y desde_linea no se pueden combinar")
+    return opciones
+
+
+def timestamp_de(linea):
+    coincidencia = PATRON_TIMESTAMP.match(linea)
+    return coincidencia.group(1) if coincidencia else None
+
+
+class IndiceLog:
+    """Indice disperso de un archivo de log: (timestamp, offset, numero de linea).
+
+    Se guarda una entrada cada PASO_INDICE bytes, siempre al comienzo de una
+    linea. Se construye una vez recorriendo el archivo por bloques y despues
+    solo se extiende con lo que se agrego al final. Si el archivo roto (cambia
+    el inodo o se achica) se reconstruye desde cero.
+    """
+
+    def __init__(self, ruta):
+        self.ruta = ruta
+        self.mutex = threading.Lock()
+        self._reiniciar(None)
+
+    def _reiniciar(self, inodo):
+        self.inodo = inodo
+        self.timestamps = []
+        self.offsets = []
+        self.lineas = []
+        self.indexado_hasta = 0
+        self.lineas_hasta = 0
+        self.ultimo_timestamp = b""
+
+    def actualizar(self):
+        with self.mutex:
+            estado = os.stat(self.ruta)
+            if estado.st_ino != self.inodo or estado.st_size < self.indexado_hasta:
+                self._reiniciar(estado.st_ino)
+            if estado.st_size == self.indexado_hasta:
+                return
+            with open(self.ruta, "rb") as f:
+                self._indexar(f)
+
+    def _indexar(self, f):
+        posicion = self.indexado_hasta
+        f.seek(posicion)
+        while True:
+            bloque = f.read(PASO_INDICE)
+            if not bloque:
+                break
+            corte = bloque.rfind(b"\n")
+            while corte < 0:
+                mas = f.read(PASO_INDICE)
+                if not mas:
+                    break
+                bloque += mas
+                corte = bloque.rfind(b"\n")
+            if corte < 0:
+                break  # la ultima linea todavia se esta escribiendo
+            bloque = bloque[:corte + 1]
+
+            # Las lineas sin timestamp heredan el de la anterior
+            primera = PATRON_TIMESTAMP.match(bloque)
+            self.timestamps.append(primera.group(1) if primera else self.ultimo_timestamp)
+            self.offsets.append(posicion)
+            self.lineas.append(self.lineas_hasta)
+
+            # Ultimo timestamp del bloque (normalmente esta en los ultimos bytes)
+            encontrados = list(PATRON_TIMESTAMP_LINEAS.finditer(bloque, max(0, len(bloque) - 4096)))
+            if not encontrados:
+                encontrados = list(PATRON_TIMESTAMP_LINEAS.finditer(bloque))
+            if encontrados:
+                self.ultimo_timestamp = encontrados[-1].group(1)
+            self.lineas_hasta += bloque.count(b"\n")
+            posicion += len(bloque)
+            f.seek(posicion)
+        self.indexado_hasta = posicion
+
+    def offset_para_tiempo(self, desde):
+        """Offset de una linea al comienzo de un bloque anterior a `desde`"""
+        with self.mutex:
+            i = bisect.bisect_left(self.timestamps, desde) - 1
+            return (self.offsets[i], self.lineas[i]) if i >= 0 else (0, 0)
+
+    def offset_para_linea(self, numero):
+        """(offset, linea) de la entrada del indice mas cercana antes de `numero`"""
+        with self.mutex:
+            i = bisect.bisect_right(self.lineas, numero) - 1
+            return (self.offsets[i], self.lineas[i]) if i >= 0 else (0, 0)
+
+
+_indices = {}
+_indices_mutex = threading.Lock()
+
+
+def obtener_indice(ruta):
+    with _indices_mutex:
+        indice = _indices.get(ruta)
+        if indice is None:
+            indice = _indices[ruta] = IndiceLog(ruta)
+    indice.actualizar()
+    return indice
+
+
+def _pasa_filtros(linea, timestamp, opciones):
+    if "contiene" in opciones and opciones["contiene"] not in linea:
+        return False
+    if "desde" in opciones and timestamp < opciones["desde"]:
+        return False
+    if "hasta" in opciones and timestamp > opciones["hasta"]:
+        return False
+    return True
+
+
+def _lineas_desde(f, offset, fin):
+    """Recorre las lineas entre offset y fin, cada una con su salto de linea"""
+    f.seek(offset)
+    resto = b""
+    while offset < fin:
+        bloque = f.read(min(BLOQUE_LECTURA, fin - offset))
+        if not bloque:
+            break
+        offset += len(bloque)
+        partes = (resto + bloque).split(b"\n")
+        resto = partes.pop()
+        for linea in partes:
+            yield linea + b"\n"
+    if resto:
+        yield resto
+
+
+def _lineas_hacia_atras(f, fin):
+    """Recorre las lineas desde fin hacia el comienzo del archivo"""
+    posicion = fin
+    resto = b""
+    while posicion > 0:
+        leer = min(BLOQUE_LECTURA, posicion)
+        posicion -= leer
+        f.seek(posicion)
+        partes = (f.read(leer) + resto).split(b"\n")
+        resto = partes.pop(0)
+        for linea in reversed(partes):
+            if linea:
+                yield linea + b"\n"
+    if resto:
+        yield resto + b"\n"
+
+
+def consultar(ruta, opciones, fin=None):
+    """Devuelve bloques de bytes con las lineas del log que cumplen las opciones.
+
+    Solo mira hasta el byte `fin` (por defecto, el tamano actual), para que
+    el modo seguir pueda continuar justo desde ahi.
+    """
+    if fin is None:
+        fin = os.path.getsize(ruta)
+    filtra_tiempo = "desde" in opciones or "hasta" in opciones
+    limite = opciones.get("limite")
+
+    with open(ruta, "rb") as f:
+        if "ultimas" in opciones:
+            # Recorremos desde el final y despues devolvemos en orden
+            seleccion = []
+            for linea in _lineas_hacia_atras(f, fin):
+                if len(seleccion) >= opciones["ultimas"]:
+                    break
+                timestamp = timestamp_de(linea) if filtra_tiempo else None
+                if filtra_tiempo and timestamp is None:
+                    continue
+                if _pasa_filtros(linea, timestamp, opciones):
+                    seleccion.append(linea)
+            seleccion.reverse()
+            if limite is not None:
+                seleccion = seleccion[:limite]
+            for i in range(0, len(seleccion), 256):
+                yield b"".join(seleccion[i:i + 256])
+            return
+
+        saltar = 0
+        if "desde_byte" in opciones:
+            offset = min(opciones["desde_byte"], fin)
+        elif "desde_linea" in opciones:
+            offset, linea_inicio = obtener_indice(ruta).offset_para_linea(opciones["desde_linea"])
+            saltar = opciones["desde_linea"] - linea_inicio
+        elif "desde" in opciones:
+            offset, _ = obtener_indice(ruta).offset_para_tiempo(opciones["desde"])
+        else:
+            offset = 0
+
+        salida = []
+        tamano = 0
+        enviadas = 0
+        timestamp = b""
+        for linea in _lineas_desde(f, offset, fin):
+            if saltar:
+                saltar -= 1
+                continue
+            if filtra_tiempo:
+                timestamp = timestamp_de(linea) or timestamp
+                if "hasta" in opciones and timestamp > opciones["hasta"]:
+                    break
+            if not _pasa_filtros(linea, timestamp, opciones):
+                continue
+            salida.append(linea)
+            tamano += len(linea)
+            enviadas += 1
+            if tamano >= BLOQUE_LECTURA:
+                yield b"".join(salida)
+                salida, tamano = [], 0
+            if limite is not None and enviadas >= limite:
+                break
+        if salida:
+            yield b"".join(salida)
+
+
+def seguir(ruta, offset, opciones):
+    """Devuelve las lineas nuevas a medida que se escriben, desde offset.
+
+    Cuando no hay nada nuevo devuelve None, para que quien envia pueda
+    esperar un rato y revisar si el cliente pidio cortar. Si el log rota,
+    termina de leer el archivo viejo y sigue con el nuevo desde el comienzo.
+    """
+    f = open(ruta, "rb")
+    try:
+        f.seek(offset)
+        resto = b""
+        timestamp = b""
+        while True:
+            bloque = f.read(BLOQUE_LECTURA)
+            if not bloque:
+                try:
+                    rotado = os.stat(ruta).st_ino != os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    rotado = False
+                if rotado:
+                    f.close()
+                    f = open(ruta, "rb")
+                    continue
+                yield None
+                continue
+            partes = (resto + bloque).split(b"\n")
+            resto = partes.pop()
+            salida = []
+            for linea in partes:
+                linea += b"\n"
+                timestamp = timestamp_de(linea) or timestamp
+                if _pasa_filtros(linea, timestamp, opciones):
+                    salida.append(linea)
+            if salida:
+                yield b"".join(salida)
+    finally:
+        f.close()
@@ -0,0 +1,264 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+# Subida por diferencias al estilo rsync.
+#
+# El servidor parte su copia del archivo en bloques de `bloque` bytes y manda
+# la firma de cada uno: un checksum debil que se puede "rodar" byte a byte
+# (Adler-32) y un hash fuerte (BLAKE2b de 16 bytes). El cliente recorre su
+# version buscando ventanas cuya firma coincida y manda solo instrucciones:
+# "copia los bloques i..i+n de tu archivo" o "estos bytes nuevos". El
+# servidor arma el archivo nuevo en un temporal y lo verifica con el SHA-256
+# completo antes de reemplazar nada.
+
+MOD_ADLER = 65521
+FIRMA = struct.Struct("!I16s")  # adler32, blake2b-16
+LARGO = struct.Struct("!I")
+RANGO_BLOQUES = struct.Struct("!II")  # primer bloque, cantidad
+
+INSTRUCCION_CABECERA = b"H"
+INSTRUCCION_LITERAL = b"L"
+INSTRUCCION_BLOQUES = b"B"
+
+BLOQUE_MINIMO = 8 * 1024
+BLOQUE_MAXIMO = 1024 * 1024
+# Maximo de una instruccion literal (las mas largas se parten)
+LITERAL_MAXIMO = 1024 * 1024
+
+
+class DeltaNoConviene(Exception):
+    """Hay tan pocos bloques en comun que conviene subir el archivo completo"""
+
+
+def tamano_bloque(tamano):
+    """Bloque ~ raiz del tamano: pocas firmas y poco literal por cada cambio"""
+    bloque = int(math.sqrt(tamano)) // 1024 * 1024
+    return max(BLOQUE_MINIMO, min(BLOQUE_MAXIMO, bloque))
+
+
+def hash_fuerte(datos):
+    return hashlib.blake2b(datos, digest_size=16).digest()
+
+
+def firmas(archivo, bloque):
+    """Genera las firmas de un archivo abierto, en lotes de bytes empaquetados"""
+    lote = []
+    while True:
+        datos = archivo.read(bloque)
+        if not datos:
+            break
+        lote.append(FIRMA.pack(zlib.adler32(datos), hash_fuerte(datos)))
+        if len(lote) >= 4096:
+            yield b"".join(lote)
+            lote = []
+    if lote:
+        yield b"".join(lote)
+
+
+def leer_firmas(datos):
+    """Bytes de firmas -> lista de (adler32, hash fuerte) por numero de bloque"""
+    return [FIRMA.unpack_from(datos, i) for i in range(0, len(datos) - FIRMA.size + 1, FIRMA.size)]
+
+
+def calcular_delta(ruta, lista_firmas, bloque, tamano_base, limite_literal=None):
+    """Compara el archivo local con las firmas del servidor.
+
+    Devuelve (instrucciones, bytes_literales) donde cada instruccion es
+    ("B", primer_bloque, cantidad) o ("L", offset_local, largo); los
+    literales se leen del archivo local recien al enviar. Si los bytes sin
+    coincidencia pasan de limite_literal lanza DeltaNoConviene.
+    """
+    tabla = {}
+    completos = tamano_base // bloque
+    for indice, (debil, fuerte) in enumerate(lista_firmas[:completos]):
+        tabla.setdefault(debil, {}).setdefault(fuerte, indice)
+    # El ultimo bloque de la base puede ser mas corto: solo puede coincidir con el final
+    ultimo = lista_firmas[completos] if len(lista_firmas) > completos else None
+    largo_ultimo = tamano_base - completos * bloque
+
+    instrucciones = []
+    literales = 0
+
+    def agregar_bloque(indice):
+        if instrucciones and instrucciones[-1][0] == "B":
+            _, primero, cantidad = instrucciones[-1]
+            if primero + cantidad == indice:
+                instrucciones[-1] = ("B", primero, cantidad + 1)
+                return
+        instrucciones.append(("B", indice, 1))
+
+    with open(ruta, "rb") as f:
+        tamano = os.fstat(f.fileno()).st_size
+        if tamano == 0:
+            return [], 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = 0
+            inicio_literal = 0
+            debil = None
+            a = b = 0
+            while pos + bloque <= tamano and tabla:
+                if debil is None:
+                    debil = zlib.adler32(m[pos:pos + bloque])
+                    a, b = debil & 0xFFFF, debil >> 16
+                candidatos = tabla.get(debil)
+                if candidatos is not None:
+                    indice = candidatos.get(hash_fuerte(m[pos:pos + bloque]))
+                    if indice is not None:
+                        if inicio_literal < pos:
+                            instrucciones.append(("L", inicio_literal, pos - inicio_literal))
+                            literales += pos - inicio_literal
+                        agregar_bloque(indice)
+                        pos += bloque
+                        inicio_literal = pos
+                        debil = None
+                        continue
+                if limite_literal is not None and pos - inicio_literal + literales > limite_literal:
+                    raise DeltaNoConviene(f"mas de {limite_literal} bytes sin coincidencia")
+                # Rodamos la ventana un byte (Adler-32: a = 1 + suma, b = suma de los a)
+                if pos + bloque < tamano:
+                    sale, entra = m[pos], m[pos + bloque]
+                    a = (a - sale + entra) % MOD_ADLER
+                    b = (b - bloque * sale + a - 1) % MOD_ADLER
+                    debil = (b << 16) | a
+                pos += 1
+
+            cola = tamano - inicio_literal
+            if (ultimo is not None and largo_ultimo and cola >= largo_ultimo
+                    and zlib.adler32(m[tamano - largo_ultimo:]) == ultimo[0]
+                    and hash_fuerte(m[tamano - largo_ultimo:]) == ultimo[1]):
+                if cola > largo_ultimo:
+                    instrucciones.append(("L", inicio_literal, cola - largo_ultimo))
+                    literales += cola - largo_ultimo
+                agregar_bloque(completos)
+            elif cola:
+                instrucciones.append(("L", inicio_literal, cola))
+                literales += cola
+    if limite_literal is not None and literales > limite_literal:
+        raise DeltaNoConviene(f"mas de {limite_literal} bytes sin coincidencia")
+    return instrucciones, literales
+
+
+def codificar(instrucciones, archivo, cabecera):
+    """Genera los bytes del delta: cabecera y despues las instrucciones"""
+    yield INSTRUCCION_CABECERA + LARGO.pack(len(cabecera)) + cabecera
+    pendientes = []
+    for tipo, primero, cantidad in instrucciones:
+        if tipo == "B":
+            pendientes.append(INSTRUCCION_BLOQUES + RANGO_BLOQUES.pack(primero, cantidad))
+            continue
+        if pendientes:
+            yield b"".join(pendientes)
+            pendientes = []
+        archivo.seek(primero)
+        while cantidad:
+            datos = archivo.read(min(cantidad, LITERAL_MAXIMO))
+            yield INSTRUCCION_LITERAL + LARGO.pack(len(datos)) + datos
+            cantidad -= len(datos)
+    if pendientes:
+        yield b"".join(pendientes)
+
+
+class Reconstructor:
+    """Arma el archivo nuevo a partir de la base y el delta que va llegando.
+
+    Tiene write() para poder pasarlo a Conexion.recibir_archivo: el delta se
+    aplica a medida que llega, sin guardarlo. Si la base ya no es la version
+    de las firmas (otro etag) el resto del delta se descarta y terminar()
+    lanza el error; la conexion queda sincronizada igual.
+    """
+
+    def __init__(self, base, etag_base, salida):
+        self.base = base
+        self.etag_base = etag_base
+        self.salida = salida
+        self.cabecera = None
+        self.suma = hashlib.sha256()
+        self.escritos = 0
+        self.copiados = 0
+        self.error = None
+        self._buffer = bytearray()
+
+    def write(self, datos):
+        if self.error is not None:
+            return
+        self._buffer += datos
+        try:
+            self._procesar()
+        except Exception as e:
+            self.error = e
+            self._buffer = bytearray()
+
+    def _escribir(self, datos):
+        self.suma.update(datos)
+        self.salida.write(datos)
+        self.escritos += len(datos)
+
+    def _procesar(self):
+        buffer = self._buffer
+        posicion = 0
+        while posicion < len(buffer):
+            tipo = bytes(buffer[posicion:posicion + 1])
+            if tipo == INSTRUCCION_BLOQUES:
+                if len(buffer) - posicion < 1 + RANGO_BLOQUES.size:
+                    break
+                primero, cantidad = RANGO_BLOQUES.unpack_from(buffer, posicion + 1)
+                posicion += 1 + RANGO_BLOQUES.size
+                self._copiar_bloques(primero, cantidad)
+                continue
+            if tipo not in (INSTRUCCION_LITERAL, INSTRUCCION_CABECERA):
+                raise ValueError(f"Instruccion de delta desconocida: {tipo!r}")
+            if len(buffer) - posicion < 1 + LARGO.size:
+                break
+            (largo,) = LARGO.unpack_from(buffer, posicion + 1)
+            if largo > LITERAL_MAXIMO + 64 * 1024:
+                raise ValueError("Instruccion de delta demasiado grande")
+            fin = posicion + 1 + LARGO.size + largo
+            if len(buffer) < fin:
+                break
+            datos = bytes(buffer[posicion + 1 + LARGO.size:fin])
+            posicion = fin
+            if tipo == INSTRUCCION_CABECERA:
+                self._leer_cabecera(datos)
+            elif self.cabecera is None:
+                raise ValueError("El delta no empieza con la cabecera")
+            else:
+                self._escribir(datos)
+        del buffer[:posicion]
+
+    def _leer_cabecera(self, datos):
+        cabecera = {}
+        for linea in datos.decode("utf-8").splitlines():
+            clave, _, valor = linea.partition("=")
+            cabecera[clave] = valor
+        if self.base is None or cabecera.get("etag") != self.etag_base:
+            raise ValueError("El archivo ya no esta o cambio en el servidor desde que se pidieron las firmas")
+        cabecera["bloque"] = int(cabecera["bloque"])
+        cabecera["tamano"] = int(cabecera["tamano"])
+        self.cabecera = cabecera
+
+    def _copiar_bloques(self, primero, cantidad):
+        if self.cabecera is None:
+            raise ValueError("El delta no empieza con la cabecera")
+        bloque = self.cabecera["bloque"]
+        self.base.seek(primero * bloque)
+        faltan = cantidad * bloque
+        while faltan:
+            datos = self.base.read(min(faltan, LITERAL_MAXIMO))
+            if not datos:
+                break  # el ultimo bloque de la base es mas corto
+            self._escribir(datos)
+            self.copiados += len(datos)
+            faltan -= len(datos)
+
+    def terminar(self):
+        """Verifica que el resultado sea exactamente el archivo del cliente"""
+        if self.error is not None:
+            raise self.error
+        if self.cabecera is None or self._buffer:
+            raise ValueError("Delta incompleto")
+        if self.escritos != self.cabecera["tamano"] or self.suma.hexdigest() != self.cabecera["sha256"]:
+            raise ValueError("El archivo reconstruido no coincide con el del cliente")
@@ -1,12 +1,20 @@
+import argparse
+import json
 import os
 import time
 import threading
-import shutil
 import logging
 import sys
 import platform
 import queue
 
+import almacen
+import bitacora
+import directorios
+import procesamiento
+import registro
+import vigilante
+
 # Aca ponemos donde van a estar los archivos (en tu carpeta personal)
 BASE_DIR = os.path.expanduser("~/servidor_archivos")
 
@@ -14,12 +22,24 @@ BASE_DIR = os.path.expanduser("~/servidor_archivos")
 DIR_ENTRADA = os.path.join(BASE_DIR, 'entrada')
 DIR_PROCESADOS = os.path.join(BASE_DIR, 'procesados')
 DIR_LOGS = os.path.join(BASE_DIR, 'logs')
+# Aca van los archivos k no pasan la validacion
+DIR_RECHAZADOS = os.path.join(BASE_DIR, 'rechazados')
+# Aca las etapas dejan los archivos a medio transformar (mismo disco k procesados, pa poder usar os.replace)
+DIR_TRABAJO = os.path.join(BASE_DIR, 'temporales')
+# Blobs del almacen por contenido (el mismo k usa el servidor con --deduplicar)
+DIR_BLOBS = os.path.join(BASE_DIR, 'blobs')
 
 # Esto crea las carpetas si no existen todavia
-for directorio in [DIR_ENTRADA, DIR_PROCESADOS, DIR_LOGS]:
+for directorio in [DIR_ENTRADA, DIR_PROCESADOS, DIR_LOGS, DIR_RECHAZADOS, DIR_TRABAJO]:
     if not os.path.exists(directorio):
         os.makedirs(directorio)
 
+# Entrada y procesados pueden estar repartidos en subcarpetas (ver directorios.py),
+# asi k las rutas de los archivos se piden a estos objetos y no se arman a mano
+entrada = directorios.Directorio(DIR_ENTRADA)
+procesados = directorios.Directorio(DIR_PROCESADOS)
+rechazados = directorios.Directorio(DIR_RECHAZADOS)
+
 # Asi guardamos los errores y cosas importantes
 logging.basicConfig(
     filename=os.path.join(DIR_LOGS, 'demonio.log'),
@@ -37,58 +57,160 @@ cola_archivos = queue.Queue()
 archivos_en_proceso = set()
 archivos_en_proceso_lock = threading.Lock()
 
-# Esta funcion escribe en el log lo k pasa
+# Nombres en procesados k ya eligio alguien pero todavia no llego el archivo
+destinos_reservados = set()
+
+# La cola tambien se anota en disco (encolado, iniciado, moviendo, completado) pa k si el demonio
+# se cae sepa al volver k quedo a medias. Se abre en monitorear_directorio, no al importar,
+# porque los procesos de las etapas tambien importan este archivo
+RUTA_BITACORA = os.path.join(DIR_LOGS, 'cola.bitacora')
+bitacora_cola = None
+
+# Cada tanto dejamos en este archivo como va la cola, pa k el servidor lo muestre en STATS
+RUTA_ESTADO = os.path.join(DIR_LOGS, 'demonio.estado')
+INTERVALO_ESTADO = 5
+# Cuantos archivos terminaron (bien o mal) desde k arranco el demonio
+archivos_completados = 0
+
+def anotar(estado, archivo, destino=None, inodo=None):
+    if bitacora_cola is None:
+        return None
+    return bitacora_cola.anotar(estado, archivo, destino, inodo)
+
+# El registro.log es el mismo k usa el servidor, lo escribe un hilo aparte en lotes
+registro_log = registro.RegistroAsincrono(
+    os.path.join(DIR_LOGS, "registro.log"),
+    intervalo=0.05,
+    durabilidad=registro.DURABILIDAD_FLUSH,
+)
+
+# Esta funcion escribe en el log lo k pasa (sin esperar al disco)
 def registrar_operacion(mensaje):
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    registro_log.registrar(f"[{timestamp}] {mensaje}\n")
+    logging.info(mensaje)
+
+# Por defecto ninguna etapa: el archivo pasa a procesados con un os.replace, sin leerlo.
+# validar, suma, convertir y comprimir hay k pedirlas con --etapas
+ETAPAS_POR_DEFECTO = ""
+
+# El pipeline se arma en monitorear_directorio con las etapas elegidas
+pipeline = None
+
+# Con --deduplicar los archivos de procesados son enlaces a blobs por contenido
+almacen_procesados = None
+
+# Le busca un nombre libre en una carpeta (si ya existe le pone la fecha pa k sea unico)
+def nombre_libre(directorio, nombre):
+    destino = directorio.ruta(nombre)
+    if directorio.existe(nombre) or destino in destinos_reservados:
+        nombre_base, extension = os.path.splitext(nombre)
+        timestamp = time.strftime("%Y%m%d%H%M%S")
+        nuevo_nombre = f"{nombre_base}_{timestamp}{extension}"
+        mensaje = f"El archivo {nombre} ya existe en {os.path.basename(directorio.raiz)}, renombrando a {nuevo_nombre}"
+        registrar_operacion(mensaje)
+        print(mensaje)
+        destino = directorio.ruta(nuevo_nombre)
+    return destino
+
+# Ultimo paso del pipeline: deja el resultado en procesados y saca el original de entrada
+def mover_a_procesados(tarea):
+    # Si mientras tanto se repartio entrada en subcarpetas, el original ya no esta donde empezo
+    origen = entrada.buscar(tarea.archivo) or tarea.original
+    if tarea.ruta == tarea.original:
+        tarea.ruta = tarea.original = origen
+    suma = None
+    if almacen_procesados:
+        # La suma de la etapa suma sirve si ninguna etapa cambio el archivo
+        suma = tarea.info.get("sha256") if tarea.ruta == tarea.original else None
+        suma = suma or almacen_procesados.suma_de(tarea.ruta)
+    # Aqui usamos el lock solo para elegir el nombre, lo reservamos y lo soltamos
     with archivo_lock:
-        log_path = os.path.join(DIR_LOGS, "registro.log")
-        with open(log_path, "a", encoding='utf-8') as log_file:
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
-            log_file.write(f"[{timestamp}] {mensaje}\n")
-            logging.info(mensaje)
+        if not os.path.exists(tarea.ruta):  # Verificamos de nuevo dentro del lock
+            raise FileNotFoundError(f"El archivo {tarea.archivo} ya no existe en la carpeta de entrada")
+        existente = procesados.buscar(tarea.nombre)
+        # Si en procesados ya esta este mismo contenido con este nombre no hace falta otra copia con fecha
+        repetido = suma is not None and existente is not None and almacen_procesados.contiene(existente, suma)
+        destino = existente if repetido else nombre_libre(procesados, tarea.nombre)
+        if not repetido:
+            destinos_reservados.add(destino)
+    try:
+        # Antes del rename dejamos en disco a donde va, pa k si nos caemos justo aca al volver
+        # sepamos k ya se movio y no lo procesemos de nuevo (quedaria duplicado con fecha)
+        # Esto espera el fsync fuera del lock, asi los movimientos de varios hilos comparten fsync
+        inodo = os.stat(origen).st_ino if os.path.exists(origen) else None
+        numero = anotar(bitacora.MOVIENDO, tarea.archivo, destino, inodo)
+        if numero is not None and not bitacora_cola.esperar(numero):
+            # Sin la linea en disco una caida despues del rename lo procesaria de nuevo: se queda en entrada
+            raise OSError(f"No se pudo anotar en la bitacora el movimiento de {tarea.archivo}, queda en entrada")
+        if repetido:
+            os.remove(tarea.ruta)
+        elif almacen_procesados:
+            # Si el contenido es nuevo el archivo pasa a ser el blob, si no se enlaza al k ya estaba
+            almacen_procesados.guardar(tarea.ruta, destino, suma)
+        else:
+            # Mismo disco: os.replace es un rename, no se copian los datos
+            os.replace(tarea.ruta, destino)
+        if tarea.ruta != origen and os.path.exists(origen):
+            os.remove(origen)
+    finally:
+        with archivo_lock:
+            destinos_reservados.discard(destino)
+    if repetido:
+        mensaje = f"Archivo {tarea.archivo} ya estaba en procesados con el mismo contenido, no se duplica"
+        registrar_operacion(mensaje)
+        print(mensaje)
+        return
+    detalles = ", ".join(f"{clave}={valor}" for clave, valor in tarea.info.items())
+    mensaje = f"Archivo {tarea.archivo} procesado exitosamente" + (f" ({detalles})" if detalles else "")
+    registrar_operacion(mensaje)
+    print(mensaje)
+
+# Si una etapa falla: los invalidos van a rechazados, el resto se queda en entrada
+def rechazar_archivo(tarea, error):
+    if isinstance(error, procesamiento.ErrorValidacion) and os.path.exists(tarea.original):
+        with archivo_lock:
+            destino = nombre_libre(rechazados, tarea.archivo)
+            os.replace(tarea.original, destino)
+        mensaje = f"Archivo {tarea.archivo} rechazado: {str(error)}"
+        registrar_operacion(mensaje)
+        logging.warning(mensaje)
+        print(mensaje)
+        return
+    error = f"Error al procesar el archivo {tarea.archivo}: {str(error)}"
+    registrar_operacion(error)
+    logging.error(error)
+    print(f"ERROR: {error}")
 
-# Esta funcion mueve los archivo de entrada a prosesados
+# Esta funcion pasa un archivo de entrada por el pipeline y espera a k termine
 def procesar_archivo(archivo):
+    global archivos_completados
     try:
-        origen = os.path.join(DIR_ENTRADA, archivo)
-        destino = os.path.join(DIR_PROCESADOS, archivo)
-        
+        origen = entrada.buscar(archivo)
+
         # Verificamos si el archivo existe antes de procesar
-        if not os.path.exists(origen):
+        anotar(bitacora.INICIADO, archivo)
+        if origen is None:
             mensaje = f"El archivo {archivo} ya no existe en la carpeta de entrada"
             registrar_operacion(mensaje)
             logging.warning(mensaje)
             print(mensaje)
             return
-            
-        # Vemos si ya hay un archivo con el mismo nombre en destino
-        if os.path.exists(destino):
-            # Si ya existe, le ponemos la fecha al nombre para k sea unico
-            nombre_base, extension = os.path.splitext(archivo)
-            timestamp = time.strftime("%Y%m%d%H%M%S")
-            nuevo_nombre = f"{nombre_base}_{timestamp}{extension}"
-            destino = os.path.join(DIR_PROCESADOS, nuevo_nombre)
-            mensaje = f"El archivo {archivo} ya existe en procesados, renombrando a {nuevo_nombre}"
-            registrar_operacion(mensaje)
-            print(mensaje)
-        
-        # Copiamos el archivo y borramos el orijinal
-        # Aqui usamos el lock solo para la operacion critica
-        with archivo_lock:
-            if os.path.exists(origen):  # Verificamos de nuevo dentro del lock
-                shutil.copy2(origen, destino)
-                os.remove(origen)
-                mensaje = f"Archivo {archivo} procesado exitosamente"
-                registrar_operacion(mensaje)
-                print(mensaje)
-        
+
+        # Los errores ya los registro rechazar_archivo
+        pipeline.procesar(archivo, origen).exception()
+
     except Exception as e:
         error = f"Error al procesar el archivo {archivo}: {str(e)}"
         registrar_operacion(error)
         logging.error(error)
         print(f"ERROR: {error}")
     finally:
+        # Si salio bien o mal da igual: este intento ya termino (si quedo en entrada se vuelve a encontrar)
+        anotar(bitacora.COMPLETADO, archivo)
         # Removemos el archivo de la lista de archivos en proceso
         with archivos_en_proceso_lock:
+            archivos_completados += 1
             if archivo in archivos_en_proceso:
                 archivos_en_proceso.remove(archivo)
 
@@ -112,8 +234,74 @@ def worker_procesar_archivos():
             logging.error(error)
             print(f"ERROR EN WORKER: {error}")
 
-# Esta es la funcion principal k revisa cada 10 segundos si hay archivos
-def monitorear_directorio():
+# Escribe cada INTERVALO_ESTADO segundos el tamano de la cola y a k ritmo se esta procesando
+def escribir_estado():
+    anteriores, antes = 0, time.monotonic()
+    while True:
+        time.sleep(INTERVALO_ESTADO)
+        try:
+            with archivos_en_proceso_lock:
+                completados = archivos_completados
+                en_proceso = len(archivos_en_proceso)
+            en_cola = cola_archivos.qsize()
+            ahora = time.monotonic()
+            estado = {"pid": os.getpid(), "actualizado": time.time(), "en_cola": en_cola,
+                      "procesando": max(0, en_proceso - en_cola), "completados": completados,
+                      "por_segundo": round((completados - anteriores) / (ahora - antes), 3)}
+            with pipeline.mutex:
+                for etapa, cantidad in pipeline.procesados.items():
+                    estado[f"etapa_{etapa}"] = cantidad
+            anteriores, antes = completados, ahora
+            # Se escribe aparte y se renombra, asi el servidor nunca lee un archivo a medias
+            temporal = RUTA_ESTADO + ".tmp"
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(estado, f)
+            os.replace(temporal, RUTA_ESTADO)
+        except Exception as e:
+            logging.error(f"Error al escribir el estado del demonio: {str(e)}")
+
+# Retoma los archivos k la bitacora dice k no terminaron la ultima vez
+def reanudar_pendientes():
+    reanudados = []
+    for archivo, (estado, destino, inodo) in bitacora_cola.pendientes().items():
+        origen = entrada.buscar(archivo) or entrada.ruta(archivo)
+        try:
+            inodo_origen = os.stat(origen).st_ino
+        except FileNotFoundError:
+            inodo_origen = None
+        if destino and not os.path.exists(destino):
+            # Pudo haberse movido a su subcarpeta al repartir procesados
+            destino = procesados.buscar(os.path.basename(destino)) or destino
+        if estado == bitacora.MOVIENDO and destino and os.path.exists(destino):
+            # El rename alcanzo a hacerse. Si el original sigue (etapas k transforman) es lo unico k falta
+            if inodo_origen is not None and inodo_origen == inodo and not os.path.samefile(origen, destino):
+                os.remove(origen)
+            mensaje = f"Archivo {archivo} ya estaba en procesados como {os.path.basename(destino)}"
+            registrar_operacion(mensaje)
+            print(mensaje)
+            anotar(bitacora.COMPLETADO, archivo)
+        elif inodo_origen is not None:
+            reanudados.append(archivo)
+        else:
+            anotar(bitacora.COMPLETADO, archivo)
+
+    if reanudados:
+        with archivos_en_proceso_lock:
+            archivos_en_proceso.update(reanudados)
+        mensaje = f"Retomando {len(reanudados)} archivos k quedaron a medias: {', '.join(reanudados)}"
+        print(mensaje)
+        registrar_operacion(mensaje)
+        for archivo in reanudados:
+            cola_archivos.put(archivo)
+
+# Cada cuanto se revisa la carpeta cuando no hay inotify
+INTERVALO_SONDEO = 10
+# Eventos del mismo archivo k llegan mas juntos k esto se cuentan como uno solo
+VENTANA_EVENTOS = 0.05
+
+# Esta es la funcion principal k espera archivos nuevos en la carpeta de entrada
+def monitorear_directorio(etapas=None, deduplicar=False):
+    global pipeline, bitacora_cola, almacen_procesados
     print(f"Iniciando monitoreo del directorio {DIR_ENTRADA}...")
     registrar_operacion(f"Demonio de monitoreo iniciado en {platform.system()}")
     print(f"Sistema operativo detectado: {platform.system()}")
@@ -124,17 +312,44 @@ def monitorear_directorio():
         with open(log_path, "w", encoding='utf-8') as log_file:
             log_file.write("# Registro de operaciones del servidor de archivos\n")
 
-    # Creamos los workers (hilos que procesan la cola)
-    num_workers = 3  # Podemos usar varios trabajadores
+    # Armamos el pipeline: las etapas de CPU corren en procesos aparte y las de disco en hilos
+    if etapas is None:
+        etapas = procesamiento.parsear_etapas(ETAPAS_POR_DEFECTO)
+    pipeline = procesamiento.Pipeline(etapas, DIR_TRABAJO, mover_a_procesados, rechazar_archivo)
+    mensaje = f"Etapas de procesamiento: {', '.join(map(repr, etapas)) or 'ninguna'}"
+    print(mensaje)
+    registrar_operacion(mensaje)
+
+    if deduplicar:
+        almacen_procesados = almacen.AlmacenContenido(DIR_BLOBS)
+        registrar_operacion(f"Almacen por contenido activado en {DIR_BLOBS}")
+
+    # Leemos la bitacora y retomamos lo k quedo a medias antes de mirar la carpeta
+    bitacora_cola = bitacora.Bitacora(RUTA_BITACORA)
+    borrados = procesamiento.limpiar_intermedios(DIR_TRABAJO)
+    if borrados:
+        registrar_operacion(f"Se borraron {borrados} archivos intermedios de una ejecucion anterior")
+    reanudar_pendientes()
+
+    # Creamos los workers (hilos que sacan de la cola y esperan al pipeline)
+    # Cada uno tiene un archivo en vuelo, asi k tienen k ser mas k los trabajadores de las etapas
+    num_workers = max(3, 2 * max([etapa.trabajadores for etapa in etapas] + [1]))
     for _ in range(num_workers):
         worker = threading.Thread(target=worker_procesar_archivos, daemon=True)
         worker.start()
+    threading.Thread(target=escribir_estado, name="estado", daemon=True).start()
     
+    # En Linux nos avisa el kernel (inotify) apenas llega un archivo, si no revisamos cada 10 segundos
+    vigia = vigilante.crear_vigilante(entrada, INTERVALO_SONDEO, VENTANA_EVENTOS)
+    mensaje = f"Vigilando {entrada} con {vigia.tipo}"
+    print(mensaje)
+    registrar_operacion(mensaje)
+
     # Este es el bucle principal k nunca termina
     while True:
         try:
-            # Buscamos archivos nuevos en la carpeta
-            archivos = [f for f in os.listdir(DIR_ENTRADA) if os.path.isfile(os.path.join(DIR_ENTRADA, f))]
+            # Esperamos hasta k haya archivos (los eventos seguidos del mismo archivo ya vienen juntos)
+            archivos = vigia.esperar()
             
             # Filtramos para procesar solo archivos nuevos (que no esten ya en proceso)
             with archivos_en_proceso_lock:
@@ -152,29 +367,48 @@ def monitorear_directorio():
                 
                 # Agregamos los archivos nuevos a la cola
                 for archivo in archivos_nuevos:
+                    anotar(bitacora.ENCOLADO, archivo)
                     cola_archivos.put(archivo)
             
             # Si no hay nada lo decimos
             if not archivos:
                 print("No hay archivos nuevos para procesar. Esperando...")
             
-            # Esperamos un ratito antes de revisar otra vez
-            time.sleep(10)
-            
         except Exception as e:
             error = f"Error durante el monitoreo: {str(e)}"
             registrar_operacion(error)
             logging.error(error)
             print(f"ERROR EN MONITOREO: {error}")
-            time.sleep(10)
+            time.sleep(INTERVALO_SONDEO)
 
 # Esto es lo k se ejecuta cuando arrancas el programa
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Demonio k procesa los archivos de la carpeta de entrada")
+    parser.add_argument("--etapas", default=ETAPAS_POR_DEFECTO,
+                        help=f"etapas separadas por coma, en orden ({', '.join(procesamiento.ETAPAS)})")
+    parser.add_argument("--trabajadores", default="",
+                        help="trabajadores por etapa, ej: suma=4,comprimir=2 (por defecto: un proceso por nucleo)")
+    parser.add_argument("--tamano-maximo", type=int, default=None,
+                        help="bytes maximos k acepta la etapa validar")
+    parser.add_argument("--verificar-hasta", type=int, default=procesamiento.TAMANO_VERIFICAR,
+                        help="la etapa validar revisa el contenido de los .json y .gz solo hasta estos bytes")
+    parser.add_argument("--deduplicar", action="store_true",
+                        help="guardar procesados por contenido (igual k el servidor con --deduplicar)")
+    args = parser.parse_args()
+    try:
+        etapas = procesamiento.parsear_etapas(args.etapas, args.trabajadores)
+    except ValueError as e:
+        parser.error(str(e))
+    for etapa in etapas:
+        if etapa.nombre == "validar":
+            etapa.opciones["tamano_maximo"] = args.tamano_maximo
+            etapa.opciones["tamano_verificar"] = args.verificar_hasta
+
     try:
         print(f"Iniciando demonio en {BASE_DIR}")
         print(f"Sistema operativo: {platform.system()}")
         # Empezamos el programa
-        monitorear_directorio()
+        monitorear_directorio(etapas, args.deduplicar)
     except KeyboardInterrupt:
         mensaje = "Demonio de monitoreo detenido manualmente"
         registrar_operacion(mensaje)
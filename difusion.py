@@ -0,0 +1,274 @@
+import selectors
+import socket
+import threading
+import time
+
+import compresion
+import protocolo
+
+# Respuestas que siguen abiertas mientras el cliente no corte (LOGS con
+# seguir=1 y VIGILAR). Pasan casi todo el tiempo esperando algo nuevo, asi que no
+# ocupan un hilo del pool: el hilo que atiende el comando solo arma el Flujo
+# y un unico hilo, el Difusor, se queda con los sockets de todos. Saca
+# bloques de cada generador, los envia sin bloquear y, cuando el flujo
+# termina, devuelve la conexion al pool para el proximo comando. El servidor
+# asyncio hace lo mismo desde el event loop (ver servidor_async.py).
+
+# Seguimientos abiertos a la vez como maximo, entre todos los clientes
+MAXIMO = 1024
+# Bytes de tramas que se preparan por conexion antes de esperar a que el
+# socket los acepte: a un cliente lento no se le piden mas bloques
+LIMITE_SALIDA = 256 * 1024
+# Lo que se lee de una vez de un cliente que manda algo durante el flujo
+BLOQUE_LECTURA = 4096
+
+
+class Seguimiento:
+    """Respuesta de un manejador que sigue abierta.
+
+    bloques es un generador de bytes que entrega None cuando por ahora no
+    hay nada nuevo.
+    """
+
+    def __init__(self, bloques):
+        self.bloques = bloques
+
+
+class Cupo:
+    """Cuantos seguimientos hay abiertos, hasta `maximo`"""
+
+    def __init__(self, maximo=MAXIMO):
+        self.maximo = maximo
+        self.mutex = threading.Lock()
+        self.activos = 0
+        self.rechazados = 0
+
+    def tomar(self):
+        """Ocupa un lugar; False si ya no queda ninguno"""
+        with self.mutex:
+            if self.activos >= self.maximo:
+                self.rechazados += 1
+                return False
+            self.activos += 1
+            return True
+
+    def soltar(self):
+        with self.mutex:
+            self.activos -= 1
+
+    def estadisticas(self):
+        with self.mutex:
+            return {"activos": self.activos, "maximo": self.maximo, "rechazados": self.rechazados}
+
+
+class Flujo:
+    """Las tramas de un Seguimiento para una conexion.
+
+    Igual que Conexion.enviar_flujo: OP_DATOS (comprimidas y vaciadas si se
+    negocio compresion) y OP_FIN al final, pero en lugar de enviarlas las
+    deja en salida para que otro las mande sin bloquear.
+    """
+
+    def __init__(self, conexion, direccion, bloques, cupo):
+        self.conexion = conexion
+        self.direccion = direccion
+        self.bloques = bloques
+        self.cupo = cupo
+        self.compresor = compresion.Compresor(*conexion.compresion) if conexion.compresion else None
+        self.salida = bytearray()
+        self.terminado = False
+        # True si termino porque el cliente mando una trama (queda por leer)
+        self.cancelado = False
+        self.ultimo_envio = time.monotonic()
+        self.mascara = 0
+
+    def producir(self, limite=LIMITE_SALIDA):
+        """Pasa a salida los bloques que haya, hasta `limite` bytes.
+
+        Devuelve True si el generador entrego algo (False si por ahora no
+        hay nada nuevo).
+        """
+        nuevos = False
+        while not self.terminado and len(self.salida) < limite:
+            try:
+                bloque = next(self.bloques)
+            except StopIteration:
+                self.terminar()
+                return True
+            if bloque is None:
+                break
+            nuevos = True
+            if bloque and self.compresor is not None:
+                self.salida += self.conexion.trama(protocolo.OP_DATOS,
+                                                   payload=self.compresor.comprimir(bloque) + self.compresor.vaciar(),
+                                                   flags=protocolo.FLAG_COMPRIMIDO)
+            elif bloque:
+                self.salida += self.conexion.trama(protocolo.OP_DATOS, payload=bloque)
+        return nuevos
+
+    def terminar(self, cancelado=False):
+        """Cierra el generador y agrega a salida el final del flujo"""
+        if self.terminado:
+            return
+        self.terminado = True
+        self.cancelado = cancelado
+        self.cerrar()
+        if self.compresor is not None:
+            self.salida += self.conexion.trama(protocolo.OP_DATOS, payload=self.compresor.terminar(),
+                                               flags=protocolo.FLAG_COMPRIMIDO)
+        self.salida += self.conexion.trama(protocolo.OP_FIN)
+
+    def enviado(self, cantidad):
+        del self.salida[:cantidad]
+        self.conexion.bytes_enviados += cantidad
+        self.ultimo_envio = time.monotonic()
+
+    def cerrar(self):
+        """Cierra el generador y libera el lugar en el cupo (una sola vez)"""
+        if self.cupo is not None:
+            self.cupo.soltar()
+            self.cupo = None
+            self.bloques.close()
+
+
+class Difusor:
+    """Un hilo que envia los flujos de todas las conexiones del pool.
+
+    Los sockets pasan a modo no bloqueante y se esperan todos juntos con
+    selectors. Cuando un flujo termina la conexion se pasa a
+    devolver(conexion, direccion, cancelado) para que siga atendiendo
+    comandos; si el cliente cerro, fallo el generador o el cliente no lee
+    nada en `timeout` segundos se pasa a cerrar(conexion, direccion). El
+    hilo arranca con el primer flujo (en el modo procesos, en cada
+    trabajador).
+    """
+
+    def __init__(self, intervalo, timeout, cerrar, registrar):
+        self.intervalo = intervalo
+        self.timeout = timeout
+        self.cerrar = cerrar
+        self.registrar = registrar
+        self.devolver = None
+        self.mutex = threading.Lock()
+        self.nuevos = []
+        self.flujos = set()
+        self.cortados = 0
+        self.selector = None
+        self._aviso = None
+        self._avisado = False
+
+    def agregar(self, flujo):
+        with self.mutex:
+            if self.selector is None:
+                self._iniciar()
+            self.nuevos.append(flujo)
+        self.despertar()
+
+    def _iniciar(self):
+        self.selector = selectors.DefaultSelector()
+        lectura, self._aviso = socket.socketpair()
+        lectura.setblocking(False)
+        self._aviso.setblocking(False)
+        self.selector.register(lectura, selectors.EVENT_READ)
+        threading.Thread(target=self._ejecutar, name="difusor", daemon=True).start()
+
+    def despertar(self):
+        """Hace que el hilo revise los generadores ya, sin esperar al intervalo"""
+        if self._aviso is None or self._avisado:
+            return
+        self._avisado = True
+        try:
+            self._aviso.send(b"\0")
+        except OSError:
+            pass
+
+    def _ejecutar(self):
+        espera = self.intervalo
+        while True:
+            for clave, _ in self.selector.select(espera):
+                if clave.data is None:
+                    # Primero se baja la marca y despues se vacia el aviso:
+                    # lo que se publique mientras tanto vuelve a despertar
+                    self._avisado = False
+                    try:
+                        while clave.fileobj.recv(BLOQUE_LECTURA):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif clave.data in self.flujos and clave.data.mascara & selectors.EVENT_READ:
+                    self._leer(clave.data)
+            with self.mutex:
+                nuevos, self.nuevos = self.nuevos, []
+            for flujo in nuevos:
+                flujo.conexion.sock.setblocking(False)
+                flujo.ultimo_envio = time.monotonic()
+                flujo.mascara = selectors.EVENT_READ
+                self.selector.register(flujo.conexion.sock, flujo.mascara, flujo)
+                self.flujos.add(flujo)
+            # Si algun generador todavia tenia bloques no se espera al intervalo
+            espera = self.intervalo
+            for flujo in list(self.flujos):
+                if self._avanzar(flujo):
+                    espera = 0
+
+    def _leer(self, flujo):
+        """El cliente mando algo: si cerro se descarta, si no se corta el flujo"""
+        try:
+            datos = flujo.conexion.sock.recv(BLOQUE_LECTURA)
+        except BlockingIOError:
+            return
+        except OSError:
+            datos = b""
+        if not datos:
+            self._descartar(flujo)
+            return
+        flujo.conexion.bytes_recibidos += len(datos)
+        flujo.conexion.devolver(datos)
+        flujo.terminar(cancelado=True)
+
+    def _avanzar(self, flujo):
+        """Produce y envia lo que se pueda; True si el generador entrego algo"""
+        nuevos = False
+        try:
+            nuevos = flujo.producir()
+            if flujo.salida:
+                flujo.enviado(flujo.conexion.sock.send(flujo.salida))
+        except BlockingIOError:
+            pass
+        except Exception as e:
+            self._descartar(flujo, f"Error en el seguimiento de {flujo.direccion}: {str(e)}")
+            return False
+        if flujo.salida and time.monotonic() - flujo.ultimo_envio > self.timeout:
+            self.cortados += 1
+            self._descartar(flujo, f"Seguimiento cortado: {flujo.direccion} no lee hace {self.timeout} segundos")
+            return False
+        if flujo.terminado and not flujo.salida:
+            self._soltar(flujo)
+            if self.devolver is not None:
+                self.devolver(flujo.conexion, flujo.direccion, flujo.cancelado)
+            else:
+                self.cerrar(flujo.conexion, flujo.direccion)
+            return False
+        # Se deja de leer al terminar: lo que mande el cliente despues es su
+        # proximo comando y lo lee el hilo del pool
+        mascara = (0 if flujo.terminado else selectors.EVENT_READ) | (selectors.EVENT_WRITE if flujo.salida else 0)
+        if mascara != flujo.mascara:
+            flujo.mascara = mascara
+            self.selector.modify(flujo.conexion.sock, mascara, flujo)
+        # Con la salida llena no hace falta volver enseguida: avisa el selector
+        return nuevos and len(flujo.salida) < LIMITE_SALIDA
+
+    def _soltar(self, flujo):
+        self.flujos.discard(flujo)
+        self.selector.unregister(flujo.conexion.sock)
+        flujo.cerrar()
+        flujo.conexion.sock.setblocking(True)
+
+    def _descartar(self, flujo, motivo=None):
+        self._soltar(flujo)
+        if motivo:
+            self.registrar(motivo)
+        self.cerrar(flujo.conexion, flujo.direccion)
+
+    def estadisticas(self):
+        return {"en_difusor": len(self.flujos), "cortados": self.cortados}
@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+
+# Disposicion en disco de entrada y procesados.
+#
+# Un directorio puede ser plano (todos los archivos juntos, como siempre) o
+# repartido: cada archivo va a una subcarpeta que sale de un hash de su
+# nombre (entrada/3f/informe.txt), asi ninguna carpeta pasa de unos miles de
+# archivos aunque haya millones. Los clientes siguen viendo un solo espacio
+# de nombres plano.
+#
+# El reparto se anota en un archivo MARCA en la raiz del directorio. Servidor
+# y demonio son procesos aparte y lo vuelven a revisar cada
+# INTERVALO_REVISION segundos, asi repartir() puede correr con todo andando:
+# mientras dura, un archivo puede seguir en la raiz, y por eso las busquedas
+# miran la subcarpeta, despues la raiz y de nuevo la subcarpeta (un archivo
+# que se mueve entre las dos primeras miradas aparece en la tercera).
+
+MARCA = ".reparto"
+# Subcarpetas posibles: 1, 2 o 3 digitos hexadecimales
+ABANICOS = (16, 256, 4096)
+ABANICO_POR_DEFECTO = 256
+INTERVALO_REVISION = 1.0
+# Cuanto espera repartir() entre anotar el reparto y mover el primer archivo,
+# para que todos los procesos ya escriban en las subcarpetas
+ESPERA_MIGRACION = 3 * INTERVALO_REVISION
+BASE_DIR = os.path.expanduser("~/servidor_archivos")
+
+
+def es_interno(nombre):
+    """Archivos de la raiz que no son del usuario (la marca de reparto)"""
+    return nombre == MARCA or nombre == MARCA + ".tmp"
+
+
+def carpeta_de(nombre, abanico):
+    """Subcarpeta de un nombre; crc32 para que de lo mismo en todos los procesos"""
+    digitos = len(f"{abanico - 1:x}")
+    return f"{zlib.crc32(nombre.encode('utf-8', 'surrogateescape')) & (abanico - 1):0{digitos}x}"
+
+
+class Directorio:
+    """Un directorio de archivos (entrada, procesados...), plano o repartido en subcarpetas.
+
+    clave(nombre) es la ruta logica del archivo (la que tendria en un
+    directorio plano), la que se usa para los locks; ruta(nombre) es donde se
+    escribe y rutas(nombre) donde puede estar al leerlo.
+    """
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+        self.abanico = None
+        self._firma_marca = None
+        self._revisado = None
+        self.revisar(forzar=True)
+
+    def revisar(self, forzar=False):
+        """Vuelve a leer la marca de reparto si paso INTERVALO_REVISION desde la ultima vez"""
+        ahora = time.monotonic()
+        if not forzar and self._revisado is not None and ahora - self._revisado < INTERVALO_REVISION:
+            return
+        self._revisado = ahora
+        ruta_marca = os.path.join(self.raiz, MARCA)
+        try:
+            estado = os.stat(ruta_marca)
+            firma = (estado.st_ino, estado.st_mtime_ns)
+            if firma == self._firma_marca:
+                return
+            with open(ruta_marca, encoding="utf-8") as f:
+                abanico = json.load(f)["abanico"]
+        except FileNotFoundError:
+            self.abanico = self._firma_marca = None
+            return
+        if abanico not in ABANICOS:
+            raise ValueError(f"Reparto invalido en {ruta_marca}: abanico {abanico}")
+        self.abanico, self._firma_marca = abanico, firma
+
+    @property
+    def repartido(self):
+        self.revisar()
+        return self.abanico is not None
+
+    def clave(self, nombre):
+        return os.path.join(self.raiz, nombre)
+
+    def ruta(self, nombre):
+        """Donde se escribe un archivo nuevo con este nombre"""
+        if not self.repartido:
+            return os.path.join(self.raiz, nombre)
+        return os.path.join(self.raiz, carpeta_de(nombre, self.abanico), nombre)
+
+    def rutas(self, nombre):
+        """Donde puede estar un archivo, en el orden en que hay que buscarlo"""
+        plana = os.path.join(self.raiz, nombre)
+        if not self.repartido:
+            return (plana,)
+        repartida = os.path.join(self.raiz, carpeta_de(nombre, self.abanico), nombre)
+        return (repartida, plana, repartida)
+
+    def buscar(self, nombre):
+        """Ruta del archivo, o None si no existe"""
+        for ruta in self.rutas(nombre):
+            if os.path.isfile(ruta):
+                return ruta
+        return None
+
+    def existe(self, nombre):
+        return self.buscar(nombre) is not None
+
+    def carpetas(self):
+        """Las carpetas que pueden tener archivos: las subcarpetas y la raiz"""
+        if not self.repartido:
+            return [self.raiz]
+        digitos = len(f"{self.abanico - 1:x}")
+        return [os.path.join(self.raiz, f"{i:0{digitos}x}") for i in range(self.abanico)] + [self.raiz]
+
+    def carpetas_de(self, nombre):
+        """Las carpetas donde puede estar un nombre, la que manda primero"""
+        if not self.repartido:
+            return [self.raiz]
+        return [os.path.join(self.raiz, carpeta_de(nombre, self.abanico)), self.raiz]
+
+    def nombres(self):
+        """Todos los nombres de archivos, sin repetir"""
+        vistos = set()
+        for carpeta in self.carpetas():
+            try:
+                with os.scandir(carpeta) as entradas:
+                    for entrada in entradas:
+                        if (entrada.name not in vistos and not es_interno(entrada.name)
+                                and entrada.is_file(follow_symlinks=False)):
+                            vistos.add(entrada.name)
+            except FileNotFoundError:
+                continue
+        return sorted(vistos)
+
+    def crear(self):
+        for carpeta in self.carpetas():
+            os.makedirs(carpeta, exist_ok=True)
+
+    def __str__(self):
+        return self.raiz if not self.repartido else f"{self.raiz} (repartido en {self.abanico} carpetas)"
+
+
+def _mover_a_subcarpeta(raiz, nombre, abanico):
+    """Devuelve True si movio el archivo"""
+    origen = os.path.join(raiz, nombre)
+    destino = os.path.join(raiz, carpeta_de(nombre, abanico), nombre)
+    # link + remove en lugar de os.replace para no pisar una version de la
+    # subcarpeta: si ya hay una, se escribio despues de anotar el reparto y es
+    # la nueva. Entre medio el archivo esta en los dos lugares, nunca en ninguno
+    try:
+        os.link(origen, destino)
+    except FileNotFoundError:
+        # Otro proceso lo movio o lo borro
+        return False
+    except FileExistsError:
+        pass
+    try:
+        os.remove(origen)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def repartir(raiz, abanico=ABANICO_POR_DEFECTO, espera=ESPERA_MIGRACION, progreso=None):
+    """Pasa un directorio plano a subcarpetas sin detener al servidor ni al demonio.
+
+    Crea las subcarpetas, anota el reparto, espera a que todos los procesos
+    lo vean y mueve los archivos de la raiz. Si se corta se puede volver a
+    correr: sigue con lo que quedo. Devuelve cuantos archivos movio.
+    """
+    if abanico not in ABANICOS:
+        raise ValueError(f"El abanico tiene que ser uno de {', '.join(map(str, ABANICOS))}")
+    os.makedirs(raiz, exist_ok=True)
+    directorio = Directorio(raiz)
+    if directorio.abanico not in (None, abanico):
+        raise ValueError(f"{raiz} ya esta repartido en {directorio.abanico} carpetas")
+    digitos = len(f"{abanico - 1:x}")
+    for i in range(abanico):
+        os.makedirs(os.path.join(raiz, f"{i:0{digitos}x}"), exist_ok=True)
+    if directorio.abanico is None:
+        temporal = os.path.join(raiz, MARCA + ".tmp")
+        with open(temporal, "w", encoding="utf-8") as f:
+            json.dump({"abanico": abanico}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, os.path.join(raiz, MARCA))
+        time.sleep(espera)
+
+    movidos = 0
+    while True:
+        # Se vuelve a mirar hasta que no quede nada: mientras se recorre la
+        # raiz pueden llegar archivos de procesos que todavia no vieron la marca
+        with os.scandir(raiz) as entradas:
+            pendientes = [e.name for e in entradas if e.is_file(follow_symlinks=False) and not es_interno(e.name)]
+        if not pendientes:
+            return movidos
+        for nombre in pendientes:
+            if _mover_a_subcarpeta(raiz, nombre, abanico):
+                movidos += 1
+                if progreso and movidos % 10000 == 0:
+                    progreso(movidos)
+
+
+def estado(raiz):
+    """Cuantos archivos hay en la raiz y en las subcarpetas"""
+    directorio = Directorio(raiz)
+    en_raiz = 0
+    with os.scandir(raiz) as entradas:
+        for entrada in entradas:
+            if entrada.is_file(follow_symlinks=False) and not es_interno(entrada.name):
+                en_raiz += 1
+    en_carpetas = 0
+    if directorio.repartido:
+        for carpeta in directorio.carpetas()[:-1]:
+            try:
+                with os.scandir(carpeta) as entradas:
+                    en_carpetas += sum(1 for e in entradas if e.is_file(follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+    return {"abanico": directorio.abanico, "en_raiz": en_raiz, "en_carpetas": en_carpetas}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Disposicion en disco de entrada y procesados")
+    subcomandos = parser.add_subparsers(dest="subcomando", required=True)
+    por_defecto = [os.path.join(BASE_DIR, "entrada"), os.path.join(BASE_DIR, "procesados")]
+    p = subcomandos.add_parser("repartir", help="pasa directorios planos a subcarpetas (con el servidor andando)")
+    p.add_argument("directorios", nargs="*", default=por_defecto)
+    p.add_argument("--abanico", type=int, default=ABANICO_POR_DEFECTO,
+                   help=f"cantidad de subcarpetas ({', '.join(map(str, ABANICOS))})")
+    p.add_argument("--espera", type=float, default=ESPERA_MIGRACION,
+                   help="segundos entre anotar el reparto y empezar a mover")
+    p = subcomandos.add_parser("estado", help="muestra como esta repartido cada directorio")
+    p.add_argument("directorios", nargs="*", default=por_defecto)
+    args = parser.parse_args()
+
+    for raiz in args.directorios:
+        if args.subcomando == "estado":
+            e = estado(raiz)
+            disposicion = f"repartido en {e['abanico']} carpetas" if e["abanico"] else "plano"
+            print(f"{raiz}: {disposicion}, {e['en_carpetas']} archivos en subcarpetas, {e['en_raiz']} en la raiz")
+            continue
+        try:
+            inicio = time.monotonic()
+            movidos = repartir(raiz, args.abanico, args.espera,
+                               progreso=lambda n: print(f"  {n} archivos movidos...", flush=True))
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"{raiz}: repartido en {args.abanico} carpetas, {movidos} archivos movidos "
+              f"en {time.monotonic() - inicio:.1f} s")
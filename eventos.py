@@ -0,0 +1,182 @@
+import collections
+import datetime
+import fnmatch
+import itertools
+import os
+import threading
+import time
+
+# Cambios de entrada y procesados para los clientes que los siguen (comando
+# VIGILAR), asi no tienen que llamar a LISTAR en un bucle.
+#
+# Los eventos salen de los indices de LISTAR (ver indice_directorio.py): los
+# cambios que hace el servidor (SUBIR, COPIAR) aparecen al instante y los
+# del demonio o de otros procesos cuando el indice se reconcilia con el
+# disco. Cada evento lleva un numero de secuencia y se guarda en un anillo
+# acotado; cada suscriptor lleva su propio cursor y lee del anillo a su
+# ritmo, asi que publicar nunca espera a nadie. Los suscriptores no ocupan
+# un hilo cada uno: sus flujos los envia el difusor (ver difusion.py), al
+# que avisar despierta apenas hay eventos nuevos. Un suscriptor lento solo
+# frena su propia conexion (el socket se llena) y, si se atrasa mas que el
+# anillo, se le avisa y se corta su flujo. La generacion identifica al
+# anillo: cambia al reiniciar el servidor y es distinta en cada trabajador
+# del modo procesos, donde las secuencias no se corresponden.
+
+CAPACIDAD = 10000
+# Eventos que se envian juntos como maximo
+LOTE = 1000
+
+OPCIONES_VALIDAS = ("desde", "generacion", "directorio", "patron")
+
+
+class ErrorEventos(Exception):
+    """Opciones invalidas o eventos que ya no estan en el anillo"""
+
+
+Evento = collections.namedtuple("Evento", "secuencia tiempo tipo directorio nombre tamano")
+
+
+def parsear_opciones(texto, directorios):
+    """Convierte "clave=valor" (una por linea) en un diccionario validado"""
+    opciones = {"desde": None, "generacion": None, "directorio": None, "patron": None}
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        clave, separador, valor = linea.partition("=")
+        clave, valor = clave.strip(), valor.strip()
+        if not separador or clave not in OPCIONES_VALIDAS:
+            raise ErrorEventos(f"Opcion desconocida: {linea}")
+        if clave == "desde":
+            try:
+                valor = int(valor)
+            except ValueError:
+                raise ErrorEventos("desde debe ser un numero")
+            if valor < 0:
+                raise ErrorEventos("desde no puede ser negativo")
+        elif clave == "directorio" and valor not in directorios:
+            raise ErrorEventos(f"Directorio desconocido: {valor}")
+        opciones[clave] = valor
+    return opciones
+
+
+def formatear(evento):
+    """secuencia, tipo, directorio, nombre, tamano y fecha separados por tabuladores"""
+    fecha = datetime.datetime.fromtimestamp(evento.tiempo).strftime('%Y-%m-%d %H:%M:%S')
+    tamano = "" if evento.tamano is None else evento.tamano
+    return (f"{evento.secuencia}\t{evento.tipo}\t{evento.directorio}\t{evento.nombre}\t{tamano}\t{fecha}\n"
+            .encode("utf-8", "surrogateescape"))
+
+
+class AnilloEventos:
+    """Los ultimos `capacidad` eventos, numerados desde 1"""
+
+    def __init__(self, capacidad=CAPACIDAD):
+        self.mutex = threading.Lock()
+        self.anillo = collections.deque(maxlen=capacidad)
+        self.ultimo = 0
+        self.generacion = os.urandom(4).hex()
+        self.suscriptores = 0
+        self.desbordados = 0
+        # Funcion sin argumentos que se llama despues de cada evento (la
+        # del difusor, para que no espere a su proxima vuelta)
+        self.avisar = None
+
+    def publicar(self, tipo, directorio, nombre, tamano=None):
+        with self.mutex:
+            self.ultimo += 1
+            self.anillo.append(Evento(self.ultimo, time.time(), tipo, directorio, nombre, tamano))
+        if self.avisar is not None:
+            self.avisar()
+
+    def observador(self, directorio, tipo_nuevo):
+        """Funcion para IndiceDirectorio(al_modificar=...) que publica sus cambios.
+
+        tipo_nuevo es el tipo de los archivos nuevos que el indice encuentra
+        en el disco sin que el servidor diga por que (los del demonio en
+        procesados, por ejemplo).
+        """
+        def al_modificar(nombre, anterior, actual, motivo):
+            if actual is None:
+                self.publicar("borrado", directorio, nombre)
+            else:
+                tipo = motivo or (tipo_nuevo if anterior is None else "modificado")
+                self.publicar(tipo, directorio, nombre, actual[0])
+        return al_modificar
+
+    def _pendientes(self, cursor):
+        """Eventos posteriores a cursor, o None si ya salieron del anillo"""
+        primero = self.anillo[0].secuencia if self.anillo else self.ultimo + 1
+        if cursor + 1 < primero:
+            return None
+        return list(itertools.islice(self.anillo, cursor + 1 - primero, cursor + 1 - primero + LOTE))
+
+    def validar(self, opciones):
+        """Revisa que se pueda seguir desde opciones["desde"] y devuelve el cursor inicial"""
+        with self.mutex:
+            if opciones["desde"] is None:
+                return self.ultimo
+            if opciones["generacion"] not in (None, self.generacion) or opciones["desde"] > self.ultimo:
+                raise ErrorEventos(f"eventos perdidos: la secuencia {opciones['desde']} no es de este servidor "
+                                   f"(generacion {self.generacion}, ultimo evento {self.ultimo})")
+            if self._pendientes(opciones["desde"]) is None:
+                raise ErrorEventos(f"eventos perdidos: los eventos posteriores a {opciones['desde']} ya no estan "
+                                   f"(el mas antiguo es {self.anillo[0].secuencia}, ultimo evento {self.ultimo})")
+            return opciones["desde"]
+
+    def suscribir(self, cursor, opciones):
+        """Generador de bloques de bytes con los eventos posteriores a cursor.
+
+        Empieza con una linea "# secuencia N generacion G" y sigue mientras
+        el otro extremo lea; si se atrasa mas que el anillo termina con una
+        linea "# desborde ...". Nunca espera: entrega None cuando no hay
+        eventos nuevos (ver difusion.Seguimiento).
+
+        Con filtro, los eventos que no pasan igual mueven el cursor: la
+        linea de secuencia se repite cuando el cliente se quedo atras por
+        ellos (al quedar sin eventos nuevos o cada `salto`), asi al
+        reconectar con desde= no pide eventos que ya salieron del anillo.
+        """
+        with self.mutex:
+            self.suscriptores += 1
+        salto = max(1, min(LOTE, self.anillo.maxlen // 2))
+        informado = cursor
+        try:
+            yield self._linea_secuencia(cursor)
+            while True:
+                with self.mutex:
+                    eventos = self._pendientes(cursor)
+                    if eventos is None:
+                        self.desbordados += 1
+                if eventos is None:
+                    yield (f"# desborde: los eventos posteriores a {cursor} ya no estan, "
+                           f"volver a listar y seguir sin desde\n").encode("utf-8")
+                    return
+                if not eventos:
+                    if informado < cursor:
+                        informado = cursor
+                        yield self._linea_secuencia(cursor)
+                    else:
+                        yield None
+                    continue
+                cursor = eventos[-1].secuencia
+                elegidos = [e for e in eventos
+                            if opciones["directorio"] in (None, e.directorio)
+                            and (not opciones["patron"] or fnmatch.fnmatchcase(e.nombre, opciones["patron"]))]
+                if elegidos:
+                    informado = elegidos[-1].secuencia
+                bloque = b"".join(formatear(e) for e in elegidos)
+                if cursor - informado >= salto:
+                    informado = cursor
+                    bloque += self._linea_secuencia(cursor)
+                yield bloque
+        finally:
+            with self.mutex:
+                self.suscriptores -= 1
+
+    def _linea_secuencia(self, cursor):
+        return f"# secuencia {cursor} generacion {self.generacion}\n".encode("utf-8")
+
+    def estadisticas(self):
+        with self.mutex:
+            return {"ultimo": self.ultimo, "en_anillo": len(self.anillo), "capacidad": self.anillo.maxlen,
+                    "suscriptores": self.suscriptores, "desbordados": self.desbordados}
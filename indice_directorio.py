@@ -0,0 +1,228 @@
+import fnmatch
+import os
+import threading
+import time
+
+import directorios
+
+ORDENES = ("nombre", "tamano", "mtime")
+
+
+class IndiceDirectorio:
+    """Copia en memoria del contenido de un directorio: nombre -> (tamano, mtime).
+
+    El servidor la actualiza directamente cuando escribe un archivo (SUBIR,
+    COPIAR). Los cambios que hacen otros procesos (el demonio moviendo
+    archivos) se detectan con un hilo que revisa el mtime del directorio cada
+    `intervalo` segundos; solo si cambio se vuelve a leer el directorio, y aun
+    asi solo se hace stat de los archivos nuevos o reemplazados (cambia el
+    inodo), no de todos. Si se pasa al_cambiar, se la llama con la ruta de
+    cada archivo que desaparecio o se reemplazo por fuera. Si se pasa
+    al_modificar, se la llama con (nombre, anterior, actual, motivo) por cada
+    cambio del indice despues de la carga inicial; anterior y actual son
+    (tamano, mtime, inodo) o None, y motivo es el que se paso a actualizar()
+    o None si el cambio se encontro en el disco.
+
+    Si el directorio esta repartido en subcarpetas (ver directorios.py) cada
+    una se revisa por separado: un cambio solo obliga a releer su carpeta.
+    """
+
+    def __init__(self, directorio, intervalo=1.0, al_cambiar=None, al_modificar=None):
+        if isinstance(directorio, str):
+            directorio = directorios.Directorio(directorio)
+        self.directorio = directorio
+        self.intervalo = intervalo
+        self.al_cambiar = al_cambiar
+        self.al_modificar = al_modificar
+        self.mutex = threading.Lock()
+        self.archivos = {}  # nombre -> (tamano, mtime, inodo)
+        self._carpetas = {}  # carpeta -> (mtime, {nombre: (tamano, mtime, inodo)})
+        # Una sola reconciliacion a la vez (el hilo y un listar antes de cargar)
+        self._reconciliando = threading.Lock()
+        self._ordenados = {}
+        self._cargado = False
+        self._hilo = None
+        self.reconstrucciones = 0
+
+    def iniciar(self):
+        """Carga el indice y arranca el hilo que lo reconcilia con el disco"""
+        self.reconciliar()
+        if self._hilo is None:
+            self._hilo = threading.Thread(target=self._vigilar,
+                                          name=f"indice-{os.path.basename(self.directorio.raiz)}", daemon=True)
+            self._hilo.start()
+
+    def _vigilar(self):
+        while True:
+            time.sleep(self.intervalo)
+            try:
+                self.reconciliar()
+            except Exception as e:
+                print(f"Error al actualizar el indice de {self.directorio.raiz}: {str(e)}")
+
+    @staticmethod
+    def _leer_carpeta(carpeta, conocidos):
+        nuevos = {}
+        try:
+            with os.scandir(carpeta) as entradas:
+                for entrada in entradas:
+                    try:
+                        if directorios.es_interno(entrada.name) or not entrada.is_file(follow_symlinks=False):
+                            continue
+                        anterior = conocidos.get(entrada.name)
+                        if anterior is not None and anterior[2] == entrada.inode():
+                            nuevos[entrada.name] = anterior
+                        else:
+                            estado = entrada.stat(follow_symlinks=False)
+                            nuevos[entrada.name] = (estado.st_size, estado.st_mtime, estado.st_ino)
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return nuevos
+
+    def reconciliar(self, forzar=False):
+        """Vuelve a leer las carpetas que cambiaron desde la ultima vez"""
+        with self._reconciliando:
+            self._reconciliar(forzar)
+
+    def _reconciliar(self, forzar):
+        self.directorio.revisar()
+        vigentes = self.directorio.carpetas()
+        leidas = {}
+        for carpeta in vigentes:
+            try:
+                mtime = os.stat(carpeta).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            anterior = self._carpetas.get(carpeta)
+            if not forzar and self._cargado and anterior is not None and anterior[0] == mtime:
+                continue
+            # Se anota el mtime de antes de leer: si algo cambia mientras
+            # leemos, la proxima revision la vuelve a leer
+            leidas[carpeta] = (mtime, self._leer_carpeta(carpeta, anterior[1] if anterior else {}))
+        quitadas = [carpeta for carpeta in self._carpetas if carpeta not in vigentes]
+        if self._cargado and not leidas and not quitadas:
+            return
+
+        cambiados = []  # rutas que desaparecieron o se reemplazaron
+        afectados = set()
+        for carpeta in quitadas:
+            for nombre, anterior in self._carpetas.pop(carpeta)[1].items():
+                afectados.add(nombre)
+                cambiados.append(os.path.join(carpeta, nombre))
+        for carpeta, (mtime, nuevos) in leidas.items():
+            anteriores = self._carpetas.get(carpeta, (None, {}))[1]
+            for nombre, anterior in anteriores.items():
+                if nuevos.get(nombre) is not anterior:
+                    cambiados.append(os.path.join(carpeta, nombre))
+            afectados.update(anteriores)
+            afectados.update(nuevos)
+            self._carpetas[carpeta] = (mtime, nuevos)
+        modificados = []  # (nombre, anterior, actual)
+        with self.mutex:
+            hubo_cambios = not self._cargado
+            for nombre in afectados:
+                valor = None
+                # Durante una migracion el mismo nombre puede estar en la raiz y en su subcarpeta
+                for carpeta in self.directorio.carpetas_de(nombre):
+                    valor = self._carpetas.get(carpeta, (None, {}))[1].get(nombre)
+                    if valor is not None:
+                        break
+                anterior = self.archivos.get(nombre)
+                if valor is None:
+                    if anterior is not None:
+                        del self.archivos[nombre]
+                        hubo_cambios = True
+                        modificados.append((nombre, anterior, None))
+                elif anterior != valor:
+                    self.archivos[nombre] = valor
+                    hubo_cambios = True
+                    modificados.append((nombre, anterior, valor))
+            if hubo_cambios:
+                self._ordenados = {}
+            # La carga inicial no cuenta como cambios
+            if not self._cargado:
+                modificados = []
+            self._cargado = True
+            self.reconstrucciones += 1
+        if self.al_cambiar is not None:
+            for ruta in cambiados:
+                self.al_cambiar(ruta)
+        if self.al_modificar is not None:
+            for nombre, anterior, actual in modificados:
+                self.al_modificar(nombre, anterior, actual, None)
+
+    def actualizar(self, nombre, motivo=None):
+        """Refleja en el indice el estado actual de un archivo.
+
+        motivo ("subido", "copiado"...) se le pasa a al_modificar si el archivo cambio.
+        """
+        ruta = self.directorio.buscar(nombre)
+        try:
+            estado = os.stat(ruta) if ruta is not None else None
+            valor = (estado.st_size, estado.st_mtime, estado.st_ino) if estado else None
+        except FileNotFoundError:
+            valor = None
+        with self.mutex:
+            anterior = self.archivos.get(nombre)
+            if valor is None:
+                if self.archivos.pop(nombre, None) is not None:
+                    self._ordenados = {}
+            else:
+                if nombre not in self.archivos:
+                    self._ordenados = {}
+                elif self.archivos[nombre][:2] != valor[:2]:
+                    # Cambio tamano o mtime: solo afecta esos ordenes
+                    self._ordenados.pop("tamano", None)
+                    self._ordenados.pop("mtime", None)
+                self.archivos[nombre] = valor
+        if self.al_modificar is not None and anterior != valor:
+            self.al_modificar(nombre, anterior, valor, motivo)
+
+    def eliminar(self, nombre):
+        with self.mutex:
+            anterior = self.archivos.pop(nombre, None)
+            if anterior is not None:
+                self._ordenados = {}
+        if self.al_modificar is not None and anterior is not None:
+            self.al_modificar(nombre, anterior, None, None)
+
+    def copia(self):
+        """nombre -> (tamano, mtime, inodo) de todos los archivos, para recorrerlos sin el lock"""
+        if not self._cargado:
+            self.reconciliar()
+        with self.mutex:
+            return dict(self.archivos)
+
+    def __len__(self):
+        return len(self.archivos)
+
+    def listar(self, patron=None, orden="nombre", descendente=False, desde=0, limite=None):
+        """Devuelve ([(nombre, tamano, mtime), ...], total_que_coincide)"""
+        if orden not in ORDENES:
+            raise ValueError(f"Orden desconocido: {orden}")
+        if not self._cargado:
+            self.reconciliar()
+        with self.mutex:
+            # La lista ordenada se guarda hasta el proximo cambio
+            nombres = self._ordenados.get(orden)
+            if nombres is None:
+                if orden == "nombre":
+                    nombres = sorted(self.archivos)
+                elif orden == "tamano":
+                    nombres = sorted(self.archivos, key=lambda n: (self.archivos[n][0], n))
+                else:
+                    nombres = sorted(self.archivos, key=lambda n: (self.archivos[n][1], n))
+                self._ordenados[orden] = nombres
+            archivos = self.archivos
+
+            if patron and patron != "*":
+                nombres = [n for n in nombres if fnmatch.fnmatchcase(n, patron)]
+            total = len(nombres)
+            fin = total if limite is None else min(total, desde + limite)
+            if descendente:
+                pagina = nombres[max(0, total - fin):max(0, total - desde)][::-1]
+            else:
+                pagina = nombres[desde:fin]
+            return [(n, archivos[n][0], archivos[n][1]) for n in pagina], total
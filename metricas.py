@@ -0,0 +1,216 @@
+import bisect
+import contextlib
+import http.server
+import json
+import threading
+import time
+
+# Metricas del servidor: cuantos comandos de cada tipo, cuanto tardan, cuantos
+# bytes mueven y cuantas conexiones hay abiertas. Registrar un comando cuesta
+# un lock y una busqueda binaria en el histograma, asi que se dejan siempre
+# activas. Los demas componentes (locks, log, cache, demonio) se agregan como
+# fuentes: funciones que devuelven un diccionario y se consultan al pedir las
+# metricas, no en cada comando.
+
+# Limites de los intervalos del histograma de latencias: de 50 us a unos 100 s,
+# cada uno un 19% mas grande que el anterior
+LIMITES_LATENCIA = tuple(0.00005 * 2 ** (i / 4) for i in range(85))
+PERCENTILES = (0.5, 0.95, 0.99)
+FORMATOS = ("texto", "json", "prometheus")
+PREFIJO_PROMETHEUS = "hilos_sync"
+
+
+class Histograma:
+    """Cuenta observaciones en intervalos fijos de escala logaritmica.
+
+    Los percentiles salen de las cuentas, con un error acotado por el ancho
+    del intervalo, sin guardar cada observacion.
+    """
+
+    def __init__(self, limites=LIMITES_LATENCIA):
+        self.limites = limites
+        self.cuentas = [0] * (len(limites) + 1)
+        self.total = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    def observar(self, valor):
+        self.cuentas[bisect.bisect_left(self.limites, valor)] += 1
+        self.total += 1
+        self.suma += valor
+        if valor > self.maximo:
+            self.maximo = valor
+
+    def percentil(self, p):
+        """Limite superior del intervalo donde cae el percentil p (0 a 1)"""
+        if not self.total:
+            return 0.0
+        objetivo = p * self.total
+        acumulado = 0
+        for i, cuenta in enumerate(self.cuentas):
+            acumulado += cuenta
+            if acumulado >= objetivo:
+                return min(self.limites[i], self.maximo) if i < len(self.limites) else self.maximo
+        return self.maximo
+
+
+class MetricasComando:
+    def __init__(self):
+        self.cantidad = 0
+        self.errores = 0
+        self.bytes_recibidos = 0
+        self.bytes_enviados = 0
+        self.latencia = Histograma()
+
+    def resumen(self):
+        resumen = {"cantidad": self.cantidad, "errores": self.errores,
+                   "bytes_recibidos": self.bytes_recibidos, "bytes_enviados": self.bytes_enviados,
+                   "latencia_promedio": self.latencia.suma / self.cantidad if self.cantidad else 0.0,
+                   "latencia_maxima": self.latencia.maximo, "latencia_suma": self.latencia.suma}
+        for p in PERCENTILES:
+            resumen[f"p{int(p * 100)}"] = self.latencia.percentil(p)
+        return resumen
+
+
+class Metricas:
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.inicio = time.time()
+        self.comandos = {}
+        self.conexiones_activas = 0
+        self.conexiones_totales = 0
+        self._fuentes = {}
+
+    def conexion_abierta(self):
+        with self.mutex:
+            self.conexiones_activas += 1
+            self.conexiones_totales += 1
+
+    def conexion_cerrada(self):
+        with self.mutex:
+            self.conexiones_activas -= 1
+
+    def registrar_comando(self, comando, segundos, error=False, recibidos=0, enviados=0):
+        with self.mutex:
+            metricas = self.comandos.get(comando)
+            if metricas is None:
+                metricas = self.comandos[comando] = MetricasComando()
+            metricas.cantidad += 1
+            metricas.errores += bool(error)
+            metricas.bytes_recibidos += recibidos
+            metricas.bytes_enviados += enviados
+            metricas.latencia.observar(segundos)
+
+    @contextlib.contextmanager
+    def medir(self, comando, conexion):
+        """Mide un comando: cuanto tarda, los bytes que mueve por la conexion y si responde con error"""
+        inicio = time.perf_counter()
+        recibidos, enviados, errores = conexion.bytes_recibidos, conexion.bytes_enviados, conexion.errores_enviados
+        fallo = True
+        try:
+            yield
+            fallo = False
+        finally:
+            self.registrar_comando(comando, time.perf_counter() - inicio,
+                                   fallo or conexion.errores_enviados > errores,
+                                   conexion.bytes_recibidos - recibidos, conexion.bytes_enviados - enviados)
+
+    def agregar_fuente(self, nombre, funcion):
+        """funcion() devuelve un diccionario de valores que se incluye al pedir las metricas"""
+        self._fuentes[nombre] = funcion
+
+    def instantanea(self):
+        """Todas las metricas en un diccionario"""
+        ahora = time.time()
+        with self.mutex:
+            comandos = {nombre: m.resumen() for nombre, m in sorted(self.comandos.items())}
+            datos = {"activo_desde": self.inicio, "segundos_activo": ahora - self.inicio,
+                     "conexiones": {"activas": self.conexiones_activas, "totales": self.conexiones_totales},
+                     "comandos": comandos,
+                     "bytes": {"recibidos": sum(c["bytes_recibidos"] for c in comandos.values()),
+                               "enviados": sum(c["bytes_enviados"] for c in comandos.values())}}
+        for nombre, funcion in list(self._fuentes.items()):
+            try:
+                datos[nombre] = funcion()
+            except Exception as e:
+                datos[nombre] = {"error": str(e)}
+        return datos
+
+    def formatear(self, formato="texto"):
+        if formato == "json":
+            return json.dumps(self.instantanea(), ensure_ascii=False)
+        if formato == "prometheus":
+            return self.prometheus()
+        return self.texto()
+
+    def texto(self):
+        """Resumen legible para el comando STATS"""
+        datos = self.instantanea()
+        lineas = [f"Activo hace {datos['segundos_activo']:.0f} s - conexiones: {datos['conexiones']['activas']} "
+                  f"activas, {datos['conexiones']['totales']} en total - bytes: {datos['bytes']['recibidos']} "
+                  f"recibidos, {datos['bytes']['enviados']} enviados"]
+        if datos["comandos"]:
+            lineas.append(f"{'comando':<16}{'cantidad':>10}{'errores':>9}{'p50 ms':>10}{'p95 ms':>10}"
+                          f"{'p99 ms':>10}{'max ms':>10}{'recibidos':>14}{'enviados':>14}")
+        for nombre, c in datos["comandos"].items():
+            lineas.append(f"{nombre:<16}{c['cantidad']:>10}{c['errores']:>9}{c['p50'] * 1000:>10.2f}"
+                          f"{c['p95'] * 1000:>10.2f}{c['p99'] * 1000:>10.2f}{c['latencia_maxima'] * 1000:>10.2f}"
+                          f"{c['bytes_recibidos']:>14}{c['bytes_enviados']:>14}")
+        for nombre in self._fuentes:
+            valores = datos.get(nombre, {})
+            lineas.append(f"{nombre}: " + ", ".join(
+                f"{clave}={valor:.3f}" if isinstance(valor, float) else f"{clave}={valor}"
+                for clave, valor in valores.items()))
+        return "\n".join(lineas)
+
+    def prometheus(self):
+        """Las metricas en el formato de texto de Prometheus"""
+        datos = self.instantanea()
+        p = PREFIJO_PROMETHEUS
+        lineas = [f"# TYPE {p}_conexiones_activas gauge", f"{p}_conexiones_activas {datos['conexiones']['activas']}",
+                  f"# TYPE {p}_conexiones_total counter", f"{p}_conexiones_total {datos['conexiones']['totales']}",
+                  f"# TYPE {p}_segundos_activo gauge", f"{p}_segundos_activo {datos['segundos_activo']:.3f}"]
+        series = (("comandos_total", "counter", "cantidad"), ("comandos_errores_total", "counter", "errores"),
+                  ("bytes_recibidos_total", "counter", "bytes_recibidos"),
+                  ("bytes_enviados_total", "counter", "bytes_enviados"))
+        for nombre, tipo, clave in series:
+            lineas.append(f"# TYPE {p}_{nombre} {tipo}")
+            for comando, c in datos["comandos"].items():
+                lineas.append(f'{p}_{nombre}{{comando="{comando}"}} {c[clave]}')
+        lineas.append(f"# TYPE {p}_comando_latencia_segundos summary")
+        for comando, c in datos["comandos"].items():
+            for percentil in PERCENTILES:
+                lineas.append(f'{p}_comando_latencia_segundos{{comando="{comando}",quantile="{percentil}"}} '
+                              f'{c[f"p{int(percentil * 100)}"]:.6f}')
+            lineas.append(f'{p}_comando_latencia_segundos_sum{{comando="{comando}"}} {c["latencia_suma"]:.6f}')
+            lineas.append(f'{p}_comando_latencia_segundos_count{{comando="{comando}"}} {c["cantidad"]}')
+        for fuente in self._fuentes:
+            for clave, valor in datos.get(fuente, {}).items():
+                if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+                    lineas.append(f"# TYPE {p}_{fuente}_{clave} gauge")
+                    lineas.append(f"{p}_{fuente}_{clave} {valor}")
+        return "\n".join(lineas) + "\n"
+
+
+def iniciar_http(metricas, puerto, host="127.0.0.1"):
+    """Sirve las metricas en formato Prometheus por HTTP (GET /metrics) en un hilo aparte"""
+
+    class Manejador(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            cuerpo = metricas.prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, formato, *args):
+            pass
+
+    servidor = http.server.ThreadingHTTPServer((host, puerto), Manejador)
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas-http", daemon=True).start()
+    return servidor
@@ -0,0 +1,309 @@
+import codecs
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import zlib
+
+from compresion import EXTENSIONES_COMPRIMIDAS
+
+BLOQUE = 1024 * 1024
+# validar revisa el contenido de los .json y .gz solo hasta este tamano (los
+# .json se cargan enteros en memoria); de los mas grandes solo mira el tamano
+# y la cabecera. En los .gz cuenta lo descomprimido, asi un archivo chico que
+# se expande a gigas no ocupa un trabajador
+TAMANO_VERIFICAR = 16 * 1024 * 1024
+
+EXTENSIONES_TEXTO = {".txt", ".csv", ".log", ".md", ".json", ".xml", ".html", ".ini", ".conf"}
+
+# Sufijos de los intermedios que dejan las etapas en el directorio de trabajo
+SUFIJOS_INTERMEDIOS = (".comprimiendo", ".convirtiendo")
+
+TIPO_CPU = "cpu"
+TIPO_IO = "io"
+
+
+class ErrorValidacion(Exception):
+    """El archivo no paso la validacion y no debe llegar a procesados"""
+
+
+# Funciones de cada etapa. Reciben (ruta, nombre, trabajo) y devuelven
+# (ruta, nombre, info): la ruta donde quedo el archivo (la misma si la etapa
+# no lo transforma), el nombre que va a tener en procesados y un diccionario
+# con datos para el registro. Las que transforman escriben en el directorio
+# `trabajo`. Estan a nivel de modulo para poder ejecutarse en otro proceso.
+
+def validar(ruta, nombre, trabajo, tamano_maximo=None, tamano_verificar=TAMANO_VERIFICAR):
+    """Revisa el tamano y que los formatos conocidos no esten corruptos.
+
+    El contenido se revisa completo solo hasta tamano_verificar bytes.
+    """
+    try:
+        tamano = os.path.getsize(ruta)
+    except FileNotFoundError:
+        raise ErrorValidacion(f"El archivo {nombre} ya no existe en la carpeta de entrada")
+    if tamano_maximo is not None and tamano > tamano_maximo:
+        raise ErrorValidacion(f"El archivo {nombre} pesa {tamano} bytes (maximo {tamano_maximo})")
+
+    extension = os.path.splitext(nombre)[1].lower()
+    info = {"tamano": tamano}
+    try:
+        if extension == ".json" and tamano <= tamano_verificar:
+            with open(ruta, "rb") as f:
+                json.load(f)
+        elif extension == ".json":
+            info["sin_verificar"] = 1
+        elif extension == ".gz":
+            # Leerlo completo verifica el CRC de cada miembro; si descomprimido
+            # pasa de tamano_verificar se deja ahi (la cabecera ya se reviso)
+            leidos = 0
+            with gzip.open(ruta, "rb") as f:
+                while True:
+                    bloque = f.read(BLOQUE)
+                    if not bloque:
+                        break
+                    leidos += len(bloque)
+                    if leidos > tamano_verificar:
+                        info["sin_verificar"] = 1
+                        break
+    except (ValueError, OSError, EOFError, zlib.error) as e:
+        raise ErrorValidacion(f"El archivo {nombre} esta corrupto: {str(e)}")
+    return ruta, nombre, info
+
+
+def suma_verificacion(ruta, nombre, trabajo):
+    """Calcula el SHA-256 del contenido"""
+    suma = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        while True:
+            bloque = f.read(BLOQUE)
+            if not bloque:
+                break
+            suma.update(bloque)
+    return ruta, nombre, {"sha256": suma.hexdigest()}
+
+
+def comprimir(ruta, nombre, trabajo, nivel=6):
+    """Comprime con gzip; el archivo queda en procesados como nombre.gz"""
+    if os.path.splitext(nombre)[1].lower() in EXTENSIONES_COMPRIMIDAS:
+        return ruta, nombre, {}
+    fd, salida = tempfile.mkstemp(dir=trabajo, suffix=SUFIJOS_INTERMEDIOS[0])
+    try:
+        with open(ruta, "rb") as origen, os.fdopen(fd, "wb") as archivo:
+            with gzip.GzipFile(filename=nombre, mode="wb", compresslevel=nivel, fileobj=archivo) as destino:
+                shutil.copyfileobj(origen, destino, BLOQUE)
+        antes, despues = os.path.getsize(ruta), os.path.getsize(salida)
+    except BaseException:
+        os.remove(salida)
+        raise
+    if despues >= antes:
+        # No se comprime (datos aleatorios o cifrados): queda el original
+        os.remove(salida)
+        return ruta, nombre, {}
+    return salida, nombre + ".gz", {"comprimido": f"{antes}->{despues}"}
+
+
+def convertir(ruta, nombre, trabajo):
+    """Pasa los archivos de texto a UTF-8 sin BOM y con saltos de linea \\n"""
+    if os.path.splitext(nombre)[1].lower() not in EXTENSIONES_TEXTO:
+        return ruta, nombre, {}
+    # latin-1 acepta cualquier secuencia de bytes, asi que siempre termina
+    for codificacion in ("utf-8-sig", "cp1252", "latin-1"):
+        try:
+            salida, cambio = _convertir_texto(ruta, trabajo, codificacion)
+        except UnicodeDecodeError:
+            continue
+        if not cambio:
+            os.remove(salida)
+            return ruta, nombre, {}
+        return salida, nombre, {"convertido": codificacion}
+    return ruta, nombre, {}
+
+
+def _convertir_texto(ruta, trabajo, codificacion):
+    """Escribe la version convertida en `trabajo`; devuelve (ruta, si cambio algo)"""
+    decodificador = codecs.getincrementaldecoder(codificacion)()
+    fd, salida = tempfile.mkstemp(dir=trabajo, suffix=SUFIJOS_INTERMEDIOS[1])
+    cambio = codificacion != "utf-8-sig"
+    pendiente = ""
+    try:
+        with open(ruta, "rb") as origen, os.fdopen(fd, "w", encoding="utf-8", newline="") as destino:
+            primero = True
+            while True:
+                bloque = origen.read(BLOQUE)
+                if primero:
+                    cambio = cambio or bloque.startswith(codecs.BOM_UTF8)
+                    primero = False
+                texto = pendiente + decodificador.decode(bloque, final=not bloque)
+                # Un \r al final puede ser la mitad de un \r\n que sigue en el proximo bloque
+                pendiente = ""
+                if bloque and texto.endswith("\r"):
+                    texto, pendiente = texto[:-1], "\r"
+                if "\r" in texto:
+                    cambio = True
+                    texto = texto.replace("\r\n", "\n").replace("\r", "\n")
+                destino.write(texto)
+                if not bloque:
+                    break
+    except BaseException:
+        os.remove(salida)
+        raise
+    return salida, cambio
+
+
+def limpiar_intermedios(trabajo):
+    """Borra los intermedios que quedaron de una ejecucion que se corto"""
+    borrados = 0
+    for nombre in os.listdir(trabajo):
+        if nombre.endswith(SUFIJOS_INTERMEDIOS):
+            try:
+                os.remove(os.path.join(trabajo, nombre))
+                borrados += 1
+            except FileNotFoundError:
+                pass
+    return borrados
+
+
+ETAPAS = {
+    "validar": (validar, TIPO_IO),
+    "suma": (suma_verificacion, TIPO_CPU),
+    "convertir": (convertir, TIPO_CPU),
+    "comprimir": (comprimir, TIPO_CPU),
+}
+
+
+class Etapa:
+    def __init__(self, nombre, trabajadores=None, **opciones):
+        if nombre not in ETAPAS:
+            raise ValueError(f"Etapa desconocida: {nombre} (disponibles: {', '.join(ETAPAS)})")
+        self.nombre = nombre
+        self.funcion, self.tipo = ETAPAS[nombre]
+        if trabajadores is None:
+            trabajadores = (os.cpu_count() or 1) if self.tipo == TIPO_CPU else 4
+        self.trabajadores = trabajadores
+        self.opciones = opciones
+
+    def __repr__(self):
+        return f"{self.nombre}({self.tipo} x{self.trabajadores})"
+
+
+def parsear_etapas(texto, trabajadores_texto=""):
+    """"validar,suma" y "suma=4,validar=2" -> lista de Etapa"""
+    trabajadores = {}
+    for parte in filter(None, (p.strip() for p in trabajadores_texto.split(","))):
+        nombre, _, cantidad = parte.partition("=")
+        try:
+            trabajadores[nombre.strip()] = max(1, int(cantidad))
+        except ValueError:
+            raise ValueError(f"Cantidad de trabajadores invalida: {parte}")
+    nombres = [n.strip() for n in texto.split(",") if n.strip()]
+    return [Etapa(nombre, trabajadores.get(nombre)) for nombre in nombres]
+
+
+class Tarea:
+    def __init__(self, archivo, ruta):
+        self.archivo = archivo
+        self.original = ruta
+        self.ruta = ruta
+        self.nombre = archivo
+        self.info = {}
+        self.etapa = 0
+        self.futuro = concurrent.futures.Future()
+
+
+class Pipeline:
+    """Pasa cada archivo por una serie de etapas y al final llama a `finalizar`.
+
+    Cada etapa tiene su propio executor con su cantidad de trabajadores: las
+    de CPU (suma, comprimir, convertir) un ProcessPoolExecutor, asi usan
+    todos los nucleos sin pelear por el GIL, y las de disco un pool de hilos.
+    Entre etapas solo viajan rutas, nunca el contenido. Las etapas encadenan
+    sin bloquear a nadie: cuando una termina, su callback envia la tarea a la
+    siguiente. `finalizar(tarea)` corre en un hilo y deja el archivo en su
+    destino; si una etapa falla se llama a `rechazar(tarea, error)`.
+    """
+
+    def __init__(self, etapas, trabajo, finalizar, rechazar, hilos_finalizar=4):
+        self.etapas = etapas
+        self.trabajo = trabajo
+        self.finalizar = finalizar
+        self.rechazar = rechazar
+        self.executors = []
+        contexto = multiprocessing.get_context("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                                               else "spawn")
+        for etapa in etapas:
+            if etapa.tipo == TIPO_CPU:
+                executor = concurrent.futures.ProcessPoolExecutor(etapa.trabajadores, mp_context=contexto)
+            else:
+                executor = concurrent.futures.ThreadPoolExecutor(etapa.trabajadores,
+                                                                 thread_name_prefix=f"etapa-{etapa.nombre}")
+            self.executors.append(executor)
+        self.executor_final = concurrent.futures.ThreadPoolExecutor(hilos_finalizar, thread_name_prefix="finalizar")
+        self.mutex = threading.Lock()
+        self.procesados = {etapa.nombre: 0 for etapa in etapas}
+
+    def procesar(self, archivo, ruta):
+        """Empieza a procesar un archivo; devuelve un Future que se completa al final"""
+        tarea = Tarea(archivo, ruta)
+        self._siguiente(tarea)
+        return tarea.futuro
+
+    def _siguiente(self, tarea):
+        try:
+            if tarea.etapa == len(self.etapas):
+                futuro = self.executor_final.submit(self.finalizar, tarea)
+                futuro.add_done_callback(lambda f: self._terminar(tarea, f))
+                return
+            etapa = self.etapas[tarea.etapa]
+            futuro = self.executors[tarea.etapa].submit(etapa.funcion, tarea.ruta, tarea.nombre, self.trabajo,
+                                                        **etapa.opciones)
+            futuro.add_done_callback(lambda f: self._etapa_lista(tarea, f))
+        except Exception as e:
+            self._fallar(tarea, e)
+
+    def _etapa_lista(self, tarea, futuro):
+        try:
+            ruta, nombre, info = futuro.result()
+        except Exception as e:
+            self._fallar(tarea, e)
+            return
+        # El intermedio anterior ya no sirve (el original lo saca `finalizar`)
+        if ruta != tarea.ruta and tarea.ruta != tarea.original:
+            self._borrar(tarea.ruta)
+        tarea.ruta, tarea.nombre = ruta, nombre
+        tarea.info.update(info)
+        with self.mutex:
+            self.procesados[self.etapas[tarea.etapa].nombre] += 1
+        tarea.etapa += 1
+        self._siguiente(tarea)
+
+    def _terminar(self, tarea, futuro):
+        error = futuro.exception()
+        if error is not None:
+            self._fallar(tarea, error)
+        else:
+            tarea.futuro.set_result(tarea)
+
+    def _fallar(self, tarea, error):
+        if tarea.ruta != tarea.original:
+            self._borrar(tarea.ruta)
+        try:
+            self.rechazar(tarea, error)
+        finally:
+            tarea.futuro.set_exception(error)
+
+    @staticmethod
+    def _borrar(ruta):
+        try:
+            os.remove(ruta)
+        except FileNotFoundError:
+            pass
+
+    def cerrar(self):
+        for executor in self.executors + [self.executor_final]:
+            executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,581 @@
+import os
+import re
+import select
+import socket
+import struct
+
+import compresion
+
+# Protocolo binario entre cliente y servidor.
+#
+# Al conectarse, el cliente nuevo manda MAGIA + un byte con su version. Los
+# clientes antiguos mandan directamente texto (por ejemplo "LISTAR|"), asi que
+# si la conexion no empieza con MAGIA el servidor sigue usando el protocolo de
+# texto de siempre.
+#
+# Despues del saludo todo viaja en tramas:
+#   cabecera fija (opcode, flags, largo del nombre, largo del payload)
+#   + nombre del archivo (utf-8) + payload (bytes crudos, sin decodificar)
+#
+# Desde la version 2 la cabecera lleva tambien el id de la solicitud. El
+# cliente puede mandar muchas solicitudes seguidas sin esperar cada respuesta
+# (pipelining) y todas las tramas de una respuesta llevan el id de su
+# solicitud, asi las empareja aunque lleguen en otro orden.
+
+MAGIA = b"HSYN"
+VERSION_PROTOCOLO = 2
+VERSIONES_SOPORTADAS = (1, 2)
+
+# opcode (1 byte), flags (1 byte), largo nombre (2 bytes), largo payload (8 bytes)
+CABECERA = struct.Struct("!BBHQ")
+# version 2: lo mismo + id de la solicitud (4 bytes)
+CABECERA_V2 = struct.Struct("!BBHQI")
+
+# Opcodes de solicitud
+OP_LISTAR = 0x01
+OP_COPIAR = 0x02
+OP_LEER = 0x03
+OP_SUBIR = 0x04
+OP_DESCARGAR = 0x05
+OP_LOGS = 0x06
+OP_FIRMAS = 0x07  # firmas de bloques de la copia del servidor (subida por diferencias)
+OP_DELTA = 0x08  # subida por diferencias: referencias a bloques + datos nuevos
+OP_DESCARGAR_LOTE = 0x09  # muchos archivos en una sola respuesta (nombres en el payload)
+OP_SUBIR_LOTE = 0x0A  # muchos archivos en una sola solicitud
+OP_COMPRESION = 0x0B  # negocia la compresion de la conexion (ver compresion.py)
+OP_STATS = 0x0C  # metricas del servidor (ver metricas.py)
+OP_BUSCAR = 0x0D  # busca texto en los archivos del servidor (ver busqueda.py)
+OP_VIGILAR = 0x0E  # envia los cambios de entrada y procesados a medida que ocurren (ver eventos.py)
+
+# Opcodes de respuesta
+OP_OK = 0x80
+OP_ERROR = 0x81
+OP_DATOS = 0x82  # un bloque de una transferencia por partes
+OP_FIN = 0x83  # fin de una transferencia por partes
+OP_INFO = 0x84  # datos del archivo (tamano, etag, rango) antes de sus OP_DATOS
+
+# Flags de la cabecera
+FLAG_POR_PARTES = 0x01  # el contenido sigue en tramas OP_DATOS hasta OP_FIN
+# El payload va comprimido con el codec de la conexion: en un OP_DATOS es un
+# pedazo del flujo de toda la transferencia, en cualquier otra trama un flujo completo
+FLAG_COMPRIMIDO = 0x02
+
+# Nombre del comando de texto equivalente a cada opcode
+COMANDOS = {
+    OP_LISTAR: "LISTAR",
+    OP_COPIAR: "COPIAR",
+    OP_LEER: "LEER",
+    OP_SUBIR: "SUBIR",
+    OP_DESCARGAR: "DESCARGAR",
+    OP_LOGS: "LOGS",
+    OP_FIRMAS: "FIRMAS",
+    OP_DELTA: "DELTA",
+    OP_DESCARGAR_LOTE: "DESCARGAR_LOTE",
+    OP_SUBIR_LOTE: "SUBIR_LOTE",
+    OP_COMPRESION: "COMPRESION",
+    OP_STATS: "STATS",
+    OP_BUSCAR: "BUSCAR",
+    OP_VIGILAR: "VIGILAR",
+}
+
+# Payloads mas grandes que esto se mandan aparte para no copiarlos
+LIMITE_CONCATENAR = 64 * 1024
+
+# Tamano de cada trama OP_DATOS en las transferencias de archivos
+BLOQUE_TRANSFERENCIA = 1024 * 1024
+
+# Payload maximo de una trama de comando (por ejemplo la que corta un flujo)
+MAX_PAYLOAD_COMANDO = 1024 * 1024
+# Lo que puede ocupar una trama comprimida completa (OP_OK) al descomprimirla
+MAX_DESCOMPRIMIDO = 256 * 1024 * 1024
+
+
+# Lo que manda el servidor, en lugar del saludo, cuando no puede aceptar
+# mas clientes. Empieza con "Error" para que los clientes de texto lo
+# muestren como cualquier otro error.
+MENSAJE_OCUPADO = "Error: Servidor ocupado, reintente en {segundos} segundos."
+_PATRON_OCUPADO = re.compile(r"Error: Servidor ocupado, reintente en (\d+) segundos")
+
+
+def espera_ocupado(mensaje):
+    """Segundos que sugiere esperar un aviso de servidor ocupado, o None si mensaje es otra cosa"""
+    ocupado = _PATRON_OCUPADO.match(mensaje)
+    return int(ocupado.group(1)) if ocupado else None
+
+
+class ErrorProtocolo(Exception):
+    """Se produce cuando el otro extremo no respeta el protocolo"""
+
+
+class ServidorOcupado(Exception):
+    """El servidor rechazo la conexion porque esta al limite"""
+
+    def __init__(self, reintentar_en):
+        super().__init__(f"Servidor ocupado, reintentar en {reintentar_en} segundos")
+        self.reintentar_en = reintentar_en
+
+
+def empaquetar_cabecera(opcode, largo_nombre, largo_payload, flags=0, id_solicitud=None):
+    """Cabecera de la version 1, o de la 2 si se pasa id_solicitud"""
+    if id_solicitud is None:
+        return CABECERA.pack(opcode, flags, largo_nombre, largo_payload)
+    return CABECERA_V2.pack(opcode, flags, largo_nombre, largo_payload, id_solicitud)
+
+
+def desempaquetar_cabecera(datos):
+    """Devuelve (opcode, flags, largo_nombre, largo_payload), y el id al final en la version 2"""
+    if len(datos) == CABECERA_V2.size:
+        return CABECERA_V2.unpack(datos)
+    return CABECERA.unpack(datos)
+
+
+def tamano_cabecera(version):
+    return CABECERA_V2.size if version and version >= 2 else CABECERA.size
+
+
+def empaquetar_info(info):
+    """Diccionario -> payload "clave=valor" (una por linea)"""
+    return "\n".join(f"{clave}={valor}" for clave, valor in info.items()).encode("utf-8")
+
+
+def desempaquetar_info(payload):
+    """Payload "clave=valor" -> diccionario (los valores numericos como int)"""
+    info = {}
+    for linea in payload.decode("utf-8").splitlines():
+        clave, _, valor = linea.partition("=")
+        info[clave] = int(valor) if valor.isdigit() else valor
+    return info
+
+
+def es_posible_saludo(datos):
+    """True si lo recibido hasta ahora todavia puede ser el saludo binario"""
+    if len(datos) <= len(MAGIA):
+        return MAGIA.startswith(bytes(datos))
+    return False
+
+
+def elegir_version(version_cliente):
+    """Version a usar con un cliente, o 0 si no hay ninguna en comun"""
+    version = min(version_cliente, VERSION_PROTOCOLO)
+    return version if version in VERSIONES_SOPORTADAS else 0
+
+
+class Conexion:
+    """Envuelve un socket para leer y escribir tramas completas"""
+
+    def __init__(self, sock, buffer_size=64 * 1024):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.version = None
+        # Id que llevan las tramas que se envian y el de la ultima trama recibida (version 2)
+        self.id_solicitud = 0
+        self.id_recibido = 0
+        # (codec, nivel) negociado con OP_COMPRESION, o None
+        self.compresion = None
+        # Para las metricas: bytes que pasaron por el socket y respuestas OP_ERROR enviadas
+        self.bytes_recibidos = 0
+        self.bytes_enviados = 0
+        self.errores_enviados = 0
+        # Flujo que quedo para enviar fuera del hilo del comando (ver difusion.py)
+        self.seguimiento = None
+        self._pendiente = bytearray()
+
+    # Operaciones basicas sobre el socket. Todo lo demas se arma encima de
+    # estas, asi otra implementacion (por ejemplo la del servidor asyncio)
+    # solo tiene que reemplazar estos cuatro metodos.
+
+    def _recv(self, n):
+        datos = self.sock.recv(n)
+        self.bytes_recibidos += len(datos)
+        return datos
+
+    def _recv_into(self, vista, n):
+        leidos = self.sock.recv_into(vista, n)
+        self.bytes_recibidos += leidos
+        return leidos
+
+    def enviar(self, datos):
+        """Envia bytes crudos, sin trama"""
+        self.sock.sendall(datos)
+        self.bytes_enviados += len(datos)
+
+    def enviar_desde_archivo(self, archivo, offset, cantidad):
+        """Envia bytes crudos de un archivo con sendfile. Devuelve los enviados."""
+        enviados = self.sock.sendfile(archivo, offset, cantidad)
+        self.bytes_enviados += enviados
+        return enviados
+
+    def esperar_datos(self, timeout):
+        """True si llega algo para leer (o el otro extremo cierra) antes de timeout"""
+        if self._pendiente:
+            return True
+        listos, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(listos)
+
+    def recibir(self, n):
+        """Recibe hasta n bytes (b'' si el otro extremo cerro)"""
+        if self._pendiente:
+            datos = bytes(self._pendiente[:n])
+            del self._pendiente[:n]
+            return datos
+        return self._recv(n)
+
+    def devolver(self, datos):
+        """Deja datos ya leidos para la proxima lectura"""
+        self._pendiente[:0] = datos
+
+    def recibir_exacto(self, n):
+        """Recibe exactamente n bytes o lanza ConnectionError"""
+        buffer = bytearray(n)
+        vista = memoryview(buffer)
+        recibidos = 0
+        if self._pendiente:
+            recibidos = min(n, len(self._pendiente))
+            vista[:recibidos] = self._pendiente[:recibidos]
+            del self._pendiente[:recibidos]
+        while recibidos < n:
+            leidos = self._recv_into(vista[recibidos:], n - recibidos)
+            if not leidos:
+                raise ConnectionError("Conexion cerrada a mitad de una trama")
+            recibidos += leidos
+        return bytes(buffer)
+
+    def recibir_cabecera(self):
+        """Lee la cabecera y el nombre de la siguiente trama.
+
+        Devuelve (opcode, flags, nombre, largo_payload) o None si el otro
+        extremo cerro la conexion entre tramas. El payload queda sin leer.
+        """
+        tamano = tamano_cabecera(self.version)
+        primero = self.recibir(tamano)
+        if not primero:
+            return None
+        if len(primero) < tamano:
+            primero += self.recibir_exacto(tamano - len(primero))
+        opcode, flags, largo_nombre, largo_payload, *id_solicitud = desempaquetar_cabecera(primero)
+        self.id_recibido = id_solicitud[0] if id_solicitud else 0
+        nombre = self.recibir_exacto(largo_nombre).decode("utf-8") if largo_nombre else ""
+        return opcode, flags, nombre, largo_payload
+
+    def recibir_trama(self, max_payload=None, max_descomprimido=MAX_DESCOMPRIMIDO):
+        """Devuelve (opcode, nombre, payload) o None si se cerro la conexion.
+
+        Lanza ErrorProtocolo si el payload pasa de max_payload bytes o, si
+        viene comprimido, de max_descomprimido al descomprimirlo.
+        """
+        cabecera = self.recibir_cabecera()
+        if cabecera is None:
+            return None
+        opcode, flags, nombre, largo_payload = cabecera
+        if max_payload is not None and largo_payload > max_payload:
+            raise ErrorProtocolo(f"Payload demasiado grande: {largo_payload} bytes (maximo {max_payload})")
+        payload = self.recibir_exacto(largo_payload) if largo_payload else b""
+        if flags & FLAG_COMPRIMIDO:
+            payload = b"".join(self.descomprimir(payload, max_descomprimido))
+        return opcode, nombre, payload
+
+    def descompresor(self):
+        """Descompresor para el codec negociado; ErrorProtocolo si no hay ninguno"""
+        if self.compresion is None:
+            raise ErrorProtocolo("Trama comprimida sin compresion negociada")
+        return compresion.Descompresor(self.compresion[0])
+
+    def descomprimir(self, datos, maximo=MAX_DESCOMPRIMIDO, descompresor=None):
+        """Genera de a bloques lo descomprimido de un payload completo.
+
+        Sin descompresor el payload es un flujo completo; con uno, es la
+        continuacion de un flujo repartido en varias tramas. Lanza
+        ErrorProtocolo si no se negocio compresion o si lo descomprimido
+        de esta trama pasa de maximo bytes.
+        """
+        if descompresor is None:
+            descompresor = self.descompresor()
+        total = 0
+        for parte in descompresor.descomprimir(datos):
+            total += len(parte)
+            if total > maximo:
+                raise ErrorProtocolo(f"La trama descomprimida pasa de {maximo} bytes")
+            yield parte
+
+    def conviene_comprimir(self, nombre, archivo, offset=0, cantidad=None):
+        """True si hay compresion negociada y el tramo del archivo no parece ya comprimido"""
+        return self.compresion is not None and compresion.conviene_archivo(nombre, archivo, offset, cantidad)
+
+    def cabecera(self, opcode, largo_nombre=0, largo_payload=0, flags=0):
+        """Cabecera para la version negociada, con el id_solicitud actual"""
+        id_solicitud = self.id_solicitud if self.version and self.version >= 2 else None
+        return empaquetar_cabecera(opcode, largo_nombre, largo_payload, flags, id_solicitud)
+
+    def trama(self, opcode, nombre="", payload=b"", flags=0):
+        """Trama completa en bytes, para juntar varias en un solo envio"""
+        nombre_bytes = nombre.encode("utf-8")
+        return self.cabecera(opcode, len(nombre_bytes), len(payload), flags) + nombre_bytes + payload
+
+    def enviar_trama(self, opcode, nombre="", payload=b"", flags=0):
+        if opcode == OP_ERROR:
+            self.errores_enviados += 1
+        nombre_bytes = nombre.encode("utf-8")
+        cabecera = self.cabecera(opcode, len(nombre_bytes), len(payload), flags)
+        if len(payload) <= LIMITE_CONCATENAR:
+            self.enviar(cabecera + nombre_bytes + payload)
+        else:
+            self.enviar(cabecera + nombre_bytes)
+            self.enviar(payload)
+
+    def enviar_archivo(self, archivo, offset=0, cantidad=None, bloque=BLOQUE_TRANSFERENCIA, comprimir=False):
+        """Envia un archivo abierto en binario como tramas OP_DATOS + OP_FIN.
+
+        Los datos van directo del descriptor al socket con sendfile, sin
+        pasar por la memoria del proceso; con comprimir (y compresion
+        negociada) se leen y se comprimen. Devuelve los bytes del archivo
+        enviados.
+        """
+        if cantidad is None:
+            cantidad = os.fstat(archivo.fileno()).st_size - offset
+        if comprimir and self.compresion is not None:
+            return self._enviar_archivo_comprimido(archivo, offset, cantidad, bloque)
+        enviados = 0
+        while enviados < cantidad:
+            n = min(bloque, cantidad - enviados)
+            self.enviar(self.cabecera(OP_DATOS, 0, n))
+            escritos = self.enviar_desde_archivo(archivo, offset + enviados, n)
+            if escritos != n:
+                # El archivo se achico mientras lo enviabamos: la trama ya
+                # anuncio n bytes, asi que no queda otra que cortar
+                raise ConnectionError("El archivo cambio durante el envio")
+            enviados += n
+        self.enviar_trama(OP_FIN)
+        return enviados
+
+    def enviar_contenido(self, datos, bloque=BLOQUE_TRANSFERENCIA, comprimir=False):
+        """Envia bytes que ya estan en memoria (o un mmap) como tramas OP_DATOS + OP_FIN.
+
+        Igual que enviar_archivo, pero sin leer el disco. Devuelve los bytes
+        enviados (sin comprimir).
+        """
+        vista = memoryview(datos)
+        compresor = compresion.Compresor(*self.compresion) if comprimir and self.compresion else None
+        for inicio in range(0, len(vista), bloque):
+            parte = vista[inicio:inicio + bloque]
+            if compresor is None:
+                self.enviar_trama(OP_DATOS, payload=parte)
+                continue
+            parte = compresor.comprimir(parte)
+            if parte:
+                self.enviar_trama(OP_DATOS, payload=parte, flags=FLAG_COMPRIMIDO)
+        if compresor is not None:
+            self.enviar_trama(OP_DATOS, payload=compresor.terminar(), flags=FLAG_COMPRIMIDO)
+        self.enviar_trama(OP_FIN)
+        return len(vista)
+
+    def _enviar_archivo_comprimido(self, archivo, offset, cantidad, bloque):
+        compresor = compresion.Compresor(*self.compresion)
+        enviados = 0
+        while enviados < cantidad:
+            datos = os.pread(archivo.fileno(), min(bloque, cantidad - enviados), offset + enviados)
+            if not datos:
+                raise ConnectionError("El archivo cambio durante el envio")
+            enviados += len(datos)
+            datos = compresor.comprimir(datos)
+            if datos:
+                self.enviar_trama(OP_DATOS, payload=datos, flags=FLAG_COMPRIMIDO)
+        self.enviar_trama(OP_DATOS, payload=compresor.terminar(), flags=FLAG_COMPRIMIDO)
+        self.enviar_trama(OP_FIN)
+        return enviados
+
+    def enviar_flujo(self, bloques, espera=0.5, comprimir=False):
+        """Envia los bloques de bytes de un generador como OP_DATOS + OP_FIN.
+
+        Si el generador entrega None es que por ahora no hay datos nuevos (por
+        ejemplo al seguir un log): se espera hasta `espera` segundos y, si el
+        otro extremo manda cualquier trama, se corta el flujo. Con comprimir
+        (y compresion negociada) cada bloque sale comprimido y vaciado, asi
+        el otro extremo lo puede mostrar enseguida. Devuelve False si el otro
+        extremo cerro la conexion.
+        """
+        compresor = compresion.Compresor(*self.compresion) if comprimir and self.compresion else None
+        try:
+            for bloque in bloques:
+                if bloque is None:
+                    if self.esperar_datos(espera):
+                        if self.recibir_trama(MAX_PAYLOAD_COMANDO) is None:
+                            return False
+                        break
+                    continue
+                if bloque and compresor is not None:
+                    self.enviar_trama(OP_DATOS, payload=compresor.comprimir(bloque) + compresor.vaciar(),
+                                      flags=FLAG_COMPRIMIDO)
+                elif bloque:
+                    self.enviar_trama(OP_DATOS, payload=bloque)
+        finally:
+            bloques.close()
+        if compresor is not None:
+            self.enviar_trama(OP_DATOS, payload=compresor.terminar(), flags=FLAG_COMPRIMIDO)
+        self.enviar_trama(OP_FIN)
+        return True
+
+    def recibir_hacia_archivo(self, archivo, cantidad):
+        """Copia exactamente cantidad bytes del socket al archivo por bloques"""
+        buffer = bytearray(min(cantidad, self.buffer_size) or 1)
+        vista = memoryview(buffer)
+        faltan = cantidad
+        if self._pendiente and faltan:
+            n = min(faltan, len(self._pendiente))
+            archivo.write(self._pendiente[:n])
+            del self._pendiente[:n]
+            faltan -= n
+        while faltan:
+            leidos = self._recv_into(vista, min(faltan, len(buffer)))
+            if not leidos:
+                raise ConnectionError("Conexion cerrada a mitad de una trama")
+            archivo.write(vista[:leidos])
+            faltan -= leidos
+
+    def recibir_archivo(self, archivo, al_recibir_info=None, max_descomprimido=MAX_DESCOMPRIMIDO):
+        """Recibe tramas OP_DATOS hasta OP_FIN escribiendolas en archivo.
+
+        Cada trama comprimida puede dar hasta max_descomprimido bytes.
+        Tambien acepta una unica trama OP_OK con todo el contenido. Si antes
+        de los datos llega un OP_INFO se le pasa a al_recibir_info como
+        diccionario. Devuelve (ok, datos): si llega un OP_ERROR, ok es False
+        y datos trae el mensaje; si termina bien, datos es la cantidad de
+        bytes (ya descomprimidos).
+        """
+        recibidos = 0
+        descompresor = None
+        while True:
+            cabecera = self.recibir_cabecera()
+            if cabecera is None:
+                raise ConnectionError("El servidor cerro la conexion")
+            opcode, flags, _, largo = cabecera
+            if opcode == OP_DATOS and flags & FLAG_COMPRIMIDO:
+                if descompresor is None:
+                    descompresor = self.descompresor()
+                for datos in self.descomprimir(self.recibir_exacto(largo), max_descomprimido, descompresor):
+                    archivo.write(datos)
+                    recibidos += len(datos)
+            elif opcode == OP_DATOS:
+                self.recibir_hacia_archivo(archivo, largo)
+                recibidos += largo
+            elif opcode == OP_FIN:
+                self.recibir_exacto(largo)
+                return True, recibidos
+            elif opcode == OP_INFO and not recibidos:
+                info = desempaquetar_info(self.recibir_exacto(largo))
+                if al_recibir_info is not None:
+                    al_recibir_info(info)
+            elif opcode == OP_OK and not recibidos and flags & FLAG_COMPRIMIDO:
+                for datos in self.descomprimir(self.recibir_exacto(largo), max_descomprimido):
+                    archivo.write(datos)
+                    recibidos += len(datos)
+                return True, recibidos
+            elif opcode == OP_OK and not recibidos:
+                self.recibir_hacia_archivo(archivo, largo)
+                return True, largo
+            elif opcode == OP_ERROR:
+                return False, self.recibir_exacto(largo)
+            else:
+                raise ErrorProtocolo(f"Trama inesperada durante una transferencia: {hex(opcode)}")
+
+    def cerrar(self):
+        self.sock.close()
+
+
+class EnvioAgrupado:
+    """Junta tramas chicas y las manda de a muchas en un solo envio.
+
+    Lo usan los lotes: miles de archivos chicos salen en unos pocos envios
+    de hasta `limite` bytes en lugar de varias escrituras al socket cada uno.
+    Los archivos grandes se mandan aparte con sendfile.
+    """
+
+    def __init__(self, conexion, limite=BLOQUE_TRANSFERENCIA):
+        self.conexion = conexion
+        self.limite = limite
+        self._tramas = []
+        self._largo = 0
+
+    def agregar(self, opcode, nombre="", payload=b"", flags=0):
+        self._tramas.append(self.conexion.trama(opcode, nombre, payload, flags))
+        self._largo += len(payload)
+        if self._largo >= self.limite:
+            self.vaciar()
+
+    def agregar_archivo(self, nombre, archivo):
+        """OP_INFO (nombre y tamano) + OP_DATOS + OP_FIN de un archivo abierto.
+
+        Devuelve los bytes enviados del archivo.
+        """
+        tamano = os.fstat(archivo.fileno()).st_size
+        self.agregar(OP_INFO, nombre, empaquetar_info({"tamano": tamano}))
+        if tamano > LIMITE_CONCATENAR:
+            self.vaciar()
+            return self.conexion.enviar_archivo(archivo, 0, tamano)
+        datos = archivo.read()
+        if datos:
+            self.agregar(OP_DATOS, payload=datos)
+        self.agregar(OP_FIN)
+        return len(datos)
+
+    def vaciar(self):
+        if self._tramas:
+            self.conexion.enviar(b"".join(self._tramas))
+            self._tramas.clear()
+            self._largo = 0
+
+
+def negociar_cliente(conexion):
+    """Saludo del lado del cliente. Devuelve la version acordada."""
+    conexion.enviar(MAGIA + bytes([VERSION_PROTOCOLO]))
+    respuesta = conexion.recibir_exacto(len(MAGIA) + 1)
+    if respuesta[:len(MAGIA)] != MAGIA:
+        # Puede ser el aviso de servidor ocupado: llega completo y se cierra
+        while len(respuesta) < 256:
+            mas = conexion.recibir(256)
+            if not mas:
+                break
+            respuesta += mas
+        ocupado = _PATRON_OCUPADO.match(respuesta.decode("utf-8", errors="replace"))
+        if ocupado:
+            raise ServidorOcupado(int(ocupado.group(1)))
+        raise ErrorProtocolo("El servidor no soporta el protocolo binario")
+    version = respuesta[-1]
+    if version not in VERSIONES_SOPORTADAS:
+        raise ErrorProtocolo(f"Version de protocolo no soportada: {version}")
+    conexion.version = version
+    return version
+
+
+def negociar_servidor(conexion):
+    """Saludo del lado del servidor.
+
+    Devuelve la version acordada, o None si el cliente usa el protocolo de
+    texto antiguo. En ese caso lo leido queda pendiente en la conexion para
+    que lo procese el bucle de texto.
+    """
+    inicio = conexion.recibir(conexion.buffer_size)
+    while inicio and es_posible_saludo(inicio):
+        mas = conexion.recibir(conexion.buffer_size)
+        if not mas:
+            break
+        inicio += mas
+
+    if len(inicio) <= len(MAGIA) or not inicio.startswith(MAGIA):
+        conexion.devolver(inicio)
+        return None
+
+    conexion.devolver(inicio[len(MAGIA) + 1:])
+    version = elegir_version(inicio[len(MAGIA)])
+    conexion.enviar(MAGIA + bytes([version]))
+    if not version:
+        raise ErrorProtocolo(f"Version de protocolo no soportada: {inicio[len(MAGIA)]}")
+    conexion.version = version
+    return version
+
+
+def configurar_socket(sock):
+    """Opciones comunes para sockets de datos"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
@@ -0,0 +1,224 @@
+import atexit
+import collections
+import fcntl
+import itertools
+import os
+import threading
+import time
+
+# Modos de durabilidad de cada lote
+DURABILIDAD_NINGUNA = "ninguna"  # se juntan lotes en memoria y se escriben cada tanto
+DURABILIDAD_FLUSH = "flush"  # cada lote se entrega al sistema operativo
+DURABILIDAD_FSYNC = "fsync"  # cada lote se entrega al SO y se fuerza a disco
+DURABILIDADES = (DURABILIDAD_NINGUNA, DURABILIDAD_FLUSH, DURABILIDAD_FSYNC)
+
+
+class RegistroAsincrono:
+    """Log en archivo con escritura en segundo plano y commits agrupados.
+
+    registrar() solo agrega la linea a una cola en memoria y vuelve, sin
+    tocar el disco (toma un lock solo para numerar la linea). Un hilo escritor junta todo lo pendiente
+    cada `intervalo` segundos y lo escribe con un solo os.write.
+
+    Varios procesos (servidor y demonio) pueden escribir el mismo archivo:
+    el archivo se abre con O_APPEND y cada lote se escribe con un flock sobre
+    un archivo .lock, asi las lineas de uno y otro nunca se mezclan. La
+    rotacion (por tamano o por periodo de tiempo) se hace bajo ese mismo
+    flock y los demas procesos la detectan porque cambia el inodo.
+    """
+
+    def __init__(self, ruta, intervalo=0.05, durabilidad=DURABILIDAD_FLUSH,
+                 tamano_maximo=50 * 1024 * 1024, rotar_cada=None, respaldos=5,
+                 max_pendientes=100000, buffer_ninguna=64 * 1024, espera_ninguna=1.0):
+        if durabilidad not in DURABILIDADES:
+            raise ValueError(f"Durabilidad desconocida: {durabilidad}")
+        self.ruta = ruta
+        self.intervalo = intervalo
+        self.durabilidad = durabilidad
+        self.tamano_maximo = tamano_maximo
+        self.rotar_cada = rotar_cada
+        self.respaldos = respaldos
+        self.max_pendientes = max_pendientes
+        self.buffer_ninguna = buffer_ninguna
+        self.espera_ninguna = espera_ninguna
+
+        self._cola = collections.deque()
+        self._despertar = threading.Event()
+        self._vaciado = threading.Condition()
+        self._escritos = 0
+        self._encolados = 0
+        self._contador = itertools.count(1)
+        # Numerar y encolar van juntos: si no, _encolados podria quedar con el
+        # numero de una linea anterior a la ultima encolada y vaciar() no la esperaria
+        self._encolar_mutex = threading.Lock()
+        self._hilo = None
+        self._inicio_mutex = threading.Lock()
+        self._fd = None
+        self._acumulado = []
+        self._tamano_acumulado = 0
+        self._lineas_acumuladas = 0
+        self._lineas_en_escritura = 0
+        self._ultima_escritura = time.monotonic()
+        self.descartados = 0
+        self.lotes = 0
+        # Tiempo esperando el flock del archivo (lo tiene otro proceso escribiendo)
+        self.espera_lock = 0.0
+
+    def registrar(self, linea):
+        """Encola una linea ya formateada (con su salto de linea)"""
+        if self._hilo is None:
+            self._iniciar()
+        if len(self._cola) >= self.max_pendientes:
+            # Preferimos perder lineas a frenar a los hilos que atienden clientes
+            self.descartados += 1
+            return
+        with self._encolar_mutex:
+            self._cola.append(linea)
+            self._encolados = next(self._contador)
+
+    def vaciar(self, timeout=2.0):
+        """Espera a que todo lo encolado hasta ahora quede escrito en el archivo"""
+        if self._hilo is None:
+            return
+        objetivo = self._encolados
+        limite = time.monotonic() + timeout
+        with self._vaciado:
+            while self._escritos < objetivo and time.monotonic() < limite:
+                self._despertar.set()
+                self._vaciado.wait(self.intervalo * 2)
+
+    def despues_de_fork(self):
+        """Prepara el registro en un proceso recien creado con os.fork.
+
+        El hilo escritor quedo en el proceso padre (y con el los locks que
+        pudiera tener tomados): el hijo empieza con todo vacio y arranca su
+        propio escritor con la primera linea. Lo pendiente lo escribe el padre.
+        """
+        self._cola = collections.deque()
+        self._despertar = threading.Event()
+        self._vaciado = threading.Condition()
+        self._escritos = 0
+        self._encolados = 0
+        self._contador = itertools.count(1)
+        self._encolar_mutex = threading.Lock()
+        self._hilo = None
+        self._inicio_mutex = threading.Lock()
+        self._acumulado = []
+        self._tamano_acumulado = 0
+        self._lineas_acumuladas = 0
+        # Lineas del lote que se esta escribiendo (ya no estan en _acumulado)
+        self._lineas_en_escritura = 0
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _iniciar(self):
+        with self._inicio_mutex:
+            if self._hilo is not None:
+                return
+            self._hilo = threading.Thread(target=self._escritor, name="registro", daemon=True)
+            self._hilo.start()
+            atexit.register(self.vaciar)
+
+    def _escritor(self):
+        while True:
+            self._despertar.wait(self.intervalo)
+            forzar = self._despertar.is_set()
+            self._despertar.clear()
+            lineas = []
+            while True:
+                try:
+                    lineas.append(self._cola.popleft())
+                except IndexError:
+                    break
+            try:
+                escritas = self._escribir_lote(lineas, forzar)
+            except Exception as e:
+                print(f"Error al escribir el registro: {str(e)}")
+                # Las lineas del lote se pierden, pero no dejamos esperando a vaciar()
+                escritas = self._lineas_acumuladas + self._lineas_en_escritura
+                self._acumulado, self._tamano_acumulado, self._lineas_acumuladas = [], 0, 0
+                self._lineas_en_escritura = 0
+            if escritas:
+                with self._vaciado:
+                    self._escritos += escritas
+                    self._vaciado.notify_all()
+
+    def _escribir_lote(self, lineas, forzar):
+        """Escribe lo acumulado y devuelve cuantas lineas quedaron en el archivo"""
+        if lineas:
+            datos = "".join(lineas).encode("utf-8")
+            self._acumulado.append(datos)
+            self._tamano_acumulado += len(datos)
+            self._lineas_acumuladas += len(lineas)
+        if not self._acumulado:
+            return 0
+        if (self.durabilidad == DURABILIDAD_NINGUNA and not forzar
+                and self._tamano_acumulado < self.buffer_ninguna
+                and time.monotonic() - self._ultima_escritura < self.espera_ninguna):
+            return 0
+
+        datos = b"".join(self._acumulado)
+        escritas = self._lineas_en_escritura = self._lineas_acumuladas
+        self._acumulado = []
+        self._tamano_acumulado = 0
+        self._lineas_acumuladas = 0
+        self._ultima_escritura = time.monotonic()
+
+        os.makedirs(os.path.dirname(self.ruta), exist_ok=True)
+        with open(self.ruta + ".lock", "a") as lock:
+            inicio = time.perf_counter()
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.espera_lock += time.perf_counter() - inicio
+            try:
+                self._rotar_si_corresponde(len(datos))
+                vista = memoryview(datos)
+                while vista:
+                    escritos = os.write(self._fd, vista)
+                    vista = vista[escritos:]
+                if self.durabilidad == DURABILIDAD_FSYNC:
+                    os.fsync(self._fd)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self.lotes += 1
+        self._lineas_en_escritura = 0
+        return escritas
+
+    def estadisticas(self):
+        return {"pendientes": len(self._cola), "escritas": self._escritos, "lotes": self.lotes,
+                "descartados": self.descartados, "espera_lock": self.espera_lock}
+
+    def _abrir(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.ruta, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _rotar_si_corresponde(self, por_escribir):
+        """Se llama con el flock tomado"""
+        # Si otro proceso roto el archivo, nuestro descriptor apunta al viejo
+        try:
+            actual = os.stat(self.ruta)
+        except FileNotFoundError:
+            actual = None
+        if self._fd is None or actual is None or os.fstat(self._fd).st_ino != actual.st_ino:
+            self._abrir()
+            actual = os.fstat(self._fd)
+
+        rotar = False
+        if self.tamano_maximo and actual.st_size and actual.st_size + por_escribir > self.tamano_maximo:
+            rotar = True
+        if self.rotar_cada and actual.st_size:
+            # Si lo ultimo escrito es de un periodo anterior, empezamos archivo nuevo
+            rotar = rotar or int(actual.st_mtime // self.rotar_cada) != int(time.time() // self.rotar_cada)
+        if not rotar:
+            return
+
+        for i in range(self.respaldos - 1, 0, -1):
+            anterior = f"{self.ruta}.{i}"
+            if os.path.exists(anterior):
+                os.replace(anterior, f"{self.ruta}.{i + 1}")
+        if self.respaldos:
+            os.replace(self.ruta, f"{self.ruta}.1")
+        else:
+            os.remove(self.ruta)
+        self._abrir()
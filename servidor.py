@@ -1,12 +1,33 @@
+import argparse
+import collections.abc
+import io
 import os
 import socket
+import sys
 import threading
 import time
+import queue
 import shutil
 import datetime
+import json
 import logging
 from pathlib import Path
 
+import almacen
+import bloqueos
+import busqueda
+import cache_archivos
+import compresion
+import consulta_logs
+import delta
+import difusion
+import directorios
+import eventos
+import indice_directorio
+import metricas
+import protocolo
+import registro
+
 def obtener_ip_local():
     """Obtiene la IP local del equipo"""
     try:
@@ -28,213 +49,1084 @@ ENTRADA_DIR = os.path.join(BASE_DIR, "entrada")
 PROCESADOS_DIR = os.path.join(BASE_DIR, "procesados")
 LOGS_DIR = os.path.join(BASE_DIR, "logs")
 LOG_FILE = os.path.join(LOGS_DIR, "registro.log")
+# Aqui se arman las subidas antes de moverlas a entrada (mismo disco que entrada)
+TEMP_DIR = os.path.join(BASE_DIR, "temporales")
+# Blobs del almacen por contenido de procesados (solo con --deduplicar)
+BLOBS_DIR = os.path.join(BASE_DIR, "blobs")
+# Archivos de flock para los locks por archivo entre procesos (--modo procesos)
+LOCKS_DIR = os.path.join(BASE_DIR, "locks")
 MAX_CLIENTES = 5
+# Pool de hilos del servidor: cuantos clientes se atienden a la vez, cuantos
+# pueden esperar turno y cuanto tiempo puede estar inactiva una conexion
+HILOS_TRABAJADORES = 32
+COLA_CONEXIONES = 64
+TIMEOUT_INACTIVIDAD = 300
+REINTENTAR_EN = 5  # segundos que se le sugiere esperar a un cliente rechazado
+INTERVALO_REPORTE_POOL = 60
+# Log de operaciones: cada cuanto se escribe un lote, cuanto se asegura en
+# disco ("ninguna", "flush" o "fsync") y rotacion por tamano
+INTERVALO_LOG = 0.05
+DURABILIDAD_LOG = registro.DURABILIDAD_FLUSH
+TAMANO_MAXIMO_LOG = 50 * 1024 * 1024
+RESPALDOS_LOG = 5
+# Cada cuanto se revisa si hay lineas nuevas al seguir el log (LOGS con seguir=1)
+INTERVALO_SEGUIR = 0.5
+# Seguimientos (LOGS con seguir=1 y VIGILAR) abiertos a la vez; no ocupan
+# hilos del pool, los envia el difusor (ver difusion.py)
+MAX_SEGUIMIENTOS = difusion.MAXIMO
+# Cada cuanto se revisa si entrada/procesados cambiaron por fuera del servidor
+INTERVALO_INDICE = 1.0
+# Tamano maximo del payload de un comando que no es una transferencia
+MAX_PAYLOAD_COMANDO = protocolo.MAX_PAYLOAD_COMANDO
+# Cada cuanto se borran los blobs que ya no tienen ningun nombre en procesados
+INTERVALO_RECOLECCION = 600
+# Codecs que se aceptan al negociar la compresion de una conexion
+COMPRESIONES = compresion.CODECS
+# Memoria para el contenido de los archivos mas leidos (0 la desactiva) y
+# tamano desde el que se mapean con mmap en lugar de copiarse
+CACHE_PRESUPUESTO = cache_archivos.PRESUPUESTO
+CACHE_UMBRAL_MMAP = cache_archivos.UMBRAL_MMAP
+# Cambios de entrada y procesados que se guardan para los clientes de VIGILAR
+CAPACIDAD_EVENTOS = eventos.CAPACIDAD
+# Hilos que recorren archivos para BUSCAR (compartidos por todas las busquedas)
+# y memoria para su indice de trigramas (0 lo desactiva)
+HILOS_BUSQUEDA = busqueda.HILOS
+INDICE_BUSQUEDA_PRESUPUESTO = 0
+# Estado que el demonio escribe cada tanto (cola, en proceso, ritmo) para STATS
+ESTADO_DEMONIO = os.path.join(LOGS_DIR, "demonio.estado")
+# Si el estado tiene mas que esto, el demonio no esta corriendo
+ANTIGUEDAD_ESTADO_DEMONIO = 30
 
-# Sincronizacion de acceso a archivos y logs
-log_mutex = threading.Lock()
-files_mutex = threading.Lock()
+# Log de operaciones compartido con el demonio, escrito en segundo plano
+registro_log = registro.RegistroAsincrono(
+    LOG_FILE, intervalo=INTERVALO_LOG, durabilidad=DURABILIDAD_LOG,
+    tamano_maximo=TAMANO_MAXIMO_LOG, respaldos=RESPALDOS_LOG)
 
-def registrar_operacion(operacion):
-    """Registra una operacion en el archivo de log"""
-    with log_mutex:
-        # Asegurar que el directorio de logs existe
-        os.makedirs(LOGS_DIR, exist_ok=True)
-        
-        # Asegurar que el archivo de log existe
-        if not os.path.exists(LOG_FILE):
-            open(LOG_FILE, 'a').close()
-            
-        # Registrar la operacion
+# Contadores y latencias por comando, conexiones abiertas (ver STATS)
+metricas_servidor = metricas.Metricas()
+
+# Sincronizacion de acceso a archivos
+# Un lock de lectura/escritura por archivo: lecturas del mismo archivo van en
+# paralelo y escrituras a archivos distintos no compiten
+bloqueos_archivos = bloqueos.GestorBloqueos()
+
+# Contenido de los archivos mas leidos por LEER y DESCARGAR. None si se
+# desactivo con --cache-mb 0
+cache_contenido = cache_archivos.CacheArchivos(CACHE_PRESUPUESTO, CACHE_UMBRAL_MMAP)
+
+def invalidar_cache(ruta_archivo):
+    """Descarta de la cache una ruta que se acaba de reemplazar, mover o borrar"""
+    if cache_contenido is not None:
+        cache_contenido.invalidar(ruta_archivo)
+
+def crear_temporal(sufijo):
+    """Crea un archivo vacio en TEMP_DIR y devuelve (fd, ruta).
+
+    A diferencia de tempfile.mkstemp (0600) lo crea con los permisos que
+    daria open(): 0666 menos la umask, asi lo que se publica con os.replace
+    lo pueden leer el demonio y otros usuarios como antes.
+    """
+    while True:
+        ruta = os.path.join(TEMP_DIR, f"tmp{os.urandom(6).hex()}{sufijo}")
         try:
-            with open(LOG_FILE, 'a') as f:
-                timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                f.write(f"{timestamp} - {operacion}\n")
-            print(f"[LOG] {operacion}")
-        except Exception as e:
-            print(f"Error al registrar operacion: {str(e)}")
+            return os.open(ruta, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), ruta
+        except FileExistsError:
+            continue
+
+# Entrada y procesados pueden estar repartidos en subcarpetas por un hash del
+# nombre (ver directorios.py); los clientes siempre ven un solo nivel. Las
+# rutas se piden a estos objetos: ruta() para escribir, rutas() para buscar
+# y clave() para los locks
+directorio_entrada = directorios.Directorio(ENTRADA_DIR)
+directorio_procesados = directorios.Directorio(PROCESADOS_DIR)
+
+# Cambios de entrada y procesados numerados, para VIGILAR. Los publican los
+# indices de abajo: lo que sube o copia un cliente al instante, y lo que
+# aparece en el disco (el demonio procesando) al reconciliar
+eventos_archivos = eventos.AnilloEventos(CAPACIDAD_EVENTOS)
+
+# Contenido de entrada y procesados en memoria para LISTAR. Se actualiza con
+# lo que hace este servidor y se reconcilia con el disco (cambios del demonio)
+# revisando el mtime de cada directorio; lo que el demonio mueve o reemplaza
+# tambien sale de la cache.
+indice_entrada = indice_directorio.IndiceDirectorio(directorio_entrada, INTERVALO_INDICE, invalidar_cache,
+                                                    eventos_archivos.observador("entrada", "creado"))
+indice_procesados = indice_directorio.IndiceDirectorio(directorio_procesados, INTERVALO_INDICE, invalidar_cache,
+                                                       eventos_archivos.observador("procesados", "procesado"))
+INDICES_DIRECTORIOS = {"entrada": indice_entrada, "procesados": indice_procesados}
+
+# Busquedas de texto en entrada y procesados (BUSCAR). Con
+# --indice-busqueda-mb recuerda los trigramas de cada archivo leido para
+# saltar los que no pueden contener el texto
+buscador = busqueda.Buscador(HILOS_BUSQUEDA)
+
+# Almacen por contenido: cada contenido distinto se guarda una vez y los
+# nombres de procesados son hardlinks. None si no se activo --deduplicar
+almacen_procesados = None
+
+def registrar_operacion(operacion):
+    """Registra una operacion en el archivo de log.
+
+    Solo encola la linea: la escribe en lotes el hilo de registro_log, asi
+    que no frena al hilo que atiende al cliente.
+    """
+    timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    registro_log.registrar(f"{timestamp} - {operacion}\n")
+    print(f"[LOG] {operacion}")
 
 def manejar_cliente(socket_cliente, addr):
     """Maneja la conexion con un cliente"""
     direccion_cliente = f"{addr[0]}:{addr[1]}"
     registrar_operacion(f"Nueva conexion establecida: {direccion_cliente}")
+    protocolo.configurar_socket(socket_cliente)
+    conexion = protocolo.Conexion(socket_cliente)
+    metricas_servidor.conexion_abierta()
     
     try:
-        while True:
-            # Recibir comando del cliente
-            data = socket_cliente.recv(BUFFER_SIZE)
-            if not data:
-                break
-            
-            try:
-                # Decodificar el comando como texto simple
-                comando_completo = data.decode('utf-8').strip()
-                registrar_operacion(f"Comando recibido de {direccion_cliente}: {comando_completo}")
-                
-                # Dividir el comando en partes usando | como separador
-                partes = comando_completo.split('|')
-                comando = partes[0].upper()  # convertir a mayusculas para estandarizar
-                
-                # Procesar el comando
-                if comando == 'LISTAR':
-                    respuesta = manejar_comando_listar()
-                elif comando == 'COPIAR' and len(partes) > 1:
-                    nombre_archivo = partes[1]
-                    respuesta = manejar_comando_copiar(nombre_archivo)
-                elif comando == 'LEER' and len(partes) > 1:
-                    nombre_archivo = partes[1]
-                    respuesta = manejar_comando_leer(nombre_archivo)
-                elif comando == 'SUBIR' and len(partes) > 2:
-                    nombre_archivo = partes[1]
-                    # El contenido puede contener el caracter |, por lo que unimos el resto
-                    contenido = '|'.join(partes[2:])
-                    respuesta = manejar_comando_subir(nombre_archivo, contenido)
-                elif comando == 'DESCARGAR' and len(partes) > 1:
-                    nombre_archivo = partes[1]
-                    respuesta = manejar_comando_descargar(nombre_archivo)
-                elif comando == 'LOGS':
-                    respuesta = manejar_comando_logs()
-                else:
-                    respuesta = "Comando desconocido o formato incorrecto."
-                
-            except Exception as e:
-                respuesta = f"Error: {str(e)}"
-            
-            # Enviar respuesta al cliente
-            socket_cliente.sendall(respuesta.encode('utf-8'))
+        # Saludo: los clientes nuevos negocian el protocolo binario, los
+        # antiguos mandan directamente comandos de texto
+        version = protocolo.negociar_servidor(conexion)
+        if version:
+            registrar_operacion(f"Protocolo binario v{version} negociado con {direccion_cliente}")
+            atender_protocolo_binario(conexion, direccion_cliente)
+        else:
+            atender_protocolo_texto(conexion, direccion_cliente)
     
     except Exception as e:
         registrar_operacion(f"Error en la conexion con {direccion_cliente}: {str(e)}")
     finally:
-        socket_cliente.close()
-        registrar_operacion(f"Conexion cerrada: {direccion_cliente}")
+        soltar_conexion(conexion, direccion_cliente)
+
+def reanudar_cliente(conexion, direccion_cliente, cancelado):
+    """Sigue atendiendo una conexion que devolvio el difusor al terminar su flujo"""
+    try:
+        if cancelado:
+            # La trama con la que el cliente corto el flujo
+            conexion.recibir_trama(MAX_PAYLOAD_COMANDO)
+        atender_protocolo_binario(conexion, direccion_cliente)
+    except Exception as e:
+        registrar_operacion(f"Error en la conexion con {direccion_cliente}: {str(e)}")
+    finally:
+        soltar_conexion(conexion, direccion_cliente)
+
+def soltar_conexion(conexion, direccion_cliente):
+    """Pasa la conexion al difusor si quedo un seguimiento pendiente; si no, la cierra"""
+    if conexion.seguimiento is not None:
+        flujo, conexion.seguimiento = conexion.seguimiento, None
+        difusor_seguimientos.agregar(flujo)
+    else:
+        cerrar_conexion(conexion, direccion_cliente)
+
+def cerrar_conexion(conexion, direccion_cliente):
+    metricas_servidor.conexion_cerrada()
+    conexion.cerrar()
+    registrar_operacion(f"Conexion cerrada: {direccion_cliente}")
+
+# Seguimientos abiertos (cupo compartido por el difusor y el servidor
+# asyncio) y el hilo que envia los del pool. Las conexiones cuyo flujo
+# termina vuelven al pool (PoolConexiones.reanudar)
+cupo_seguimientos = difusion.Cupo(MAX_SEGUIMIENTOS)
+difusor_seguimientos = difusion.Difusor(INTERVALO_SEGUIR, TIMEOUT_INACTIVIDAD, cerrar_conexion, registrar_operacion)
+eventos_archivos.avisar = difusor_seguimientos.despertar
+
+def atender_protocolo_texto(conexion, direccion_cliente):
+    """Atiende comandos de texto separados por | (clientes antiguos)"""
+    while True:
+        # Recibir comando del cliente
+        data = conexion.recibir(BUFFER_SIZE)
+        if not data:
+            break
+        atender_comando_texto(conexion, direccion_cliente, data)
+
+def atender_comando_texto(conexion, direccion_cliente, data):
+    """Procesa un comando de texto ya recibido y envia la respuesta"""
+    comando = data.split(b'|', 1)[0].decode('utf-8', errors='replace').strip().upper()
+    with metricas_servidor.medir(comando if comando in COMANDOS_TEXTO else "desconocido", conexion):
+        procesar_comando_texto(conexion, direccion_cliente, data)
+
+def procesar_comando_texto(conexion, direccion_cliente, data):
+    nombre_archivo = None
+    try:
+        # Decodificar el comando como texto simple
+        comando_completo = data.decode('utf-8').strip()
+        registrar_operacion(f"Comando recibido de {direccion_cliente}: {comando_completo}")
+        
+        # Dividir el comando en partes usando | como separador
+        partes = comando_completo.split('|')
+        comando = partes[0].upper()  # convertir a mayusculas para estandarizar
+        nombre_archivo = partes[1] if len(partes) > 1 else None
+        # El contenido puede contener el caracter |, por lo que unimos el resto
+        contenido = '|'.join(partes[2:]).encode('utf-8') if len(partes) > 2 else None
+        
+        if comando == 'VIGILAR':
+            # Sin tramas no hay forma de que el cliente corte el flujo
+            respuesta = "Error: VIGILAR solo esta disponible en el protocolo binario."
+        else:
+            respuesta = ejecutar_comando(comando, nombre_archivo, contenido)
+        if isinstance(respuesta, difusion.Seguimiento):
+            respuesta.bloques.close()
+            respuesta = f"Error: {comando} con seguir=1 solo esta disponible en el protocolo binario."
+    
+    except Exception as e:
+        respuesta = f"Error: {str(e)}"
+    
+    # Enviar respuesta al cliente
+    if isinstance(respuesta, FlujoConInfo):
+        respuesta.cuerpo.close()
+        respuesta = f"Error: {comando} solo esta disponible en el protocolo binario."
+    if isinstance(respuesta, Tramo):
+        if respuesta.en_memoria():
+            conexion.enviar(respuesta.datos())
+            enviados = respuesta.largo
+        else:
+            with respuesta.archivo:
+                enviados = conexion.enviar_desde_archivo(respuesta.archivo, respuesta.desde, respuesta.largo)
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} ({enviados} bytes)")
+        return
+    if isinstance(respuesta, ContenidoEnCache):
+        conexion.enviar(respuesta.datos)
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} ({len(respuesta.datos)} bytes, cache)")
+        return
+    if isinstance(respuesta, io.IOBase):
+        with respuesta:
+            tamano = os.fstat(respuesta.fileno()).st_size
+            enviados = conexion.enviar_desde_archivo(respuesta, 0, tamano)
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} ({enviados} bytes)")
+        return
+    if isinstance(respuesta, collections.abc.Iterator):
+        for bloque in respuesta:
+            if bloque:
+                conexion.enviar(bloque)
+        return
+    if isinstance(respuesta, str):
+        if es_respuesta_error(respuesta):
+            conexion.errores_enviados += 1
+        respuesta = respuesta.encode('utf-8')
+    conexion.enviar(respuesta)
+
+def atender_protocolo_binario(conexion, direccion_cliente):
+    """Atiende tramas del protocolo binario"""
+    while True:
+        cabecera = conexion.recibir_cabecera()
+        if cabecera is None:
+            break
+        if not atender_comando_binario(conexion, direccion_cliente, cabecera):
+            break
 
-def manejar_comando_listar():
-    """Lista los archivos en el directorio de entrada"""
-    with files_mutex:
+def atender_comando_binario(conexion, direccion_cliente, cabecera):
+    """Procesa una trama cuya cabecera ya se leyo y envia la respuesta.
+
+    El payload todavia esta en el socket. Devuelve False si la conexion
+    quedo desincronizada y hay que cerrarla, o si la respuesta es un
+    seguimiento que queda en conexion.seguimiento para que lo envie otro
+    (el difusor o el event loop).
+    """
+    with metricas_servidor.medir(protocolo.COMANDOS.get(cabecera[0], "desconocido"), conexion):
+        return procesar_comando_binario(conexion, direccion_cliente, cabecera)
+
+def procesar_comando_binario(conexion, direccion_cliente, cabecera):
+    opcode, flags, nombre_archivo, largo_payload = cabecera
+    comando = protocolo.COMANDOS.get(opcode)
+    # Todas las tramas de la respuesta llevan el id de esta solicitud (protocolo v2)
+    conexion.id_solicitud = conexion.id_recibido
+    registrar_operacion(f"Comando recibido de {direccion_cliente}: {comando or hex(opcode)} {nombre_archivo}".rstrip())
+    
+    if comando in ('SUBIR', 'DELTA', 'SUBIR_LOTE'):
+        # El contenido se pasa del socket al disco por bloques
+        recibir = {'SUBIR': recibir_subida, 'DELTA': recibir_delta, 'SUBIR_LOTE': recibir_lote}[comando]
+        respuesta, completa = recibir(conexion, nombre_archivo, flags, largo_payload)
+        conexion.enviar_trama(protocolo.OP_ERROR if es_respuesta_error(respuesta) else protocolo.OP_OK,
+                              payload=respuesta.encode('utf-8'))
+        return completa
+    
+    if largo_payload > MAX_PAYLOAD_COMANDO:
+        raise protocolo.ErrorProtocolo(f"Payload demasiado grande para {comando}: {largo_payload} bytes")
+    payload = conexion.recibir_exacto(largo_payload) if largo_payload else b""
+    
+    if comando == 'DESCARGAR_LOTE':
+        enviar_lote(conexion, [n for n in payload.decode('utf-8').splitlines() if n])
+        return True
+    
+    if comando == 'COMPRESION':
+        conexion.compresion = compresion.elegir(protocolo.desempaquetar_info(payload), COMPRESIONES)
+        codec, nivel = conexion.compresion or ("ninguna", 0)
+        registrar_operacion(f"Compresion acordada con {direccion_cliente}: {codec} (nivel {nivel})")
+        conexion.enviar_trama(protocolo.OP_OK, payload=protocolo.empaquetar_info({"codec": codec, "nivel": nivel}))
+        return True
+    
+    try:
+        respuesta = ejecutar_comando(comando, nombre_archivo or None, payload)
+    except Exception as e:
+        respuesta = f"Error: {str(e)}"
+    
+    # Firmas para una subida por diferencias: los datos de la copia y despues las firmas
+    if isinstance(respuesta, FlujoConInfo):
+        conexion.enviar_trama(protocolo.OP_INFO, payload=protocolo.empaquetar_info(respuesta.info))
+        return conexion.enviar_flujo(respuesta.cuerpo)
+    
+    # Pedidos por rango: primero el tamano y el etag, despues solo ese tramo
+    if isinstance(respuesta, Tramo):
         try:
-            archivos = [f for f in os.listdir(ENTRADA_DIR) if os.path.isfile(os.path.join(ENTRADA_DIR, f))]
-            registrar_operacion(f"Cliente solicito listar archivos en entrada - {len(archivos)} archivos encontrados")
-            
-            if not archivos:
-                return "No hay archivos en el directorio de entrada."
-            
-            respuesta = ""
-            for archivo in archivos:
-                respuesta += f"{archivo}\n"
-            
-            return respuesta.strip() # Eliminar el salto de linea final
-        except Exception as e:
-            registrar_operacion(f"Error al listar archivos: {str(e)}")
-            return f"Error al listar archivos: {str(e)}"
+            conexion.enviar_trama(protocolo.OP_INFO, payload=protocolo.empaquetar_info(respuesta.info()))
+            if respuesta.en_memoria():
+                datos = respuesta.datos()
+                comprimir = (conexion.compresion is not None
+                             and compresion.conviene(nombre_archivo, datos[:compresion.MUESTRA], len(datos)))
+                enviados = conexion.enviar_contenido(datos, comprimir=comprimir)
+            else:
+                comprimir = conexion.conviene_comprimir(nombre_archivo, respuesta.archivo, respuesta.desde,
+                                                        respuesta.largo)
+                enviados = conexion.enviar_archivo(respuesta.archivo, respuesta.desde, respuesta.largo,
+                                                   comprimir=comprimir)
+        finally:
+            respuesta.cerrar()
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} "
+                            f"(bytes {respuesta.desde}-{respuesta.desde + enviados} de {respuesta.tamano})")
+        return True
+    
+    # Descarga de un archivo que ya estaba en la cache: se envia desde memoria
+    if isinstance(respuesta, ContenidoEnCache):
+        datos = respuesta.datos
+        comprimir = (conexion.compresion is not None
+                     and compresion.conviene(nombre_archivo, datos[:compresion.MUESTRA], len(datos)))
+        enviados = conexion.enviar_contenido(datos, comprimir=comprimir)
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} ({enviados} bytes, cache)")
+        return True
+    
+    # Las descargas se envian por partes directo desde el archivo (o
+    # comprimidas, si se negocio compresion y el archivo no lo esta ya)
+    if isinstance(respuesta, io.IOBase):
+        with respuesta:
+            enviados = conexion.enviar_archivo(respuesta, comprimir=conexion.conviene_comprimir(nombre_archivo, respuesta))
+        registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo} ({enviados} bytes)")
+        return True
+    
+    # Seguimientos: este hilo no se queda esperando lineas o eventos nuevos,
+    # el flujo lo envia el difusor (o el event loop en modo async)
+    if isinstance(respuesta, difusion.Seguimiento):
+        if not cupo_seguimientos.tomar():
+            respuesta.bloques.close()
+            conexion.enviar_trama(protocolo.OP_ERROR,
+                                  payload=protocolo.MENSAJE_OCUPADO.format(segundos=REINTENTAR_EN).encode('utf-8'))
+            return True
+        conexion.seguimiento = difusion.Flujo(conexion, direccion_cliente, respuesta.bloques, cupo_seguimientos)
+        return False
+    
+    # Respuestas generadas de a poco (consultas y busquedas)
+    if isinstance(respuesta, collections.abc.Iterator):
+        return conexion.enviar_flujo(respuesta, INTERVALO_SEGUIR, comprimir=True)
+    
+    # Los manejadores devuelven los errores como texto que empieza con "Error"
+    if isinstance(respuesta, str):
+        opcode_respuesta = protocolo.OP_ERROR if es_respuesta_error(respuesta) else protocolo.OP_OK
+        respuesta = respuesta.encode('utf-8')
+    else:
+        opcode_respuesta = protocolo.OP_OK
+    flags = 0
+    if (conexion.compresion is not None and opcode_respuesta == protocolo.OP_OK and comando == 'LEER'
+            and compresion.conviene(nombre_archivo, respuesta[:compresion.MUESTRA], len(respuesta))):
+        comprimida = compresion.comprimir_todo(*conexion.compresion, respuesta)
+        if len(comprimida) < len(respuesta):
+            respuesta, flags = comprimida, protocolo.FLAG_COMPRIMIDO
+    conexion.enviar_trama(opcode_respuesta, payload=respuesta, flags=flags)
+    return True
+
+def es_respuesta_error(respuesta):
+    return respuesta.startswith("Error") or respuesta.startswith("Comando desconocido")
+
+def ejecutar_comando(comando, nombre_archivo, contenido):
+    """Ejecuta un comando ya decodificado.
+
+    La respuesta puede ser texto, bytes o un archivo abierto para enviar.
+    """
+    if comando == 'LISTAR':
+        return manejar_comando_listar(contenido.decode('utf-8') if contenido else None)
+    elif comando == 'COPIAR' and nombre_archivo is not None:
+        return manejar_comando_copiar(nombre_archivo)
+    elif comando == 'LEER' and nombre_archivo is not None:
+        return manejar_comando_leer(nombre_archivo, contenido.decode('utf-8') if contenido else None)
+    elif comando == 'SUBIR' and nombre_archivo is not None and contenido is not None:
+        return manejar_comando_subir(nombre_archivo, contenido)
+    elif comando == 'DESCARGAR' and nombre_archivo is not None:
+        return manejar_comando_descargar(nombre_archivo, contenido.decode('utf-8') if contenido else None)
+    elif comando == 'LOGS':
+        return manejar_comando_logs(contenido.decode('utf-8') if contenido else None)
+    elif comando == 'FIRMAS' and nombre_archivo is not None:
+        return manejar_comando_firmas(nombre_archivo, contenido.decode('utf-8') if contenido else None)
+    elif comando == 'STATS':
+        return manejar_comando_stats(contenido.decode('utf-8') if contenido else None)
+    elif comando == 'BUSCAR':
+        return manejar_comando_buscar(contenido.decode('utf-8') if contenido else None)
+    elif comando == 'VIGILAR':
+        return manejar_comando_vigilar(contenido.decode('utf-8') if contenido else None)
+    return "Comando desconocido o formato incorrecto."
+
+# Comandos que se pueden mandar como texto (los de metricas.medir)
+COMANDOS_TEXTO = ('LISTAR', 'COPIAR', 'LEER', 'SUBIR', 'DESCARGAR', 'LOGS', 'FIRMAS', 'STATS', 'BUSCAR')
+
+def parsear_opciones_listar(texto):
+    """Opciones de LISTAR ("clave=valor", una por linea)"""
+    opciones = {"directorio": "entrada", "patron": None, "orden": "nombre",
+                "desc": False, "desde": 0, "limite": None, "detalle": False}
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        clave, _, valor = linea.partition("=")
+        clave, valor = clave.strip(), valor.strip()
+        if clave not in opciones:
+            raise ValueError(f"Opcion desconocida: {clave}")
+        if clave in ("desde", "limite"):
+            valor = int(valor)
+            if valor < 0:
+                raise ValueError(f"{clave} no puede ser negativo")
+        elif clave in ("desc", "detalle"):
+            valor = valor.lower() in ("1", "si", "true")
+        elif clave == "directorio" and valor not in INDICES_DIRECTORIOS:
+            raise ValueError(f"Directorio desconocido: {valor}")
+        elif clave == "orden" and valor not in indice_directorio.ORDENES:
+            raise ValueError(f"Orden desconocido: {valor}")
+        opciones[clave] = valor
+    return opciones
+
+def manejar_comando_listar(opciones_texto=None):
+    """Lista los archivos en el directorio de entrada (o procesados).
+
+    Se responde desde el indice en memoria, sin recorrer el disco. Opciones:
+    directorio=entrada|procesados, patron=*.txt, orden=nombre|tamano|mtime,
+    desc=1, desde=N, limite=N y detalle=1 para incluir tamano y fecha.
+    """
+    try:
+        opciones = parsear_opciones_listar(opciones_texto or "")
+        indice = INDICES_DIRECTORIOS[opciones["directorio"]]
+        archivos, total = indice.listar(opciones["patron"], opciones["orden"], opciones["desc"],
+                                        opciones["desde"], opciones["limite"])
+        registrar_operacion(f"Cliente solicito listar archivos en {opciones['directorio']} - {total} archivos encontrados")
+        
+        if not archivos:
+            if total:
+                return f"No hay mas archivos (total: {total})."
+            return f"No hay archivos en el directorio de {opciones['directorio']}."
+        
+        if opciones["detalle"]:
+            return "\n".join(
+                f"{nombre}\t{tamano}\t{datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M:%S')}"
+                for nombre, tamano, mtime in archivos)
+        return "\n".join(nombre for nombre, _, _ in archivos)
+    except ValueError as e:
+        return f"Error en las opciones de listar: {str(e)}"
+    except Exception as e:
+        registrar_operacion(f"Error al listar archivos: {str(e)}")
+        return f"Error al listar archivos: {str(e)}"
+
+def abrir_para_lectura(nombre_archivo, directorios=None):
+    """Busca el archivo (en entrada primero, luego en procesados) y lo abre.
+
+    Solo se toma el lock de lectura de cada ruta mientras se resuelve y se
+    abre; despues el descriptor sigue apuntando al mismo contenido aunque el
+    archivo se reemplace o el demonio lo mueva. Devuelve None si no existe.
+    """
+    for directorio in directorios or (directorio_entrada, directorio_procesados):
+        with bloqueos_archivos.lectura(directorio.clave(nombre_archivo)):
+            for ruta_archivo in directorio.rutas(nombre_archivo):
+                try:
+                    return open(ruta_archivo, 'rb')
+                except (FileNotFoundError, IsADirectoryError):
+                    continue
+    return None
+
+def leer_contenido(nombre_archivo):
+    """Contenido de un archivo para LEER y DESCARGAR, pasando por la cache.
+
+    Devuelve (contenido, estado): el contenido es bytes o un mmap (ver
+    cache_archivos) si el archivo cabe en la cache, o el archivo abierto si
+    no cabe (o no hay cache); estado es su stat. None si no existe. Como en
+    abrir_para_lectura, el lock solo se toma para resolver la ruta.
+    """
+    if cache_contenido is None:
+        archivo = abrir_para_lectura(nombre_archivo)
+        return (archivo, os.fstat(archivo.fileno())) if archivo is not None else None
+    for directorio in (directorio_entrada, directorio_procesados):
+        archivo = None
+        with bloqueos_archivos.lectura(directorio.clave(nombre_archivo)):
+            for ruta_archivo in directorio.rutas(nombre_archivo):
+                try:
+                    encontrado = cache_contenido.obtener(ruta_archivo)
+                    if encontrado is not None:
+                        return encontrado
+                    archivo = open(ruta_archivo, 'rb')
+                    break
+                except (FileNotFoundError, IsADirectoryError):
+                    continue
+        if archivo is None:
+            continue
+        try:
+            encontrado = cache_contenido.leer(archivo, ruta_archivo)
+            if encontrado is None:
+                return archivo, os.fstat(archivo.fileno())
+        except Exception:
+            archivo.close()
+            raise
+        archivo.close()
+        return encontrado
+    return None
+
+class ContenidoEnCache:
+    """Respuesta de DESCARGAR con el archivo completo ya en la cache (bytes o mmap)"""
+    
+    def __init__(self, datos):
+        self.datos = datos
+
+def error_nombre_reservado(nombre_archivo):
+    """Mensaje de error si el nombre es de un archivo de control (la marca de reparto), o None"""
+    if directorios.es_interno(nombre_archivo):
+        return f"Error: El nombre '{nombre_archivo}' esta reservado por el servidor."
+    return None
 
 def manejar_comando_copiar(nombre_archivo):
     """Copia un archivo de entrada a procesados"""
-    with files_mutex:
-        try:
-            ruta_origen = os.path.join(ENTRADA_DIR, nombre_archivo)
-            ruta_destino = os.path.join(PROCESADOS_DIR, nombre_archivo)
-            
-            if not os.path.exists(ruta_origen):
-                return f"Error: El archivo '{nombre_archivo}' no fue encontrado en el directorio de entrada."
-            
-            # Asegurar que el directorio de procesados existe
-            os.makedirs(PROCESADOS_DIR, exist_ok=True)
+    ruta_temporal = None
+    try:
+        error = error_nombre_reservado(nombre_archivo)
+        if error:
+            return error
+        origen = abrir_para_lectura(nombre_archivo, (directorio_entrada,))
+        if origen is None:
+            return f"Error: El archivo '{nombre_archivo}' no fue encontrado en el directorio de entrada."
+        ruta_origen = origen.name
+        ruta_destino = directorio_procesados.ruta(nombre_archivo)
+        clave_destino = directorio_procesados.clave(nombre_archivo)
+        
+        # Asegurar que el directorio de procesados existe
+        directorio_procesados.crear()
+        
+        with origen:
+            # Si ya conocemos el contenido y esta en el almacen, basta con un enlace
+            suma = almacen_procesados.suma_conocida(ruta_origen) if almacen_procesados else None
+            if suma is not None:
+                with bloqueos_archivos.escritura(clave_destino):
+                    deduplicado = almacen_procesados.enlazar(suma, ruta_destino)
+                    invalidar_cache(ruta_destino)
+                if deduplicado:
+                    indice_procesados.actualizar(nombre_archivo, "copiado")
+                    registrar_operacion(f"Archivo copiado: {nombre_archivo} (entrada -> procesados, enlace)")
+                    return f"Archivo '{nombre_archivo}' copiado exitosamente al directorio procesados."
             
-            shutil.copy2(ruta_origen, ruta_destino)
-            registrar_operacion(f"Archivo copiado: {nombre_archivo} (entrada -> procesados)")
-            return f"Archivo '{nombre_archivo}' copiado exitosamente al directorio procesados."
+            # Copiamos a un temporal sin bloquear a nadie y solo tomamos el lock
+            # de escritura del destino para reemplazarlo
+            fd, ruta_temporal = crear_temporal('.copiando')
+            with os.fdopen(fd, 'wb') as destino:
+                if almacen_procesados:
+                    suma = almacen.copiar_con_suma(origen, destino)
+                else:
+                    shutil.copyfileobj(origen, destino, protocolo.BLOQUE_TRANSFERENCIA)
+            shutil.copystat(ruta_origen, ruta_temporal)
+        with bloqueos_archivos.escritura(clave_destino):
+            if almacen_procesados:
+                almacen_procesados.guardar(ruta_temporal, ruta_destino, suma)
+                almacen_procesados.recordar(ruta_origen, suma)
+            else:
+                os.replace(ruta_temporal, ruta_destino)
+            invalidar_cache(ruta_destino)
+        ruta_temporal = None
+        indice_procesados.actualizar(nombre_archivo, "copiado")
         
-        except Exception as e:
-            registrar_operacion(f"Error al copiar archivo {nombre_archivo}: {str(e)}")
-            return f"Error al copiar archivo: {str(e)}"
+        registrar_operacion(f"Archivo copiado: {nombre_archivo} (entrada -> procesados)")
+        return f"Archivo '{nombre_archivo}' copiado exitosamente al directorio procesados."
+    
+    except Exception as e:
+        registrar_operacion(f"Error al copiar archivo {nombre_archivo}: {str(e)}")
+        return f"Error al copiar archivo: {str(e)}"
+    finally:
+        if ruta_temporal and os.path.exists(ruta_temporal):
+            os.remove(ruta_temporal)
 
-def manejar_comando_leer(nombre_archivo):
-    """Lee el contenido de un archivo"""
-    with files_mutex:
-        try:
-            ruta_archivo = os.path.join(ENTRADA_DIR, nombre_archivo)
-            
-            if not os.path.exists(ruta_archivo):
-                ruta_archivo = os.path.join(PROCESADOS_DIR, nombre_archivo)
-                if not os.path.exists(ruta_archivo):
-                    return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
-            
-            with open(ruta_archivo, 'r') as f:
-                contenido = f.read()
-            
-            registrar_operacion(f"Contenido leido: {nombre_archivo}")
-            return contenido
+def manejar_comando_leer(nombre_archivo, opciones_texto=None):
+    """Lee el contenido de un archivo.
+
+    Con opciones (desde=N, largo=N, si_coincide=etag) devuelve solo ese
+    tramo, precedido del tamano y el etag del archivo.
+    """
+    try:
+        if opciones_texto is not None:
+            return abrir_tramo(nombre_archivo, opciones_texto)
         
-        except Exception as e:
-            registrar_operacion(f"Error al leer archivo {nombre_archivo}: {str(e)}")
-            return f"Error al leer archivo: {str(e)}"
+        encontrado = leer_contenido(nombre_archivo)
+        if encontrado is None:
+            return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
+        
+        contenido, _ = encontrado
+        if isinstance(contenido, io.IOBase):
+            with contenido:
+                contenido = contenido.read()
+        
+        registrar_operacion(f"Contenido leido: {nombre_archivo}")
+        return contenido
+    
+    except Exception as e:
+        registrar_operacion(f"Error al leer archivo {nombre_archivo}: {str(e)}")
+        return f"Error al leer archivo: {str(e)}"
+
+class Tramo:
+    """Parte de un archivo que se envia precedida de un OP_INFO.
+
+    archivo es el archivo abierto o, si estaba en la cache, su contenido
+    (bytes o mmap).
+    """
+    
+    def __init__(self, archivo, desde, largo, tamano, etag):
+        self.archivo = archivo
+        self.desde = desde
+        self.largo = largo
+        self.tamano = tamano
+        self.etag = etag
+    
+    def en_memoria(self):
+        return not isinstance(self.archivo, io.IOBase)
+    
+    def datos(self):
+        """El tramo de un contenido en memoria, sin copiarlo"""
+        return memoryview(self.archivo)[self.desde:self.desde + self.largo]
+    
+    def cerrar(self):
+        if not self.en_memoria():
+            self.archivo.close()
+    
+    def info(self):
+        return {"tamano": self.tamano, "etag": self.etag, "desde": self.desde, "largo": self.largo}
+
+def calcular_etag(estado):
+    """Identifica una version de un archivo: cambia si se reemplaza o modifica"""
+    return f"{estado.st_ino:x}-{estado.st_size:x}-{estado.st_mtime_ns:x}"
+
+def parsear_opciones_rango(texto):
+    """Opciones de LEER y DESCARGAR por rango ("clave=valor", una por linea)"""
+    opciones = {"desde": 0, "largo": None, "si_coincide": None}
+    for linea in texto.splitlines():
+        if not linea.strip():
+            continue
+        clave, _, valor = linea.partition("=")
+        clave, valor = clave.strip(), valor.strip()
+        if clave not in opciones:
+            raise ValueError(f"Opcion desconocida: {clave}")
+        if clave in ("desde", "largo"):
+            valor = int(valor)
+            if valor < 0:
+                raise ValueError(f"{clave} no puede ser negativo")
+        opciones[clave] = valor
+    return opciones
+
+def abrir_tramo(nombre_archivo, opciones_texto):
+    """Abre el tramo pedido de un archivo.
+
+    Si viene si_coincide y el archivo ya no es esa version, se envia
+    completo desde el byte 0: el cliente lo ve en el OP_INFO y descarta lo
+    que tenia.
+    """
+    try:
+        opciones = parsear_opciones_rango(opciones_texto)
+    except ValueError as e:
+        return f"Error en las opciones del rango: {str(e)}"
+    encontrado = leer_contenido(nombre_archivo)
+    if encontrado is None:
+        return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
+    
+    archivo, estado = encontrado
+    etag = calcular_etag(estado)
+    desde, largo = opciones["desde"], opciones["largo"]
+    if opciones["si_coincide"] is not None and opciones["si_coincide"] != etag:
+        desde, largo = 0, None
+    if desde > estado.st_size:
+        if isinstance(archivo, io.IOBase):
+            archivo.close()
+        return f"Error: El rango empieza en el byte {desde} pero el archivo tiene {estado.st_size} bytes."
+    disponibles = estado.st_size - desde
+    largo = disponibles if largo is None else min(largo, disponibles)
+    return Tramo(archivo, desde, largo, estado.st_size, etag)
+
+class FlujoConInfo:
+    """Respuesta por partes (un generador de bytes) precedida de un OP_INFO"""
+    
+    def __init__(self, info, cuerpo):
+        self.info = info
+        self.cuerpo = cuerpo
+
+def manejar_comando_firmas(nombre_archivo, opciones_texto=None):
+    """Firmas de los bloques de la copia que tiene el servidor de un archivo.
+
+    Es el primer paso de una subida por diferencias (ver delta.py). Se usa la
+    misma copia que leeria DESCARGAR (entrada primero, luego procesados); el
+    OP_INFO lleva su tamano, su etag y el tamano de bloque. Con la opcion
+    bloque=N se puede pedir otro tamano de bloque.
+    """
+    try:
+        bloque = None
+        for linea in (opciones_texto or "").splitlines():
+            clave, _, valor = linea.partition("=")
+            if clave.strip() != "bloque":
+                return f"Error en las opciones de firmas: opcion desconocida {clave.strip()}"
+            bloque = int(valor)
+            if not delta.BLOQUE_MINIMO <= bloque <= delta.BLOQUE_MAXIMO:
+                return (f"Error en las opciones de firmas: el bloque debe estar entre "
+                        f"{delta.BLOQUE_MINIMO} y {delta.BLOQUE_MAXIMO} bytes")
+        archivo = abrir_para_lectura(nombre_archivo)
+        if archivo is None:
+            return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
+        estado = os.fstat(archivo.fileno())
+        bloque = bloque or delta.tamano_bloque(estado.st_size)
+        
+        def generar():
+            with archivo:
+                yield from delta.firmas(archivo, bloque)
+        
+        registrar_operacion(f"Firmas enviadas: {nombre_archivo} ({-(-estado.st_size // bloque)} bloques de {bloque} bytes)")
+        return FlujoConInfo({"tamano": estado.st_size, "etag": calcular_etag(estado), "bloque": bloque}, generar())
+    
+    except Exception as e:
+        registrar_operacion(f"Error al calcular firmas de {nombre_archivo}: {str(e)}")
+        return f"Error al calcular firmas: {str(e)}"
 
 def manejar_comando_subir(nombre_archivo, contenido):
-    """Recibe un archivo del cliente y lo guarda en entrada"""
-    with files_mutex:
-        try:
-            # Asegurar que el directorio de entrada existe
-            os.makedirs(ENTRADA_DIR, exist_ok=True)
-            
-            ruta_archivo = os.path.join(ENTRADA_DIR, nombre_archivo)
-            with open(ruta_archivo, 'w') as f:
-                f.write(contenido)
-            
-            registrar_operacion(f"Archivo recibido del cliente: {nombre_archivo}")
-            return f"Archivo '{nombre_archivo}' recibido y guardado correctamente."
+    """Recibe un archivo del cliente y lo guarda en entrada.
+
+    contenido puede ser bytes o una funcion que escribe los datos en el
+    archivo que se le pasa (para recibirlos por partes desde el socket).
+    El archivo se arma en TEMP_DIR, fuera de la vista del demonio, y solo
+    cuando esta completo y en disco se mueve a entrada con os.replace.
+    """
+    ruta_temporal = None
+    try:
+        # Asegurar que los directorios existen
+        directorio_entrada.crear()
+        os.makedirs(TEMP_DIR, exist_ok=True)
         
-        except Exception as e:
-            registrar_operacion(f"Error al guardar archivo {nombre_archivo}: {str(e)}")
-            return f"Error al guardar archivo: {str(e)}"
+        fd, ruta_temporal = crear_temporal('.subiendo')
+        with os.fdopen(fd, 'wb') as f:
+            # Con el almacen activo la suma se calcula mientras llegan los
+            # datos, asi un COPIAR posterior no tiene que leer el archivo
+            escritura = almacen.EscrituraConSuma(f) if almacen_procesados else f
+            if callable(contenido):
+                contenido(escritura)
+            else:
+                escritura.write(contenido)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        # Se rechaza recien aca para leer igual lo que mando el cliente
+        # (la conexion sigue sincronizada); el temporal se borra abajo
+        error = error_nombre_reservado(nombre_archivo)
+        if error:
+            return error
+        ruta_archivo = directorio_entrada.ruta(nombre_archivo)
+        with bloqueos_archivos.escritura(directorio_entrada.clave(nombre_archivo)):
+            os.replace(ruta_temporal, ruta_archivo)
+            invalidar_cache(ruta_archivo)
+        ruta_temporal = None
+        if almacen_procesados:
+            almacen_procesados.recordar(ruta_archivo, escritura.hexdigest())
+        indice_entrada.actualizar(nombre_archivo, "subido")
+        
+        registrar_operacion(f"Archivo recibido del cliente: {nombre_archivo}")
+        return f"Archivo '{nombre_archivo}' recibido y guardado correctamente."
+    
+    except Exception as e:
+        registrar_operacion(f"Error al guardar archivo {nombre_archivo}: {str(e)}")
+        return f"Error al guardar archivo: {str(e)}"
+    finally:
+        if ruta_temporal and os.path.exists(ruta_temporal):
+            os.remove(ruta_temporal)
 
-def manejar_comando_descargar(nombre_archivo):
-    """Prepara un archivo para enviar al cliente"""
-    with files_mutex:
-        try:
-            # Buscar en entrada primero, luego en procesados
-            ruta_archivo = os.path.join(ENTRADA_DIR, nombre_archivo)
-            if not os.path.exists(ruta_archivo):
-                ruta_archivo = os.path.join(PROCESADOS_DIR, nombre_archivo)
-                if not os.path.exists(ruta_archivo):
-                    return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
-            
-            with open(ruta_archivo, 'r') as f:
-                contenido = f.read()
-            
-            registrar_operacion(f"Archivo enviado al cliente: {nombre_archivo}")
+def recibir_subida(conexion, nombre_archivo, flags, largo_payload, reconstructor=None):
+    """Guarda el contenido de un SUBIR binario leyendolo del socket por bloques.
+
+    El contenido viene en el payload de la trama o, con FLAG_POR_PARTES, en
+    tramas OP_DATOS hasta OP_FIN. Devuelve (respuesta, completa): completa es
+    False si no se alcanzo a leer todo lo que mando el cliente, y entonces la
+    conexion ya no esta sincronizada. Con un reconstructor lo que llega es un
+    delta y lo que se escribe es el archivo que arma.
+    """
+    completa = False
+    
+    def escribir(f):
+        nonlocal completa
+        if reconstructor is not None:
+            reconstructor.salida, f = f, reconstructor
+        if flags & protocolo.FLAG_POR_PARTES:
+            ok, datos = conexion.recibir_archivo(f)
+            completa = True
+            if not ok:
+                raise Exception(f"Subida cancelada por el cliente: {datos.decode('utf-8', errors='replace')}")
+        else:
+            conexion.recibir_hacia_archivo(f, largo_payload)
+            completa = True
+        if reconstructor is not None:
+            reconstructor.terminar()
+    
+    respuesta = manejar_comando_subir(nombre_archivo, escribir)
+    return respuesta, completa
+
+def recibir_delta(conexion, nombre_archivo, flags, largo_payload):
+    """Recibe una subida por diferencias (OP_DELTA) y la guarda como un SUBIR.
+
+    El archivo nuevo se arma con los bloques de la copia que ya tiene el
+    servidor y los datos nuevos que manda el cliente, en TEMP_DIR como
+    cualquier subida, y solo si su SHA-256 coincide con el del cliente
+    reemplaza al de entrada. Si la copia cambio desde que se pidieron las
+    firmas se responde con un error y el cliente sube el archivo completo.
+    """
+    base = abrir_para_lectura(nombre_archivo)
+    try:
+        etag = calcular_etag(os.fstat(base.fileno())) if base is not None else None
+        reconstructor = delta.Reconstructor(base, etag, None)
+        respuesta, completa = recibir_subida(conexion, nombre_archivo, flags, largo_payload, reconstructor)
+    finally:
+        if base is not None:
+            base.close()
+    if not es_respuesta_error(respuesta):
+        registrar_operacion(f"Subida por diferencias: {nombre_archivo} ({reconstructor.copiados} bytes reutilizados, "
+                            f"{reconstructor.escritos - reconstructor.copiados} bytes nuevos)")
+    return respuesta, completa
+
+def manejar_comando_descargar(nombre_archivo, opciones_texto=None):
+    """Abre un archivo para enviarlo al cliente.
+
+    Devuelve el archivo abierto en binario; el envio lo hace quien atiende la
+    conexion, sin ningun lock tomado, directo del descriptor al socket. Si el
+    archivo esta (o entra) en la cache devuelve un ContenidoEnCache. Con
+    opciones de rango devuelve un Tramo (para retomar descargas cortadas o
+    bajar partes en paralelo).
+    """
+    try:
+        if opciones_texto is not None:
+            return abrir_tramo(nombre_archivo, opciones_texto)
+        encontrado = leer_contenido(nombre_archivo)
+        if encontrado is None:
+            return f"Error: El archivo '{nombre_archivo}' no fue encontrado."
+        contenido, _ = encontrado
+        if isinstance(contenido, io.IOBase):
             return contenido
+        return ContenidoEnCache(contenido)
+    
+    except Exception as e:
+        registrar_operacion(f"Error al enviar archivo {nombre_archivo}: {str(e)}")
+        return f"Error al enviar archivo: {str(e)}"
+
+def recibir_lote(conexion, nombre_archivo, flags, largo_payload):
+    """Recibe varios archivos en una sola solicitud (SUBIR_LOTE) y los guarda en entrada.
+
+    Cada archivo llega como un OP_INFO con su nombre, sus OP_DATOS y un
+    OP_FIN; un OP_FIN suelto cierra el lote. Se arman todos en TEMP_DIR, se
+    sincronizan a disco y recien entonces se mueven a entrada: los fsync
+    seguidos salen casi gratis porque el primero ya vacia el journal con
+    todo lo pendiente. Devuelve (respuesta, completa) como recibir_subida.
+    """
+    if not flags & protocolo.FLAG_POR_PARTES:
+        conexion.recibir_hacia_archivo(io.BytesIO(), largo_payload)
+        return "Error: SUBIR_LOTE se envia por partes.", True
+    recibidos = []  # (nombre, ruta temporal, suma)
+    actual = None  # (nombre, ruta temporal, archivo, escritura)
+    completa = False
+    try:
+        directorio_entrada.crear()
+        os.makedirs(TEMP_DIR, exist_ok=True)
+        while True:
+            cabecera = conexion.recibir_cabecera()
+            if cabecera is None:
+                raise ConnectionError("El cliente cerro la conexion a mitad del lote")
+            opcode, _, nombre, largo = cabecera
+            if opcode == protocolo.OP_INFO and actual is None:
+                conexion.recibir_exacto(largo)
+                if not nombre:
+                    raise protocolo.ErrorProtocolo("Archivo del lote sin nombre")
+                fd, ruta_temporal = crear_temporal('.subiendo')
+                archivo = os.fdopen(fd, 'wb')
+                actual = (nombre, ruta_temporal, archivo,
+                          almacen.EscrituraConSuma(archivo) if almacen_procesados else archivo)
+            elif opcode == protocolo.OP_DATOS and actual is not None:
+                conexion.recibir_hacia_archivo(actual[3], largo)
+            elif opcode == protocolo.OP_FIN:
+                conexion.recibir_exacto(largo)
+                if actual is None:
+                    break
+                actual[2].close()
+                recibidos.append((actual[0], actual[1], actual[3].hexdigest() if almacen_procesados else None))
+                actual = None
+            elif opcode == protocolo.OP_ERROR:
+                mensaje = conexion.recibir_exacto(largo).decode('utf-8', errors='replace')
+                completa = True
+                raise Exception(f"Lote cancelado por el cliente: {mensaje}")
+            else:
+                raise protocolo.ErrorProtocolo(f"Trama inesperada en un lote: {hex(opcode)}")
+        completa = True
         
-        except Exception as e:
-            registrar_operacion(f"Error al enviar archivo {nombre_archivo}: {str(e)}")
-            return f"Error al enviar archivo: {str(e)}"
+        # Si alguno tiene un nombre reservado no se guarda ninguno
+        for nombre, _, _ in recibidos:
+            error = error_nombre_reservado(nombre)
+            if error:
+                registrar_operacion(f"Lote rechazado: nombre reservado {nombre}")
+                return error, completa
+        for _, ruta_temporal, _ in recibidos:
+            fd = os.open(ruta_temporal, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for nombre, ruta_temporal, suma in recibidos:
+            ruta_archivo = directorio_entrada.ruta(nombre)
+            with bloqueos_archivos.escritura(directorio_entrada.clave(nombre)):
+                os.replace(ruta_temporal, ruta_archivo)
+                invalidar_cache(ruta_archivo)
+            if suma is not None:
+                almacen_procesados.recordar(ruta_archivo, suma)
+            indice_entrada.actualizar(nombre, "subido")
+        
+        registrar_operacion(f"Lote recibido del cliente: {len(recibidos)} archivos")
+        return f"Lote recibido: {len(recibidos)} archivos guardados en entrada.", completa
+    
+    except Exception as e:
+        registrar_operacion(f"Error al recibir lote: {str(e)}")
+        return f"Error al recibir lote: {str(e)}", completa
+    finally:
+        if actual is not None:
+            actual[2].close()
+            recibidos.append(actual[:2] + (None,))
+        for _, ruta_temporal, _ in recibidos:
+            if os.path.exists(ruta_temporal):
+                os.remove(ruta_temporal)
 
-def manejar_comando_logs():
-    """Envia el contenido del archivo de log"""
+def enviar_lote(conexion, nombres):
+    """Envia varios archivos en una sola respuesta (DESCARGAR_LOTE).
+
+    Cada archivo va como un OP_INFO con su nombre y su tamano, sus OP_DATOS
+    y un OP_FIN; los que no estan van como un OP_ERROR con su nombre. Cierra
+    un OP_OK con el resumen. Las tramas de los archivos chicos se juntan,
+    asi miles de archivos chicos cuestan lo que pesan y no una ida y vuelta
+    cada uno.
+    """
+    envio = protocolo.EnvioAgrupado(conexion)
+    enviados = errores = total = 0
+    for nombre in nombres:
+        archivo = abrir_para_lectura(nombre)
+        if archivo is None:
+            errores += 1
+            envio.agregar(protocolo.OP_ERROR, nombre,
+                          f"Error: El archivo '{nombre}' no fue encontrado.".encode('utf-8'))
+            continue
+        with archivo:
+            total += envio.agregar_archivo(nombre, archivo)
+        enviados += 1
+    
+    resumen = {"enviados": enviados, "errores": errores, "bytes": total}
+    envio.agregar(protocolo.OP_OK, payload=protocolo.empaquetar_info(resumen))
+    envio.vaciar()
+    registrar_operacion(f"Lote enviado al cliente: {enviados} archivos ({total} bytes), {errores} no encontrados")
+
+def manejar_comando_logs(opciones_texto=None):
+    """Envia el archivo de log o las lineas que pide una consulta.
+
+    Sin opciones devuelve el archivo completo (se envia por partes con
+    sendfile). Con opciones ("clave=valor", una por linea) devuelve un
+    generador de bloques: ultimas=N, desde_byte=B, desde_linea=L, limite=N,
+    desde/hasta=AAAA-MM-DD HH:MM:SS, contiene=texto y seguir=1 para quedarse
+    enviando las lineas nuevas a medida que se escriben (como Seguimiento,
+    ver difusion.py).
+    """
     try:
         # Asegurar que el archivo de log existe
         if not os.path.exists(LOG_FILE):
             registrar_operacion("Cliente solicitó logs pero el archivo no existe")
             return "El archivo de registro no existe."
-            
-        with log_mutex:
-            with open(LOG_FILE, 'r', encoding='utf-8') as f:
-                contenido = f.read()
         
-        if not contenido.strip():
+        # Que aparezca todo lo registrado hasta ahora
+        registro_log.vaciar()
+        
+        if opciones_texto:
+            opciones = consulta_logs.parsear_opciones(opciones_texto)
+            registrar_operacion(f"Consulta de logs solicitada por cliente: {opciones_texto.strip()!r}")
+            if opciones["seguir"]:
+                return difusion.Seguimiento(consultar_logs(opciones))
+            return consultar_logs(opciones)
+        
+        if os.path.getsize(LOG_FILE) == 0:
             registrar_operacion("Cliente solicitó logs pero el archivo está vacío")
             return "El archivo de registro está vacío."
         
         registrar_operacion("Logs solicitados por cliente")
-        return contenido
+        return open(LOG_FILE, 'rb')
     
+    except consulta_logs.ErrorConsulta as e:
+        return f"Error en la consulta de logs: {str(e)}"
     except Exception as e:
         error_msg = f"Error al leer logs: {str(e)}"
         registrar_operacion(error_msg)
         return error_msg
-    
+
+def manejar_comando_stats(opciones_texto=None):
+    """Metricas del servidor: comandos, latencias, bytes, conexiones, locks, log, cache y demonio.
+
+    Opcion formato=texto (por defecto), json o prometheus.
+    """
+    formato = "texto"
+    for linea in (opciones_texto or "").splitlines():
+        clave, _, valor = linea.partition("=")
+        if clave.strip() != "formato" or valor.strip() not in metricas.FORMATOS:
+            return f"Error en las opciones de stats: {linea.strip()} (formato={'|'.join(metricas.FORMATOS)})"
+        formato = valor.strip()
+    return metricas_servidor.formatear(formato)
+
+def manejar_comando_buscar(opciones_texto=None):
+    """Busca un texto en los archivos de entrada y procesados sin enviarlos.
+
+    Devuelve un generador con las lineas que coinciden, que se envian a
+    medida que se encuentran (ver busqueda.py). Opciones ("clave=valor", una
+    por linea): texto=..., directorio=entrada|procesados|todos, patron=*.txt,
+    tamano_min=N, tamano_max=N, limite=N, por_archivo=N e
+    ignorar_mayusculas=1.
+    """
+    try:
+        opciones = busqueda.parsear_opciones(opciones_texto or "", INDICES_DIRECTORIOS)
+    except busqueda.ErrorBusqueda as e:
+        return f"Error en las opciones de buscar: {str(e)}"
+    fuentes = [(nombre, indice) for nombre, indice in INDICES_DIRECTORIOS.items()
+               if opciones["directorio"] in (None, nombre)]
+    registrar_operacion(f"Busqueda solicitada por cliente: {opciones_texto.strip()!r}")
+    return buscador.buscar(fuentes, opciones, lambda directorio, nombre: abrir_para_lectura(nombre, (directorio,)))
+
+def manejar_comando_vigilar(opciones_texto=None):
+    """Envia los cambios de entrada y procesados a medida que ocurren.
+
+    Devuelve un Seguimiento que sigue hasta que el cliente corta (ver
+    eventos.py y difusion.py). Opciones ("clave=valor", una por linea):
+    desde=N y generacion=G para seguir despues del ultimo evento recibido,
+    directorio=entrada|procesados y patron=*.txt.
+    """
+    try:
+        opciones = eventos.parsear_opciones(opciones_texto or "", INDICES_DIRECTORIOS)
+        cursor = eventos_archivos.validar(opciones)
+    except eventos.ErrorEventos as e:
+        return f"Error en las opciones de vigilar: {str(e)}"
+    registrar_operacion(f"Cliente vigilando cambios desde el evento {cursor}")
+    return difusion.Seguimiento(eventos_archivos.suscribir(cursor, opciones))
+
+def estado_demonio():
+    """Lo ultimo que informo el demonio de su cola (ver demonio.escribir_estado)"""
+    try:
+        with open(ESTADO_DEMONIO, encoding="utf-8") as f:
+            estado = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"activo": 0}
+    estado["activo"] = int(time.time() - estado.get("actualizado", 0) < ANTIGUEDAD_ESTADO_DEMONIO)
+    return estado
+
+def consultar_logs(opciones):
+    """Generador con el resultado de una consulta y, si se pidio, el seguimiento"""
+    fin = os.path.getsize(LOG_FILE)
+    yield from consulta_logs.consultar(LOG_FILE, opciones, fin)
+    if opciones["seguir"]:
+        yield from consulta_logs.seguir(LOG_FILE, fin, opciones)
+
 def verificar_entorno():
     """Verifica y crea los directorios necesarios"""
-    for directorio in [BASE_DIR, ENTRADA_DIR, PROCESADOS_DIR, LOGS_DIR]:
+    for directorio in [BASE_DIR, ENTRADA_DIR, PROCESADOS_DIR, LOGS_DIR, TEMP_DIR]:
         os.makedirs(directorio, exist_ok=True)
         print(f"Directorio verificado: {directorio}")
     
@@ -244,35 +1136,289 @@ def verificar_entorno():
             timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             f.write(f"{timestamp} - Servidor iniciado - Creacion del archivo de registro\n")
         print(f"Archivo de registro creado: {LOG_FILE}")
+    
+    if almacen_procesados:
+        borrados, liberados = almacen_procesados.recolectar()
+        print(f"Almacen por contenido en {BLOBS_DIR}: {borrados} blobs sin uso borrados ({liberados} bytes)")
+        threading.Thread(target=recolectar_blobs, name="recolector", daemon=True).start()
+    
+    # Cargar los indices de entrada y procesados y empezar a reconciliarlos
+    for nombre, indice in INDICES_DIRECTORIOS.items():
+        indice.iniciar()
+        print(f"Indice de {nombre} cargado: {len(indice)} archivos en {indice.directorio}")
+    
+    # Lo que se consulta recien al pedir las metricas
+    metricas_servidor.agregar_fuente("bloqueos", bloqueos_archivos.estadisticas)
+    metricas_servidor.agregar_fuente("registro", registro_log.estadisticas)
+    metricas_servidor.agregar_fuente("demonio", estado_demonio)
+    metricas_servidor.agregar_fuente("busqueda", buscador.estadisticas)
+    metricas_servidor.agregar_fuente("eventos", eventos_archivos.estadisticas)
+    metricas_servidor.agregar_fuente("seguimientos", lambda: {**cupo_seguimientos.estadisticas(),
+                                                              **difusor_seguimientos.estadisticas()})
+    if cache_contenido is not None:
+        metricas_servidor.agregar_fuente("cache", cache_contenido.estadisticas)
+    
+    if cache_contenido is not None:
+        print(f"Cache de contenido: {cache_contenido.presupuesto // (1024 * 1024)} MB "
+              f"(mmap desde {cache_contenido.umbral_mmap // 1024} KB)")
+        threading.Thread(target=reportar_cache, name="reporte-cache", daemon=True).start()
+    if buscador.indice is not None:
+        print(f"Indice de busqueda: {buscador.indice.presupuesto // (1024 * 1024)} MB de trigramas")
+
+def resumen_cache():
+    e = cache_contenido.estadisticas()
+    return (f"Cache de contenido: {e['archivos']} archivos, {e['bytes']}/{e['presupuesto']} bytes, "
+            f"{e['aciertos']} aciertos y {e['fallos']} fallos ({e['tasa_aciertos'] * 100:.1f}% aciertos), "
+            f"{e['desalojos']} desalojos, {e['invalidaciones']} invalidaciones")
+
+def reportar_cache():
+    """Registra cada tanto la tasa de aciertos de la cache, para poder dimensionarla"""
+    ultimo = None
+    while True:
+        time.sleep(INTERVALO_REPORTE_POOL)
+        resumen = resumen_cache()
+        if resumen != ultimo:
+            registrar_operacion(resumen)
+            ultimo = resumen
+
+def recolectar_blobs():
+    """Borra cada tanto los blobs que ya no tienen ningun nombre"""
+    while True:
+        time.sleep(INTERVALO_RECOLECCION)
+        try:
+            borrados, liberados = almacen_procesados.recolectar()
+            if borrados:
+                registrar_operacion(f"Recolector: {borrados} blobs sin uso borrados ({liberados} bytes)")
+        except Exception as e:
+            registrar_operacion(f"Error en el recolector de blobs: {str(e)}")
+
+class PoolConexiones:
+    """Pool fijo de hilos que atienden conexiones desde una cola acotada.
 
-def iniciar_servidor():
+    Si la cola esta llena la conexion se rechaza al tiro con un mensaje de
+    servidor ocupado, en lugar de crear mas y mas hilos. Lleva la cuenta del
+    tiempo que esperan las conexiones en la cola y de los rechazos. Tambien
+    recibe las conexiones que devuelve el difusor al terminar un seguimiento.
+    """
+    
+    def __init__(self, hilos=HILOS_TRABAJADORES, cola=COLA_CONEXIONES, timeout=TIMEOUT_INACTIVIDAD):
+        self.hilos = hilos
+        self.timeout = timeout
+        self.cola = queue.Queue(maxsize=cola)
+        self.mutex = threading.Lock()
+        self.atendidas = 0
+        self.rechazadas = 0
+        self.ocupados = 0
+        self.espera_total = 0.0
+        self.espera_maxima = 0.0
+        for i in range(hilos):
+            threading.Thread(target=self._trabajador, name=f"trabajador-{i}", daemon=True).start()
+        difusor_seguimientos.timeout = timeout
+        difusor_seguimientos.devolver = self.reanudar
+    
+    def _trabajador(self):
+        while True:
+            atender, argumentos, encolada = self.cola.get()
+            espera = time.monotonic() - encolada
+            with self.mutex:
+                self.atendidas += 1
+                self.ocupados += 1
+                self.espera_total += espera
+                self.espera_maxima = max(self.espera_maxima, espera)
+            try:
+                atender(*argumentos)
+            except Exception as e:
+                print(f"[!] Error en trabajador: {str(e)}")
+            finally:
+                with self.mutex:
+                    self.ocupados -= 1
+                self.cola.task_done()
+    
+    def despachar(self, socket_cliente, addr):
+        """Encola una conexion; devuelve False si se rechazo por estar lleno"""
+        try:
+            # Un cliente que no manda nada en timeout segundos libera el hilo
+            socket_cliente.settimeout(self.timeout)
+            self.cola.put_nowait((manejar_cliente, (socket_cliente, addr), time.monotonic()))
+            return True
+        except queue.Full:
+            with self.mutex:
+                self.rechazadas += 1
+            try:
+                socket_cliente.settimeout(1)
+                socket_cliente.sendall(protocolo.MENSAJE_OCUPADO.format(segundos=REINTENTAR_EN).encode('utf-8'))
+            except OSError:
+                pass
+            finally:
+                socket_cliente.close()
+            return False
+    
+    def reanudar(self, conexion, direccion_cliente, cancelado):
+        """Encola una conexion cuyo seguimiento termino; si la cola esta llena se cierra"""
+        try:
+            conexion.sock.settimeout(self.timeout)
+            self.cola.put_nowait((reanudar_cliente, (conexion, direccion_cliente, cancelado), time.monotonic()))
+        except queue.Full:
+            with self.mutex:
+                self.rechazadas += 1
+            cerrar_conexion(conexion, direccion_cliente)
+    
+    def drenar(self, timeout):
+        """Espera a que terminen las conexiones en curso y en cola; devuelve cuantas quedaron"""
+        limite = time.monotonic() + timeout
+        while True:
+            with self.mutex:
+                pendientes = self.ocupados + self.cola.qsize()
+            if not pendientes or time.monotonic() >= limite:
+                return pendientes
+            time.sleep(0.1)
+    
+    def estadisticas(self):
+        with self.mutex:
+            return {
+                "hilos": self.hilos,
+                "ocupados": self.ocupados,
+                "en_cola": self.cola.qsize(),
+                "atendidas": self.atendidas,
+                "rechazadas": self.rechazadas,
+                "espera_promedio": self.espera_total / self.atendidas if self.atendidas else 0.0,
+                "espera_maxima": self.espera_maxima,
+            }
+    
+    def resumen(self):
+        e = self.estadisticas()
+        return (f"Pool de conexiones: {e['ocupados']}/{e['hilos']} hilos ocupados, {e['en_cola']} en cola, "
+                f"{e['atendidas']} atendidas, {e['rechazadas']} rechazadas, "
+                f"espera en cola promedio {e['espera_promedio'] * 1000:.1f} ms (max {e['espera_maxima'] * 1000:.1f} ms)")
+
+def reportar_pool(pool):
+    """Registra periodicamente el estado del pool para poder dimensionarlo"""
+    ultimo = None
+    while True:
+        time.sleep(INTERVALO_REPORTE_POOL)
+        resumen = pool.resumen()
+        if resumen != ultimo:
+            registrar_operacion(resumen)
+            ultimo = resumen
+
+def crear_socket_servidor(reusar_puerto=False):
+    """Socket escuchando en HOST:PORT.
+
+    Con reusar_puerto (SO_REUSEPORT) varios procesos pueden escuchar el
+    mismo puerto y el kernel reparte las conexiones nuevas entre ellos.
+    """
+    servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # IPv4 y TCP
+    try:
+        servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Permitir reutilizar la direccion
+        if reusar_puerto:
+            servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        servidor.bind((HOST, PORT)) # Asignar la direccion y puerto
+        servidor.listen(MAX_CLIENTES)
+    except BaseException:
+        servidor.close()
+        raise
+    return servidor
+
+def aceptar_conexiones(servidor, pool):
+    """Pasa cada conexion nueva al pool, hasta que algo interrumpa accept()"""
+    while True:
+        cliente, addr = servidor.accept() # Aceptar una nueva conexion
+        if pool.despachar(cliente, addr):
+            print(f"[*] Conexion aceptada de {addr[0]}:{addr[1]}")
+        else:
+            print(f"[!] Servidor ocupado, conexion rechazada: {addr[0]}:{addr[1]}")
+
+def iniciar_servidor(hilos=HILOS_TRABAJADORES, cola=COLA_CONEXIONES, timeout=TIMEOUT_INACTIVIDAD):
     """Inicia el servidor"""
     print("Verificando entorno...")
     verificar_entorno()
     
-    servidor = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # IPv4 y TCP
-    servidor.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Permitir reutilizar la direccion
+    servidor = None
+    pool = PoolConexiones(hilos, cola, timeout)
+    threading.Thread(target=reportar_pool, args=(pool,), daemon=True).start()
+    metricas_servidor.agregar_fuente("pool", pool.estadisticas)
     
     try:
-        servidor.bind((HOST, PORT)) # Asignar la direccion y puerto
-        servidor.listen(MAX_CLIENTES)
-        registrar_operacion(f"Servidor iniciado en {HOST}:{PORT}")
+        servidor = crear_socket_servidor()
+        registrar_operacion(f"Servidor iniciado en {HOST}:{PORT} ({hilos} hilos, cola de {cola})")
         print(f"[*] Servidor escuchando en {HOST}:{PORT}")
-        
-        while True:
-            cliente, addr = servidor.accept() # Aceptar una nueva conexion
-            manejador_cliente = threading.Thread(target=manejar_cliente, args=(cliente, addr)) # Crear un hilo para manejar al cliente
-            manejador_cliente.start()
-            print(f"[*] Conexion aceptada de {addr[0]}:{addr[1]}")
+        aceptar_conexiones(servidor, pool)
     
     except KeyboardInterrupt:
         print("\n[*] Servidor detenido por el usuario")
         registrar_operacion("Servidor detenido por el usuario")
+        estadisticas = bloqueos_archivos.estadisticas()
+        registrar_operacion(f"Bloqueos de archivos: {estadisticas['adquisiciones']} adquisiciones, "
+                            f"{estadisticas['contenciones']} con espera ({estadisticas['tiempo_espera']:.3f} s)")
+        registrar_operacion(pool.resumen())
+        if cache_contenido is not None:
+            registrar_operacion(resumen_cache())
     except Exception as e:
         print(f"[!] Error en el servidor: {str(e)}")
         registrar_operacion(f"Error en el servidor: {str(e)}")
     finally:
-        servidor.close()
+        if servidor is not None:
+            servidor.close()
 
 if __name__ == "__main__":
-    iniciar_servidor()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Servidor de archivos")
+    parser.add_argument("--modo", choices=["hilos", "async", "procesos"], default="hilos",
+                        help="hilos: pool fijo de hilos; async: asyncio con un pool de hilos para el disco; "
+                             "procesos: varios procesos con un pool de hilos cada uno")
+    parser.add_argument("--procesos", type=int,
+                        help="procesos que atienden conexiones en modo procesos (por defecto uno por nucleo)")
+    parser.add_argument("--hilos", type=int, default=HILOS_TRABAJADORES,
+                        help="hilos que atienden conexiones (modo hilos) o hacen el trabajo de disco (modo async)")
+    parser.add_argument("--cola", type=int, default=COLA_CONEXIONES,
+                        help="conexiones que pueden esperar un hilo libre antes de rechazar (modo hilos)")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT_INACTIVIDAD,
+                        help="segundos sin actividad antes de cerrar una conexion (modo hilos)")
+    parser.add_argument("--max-seguimientos", type=int, default=MAX_SEGUIMIENTOS,
+                        help="LOGS con seguir=1 y VIGILAR abiertos a la vez; los demas reciben servidor ocupado")
+    parser.add_argument("--durabilidad-log", choices=registro.DURABILIDADES, default=DURABILIDAD_LOG,
+                        help="que tan seguido se fuerza el log a disco")
+    parser.add_argument("--deduplicar", action="store_true",
+                        help="guardar procesados por contenido: los archivos iguales se guardan una sola vez")
+    parser.add_argument("--compresion", default=",".join(COMPRESIONES),
+                        help="codecs que se aceptan para comprimir las transferencias (zlib,lzma o ninguna)")
+    parser.add_argument("--cache-mb", type=int, default=CACHE_PRESUPUESTO // (1024 * 1024),
+                        help="memoria para el contenido de los archivos mas leidos (0 la desactiva)")
+    parser.add_argument("--cache-mmap-kb", type=int, default=CACHE_UMBRAL_MMAP // 1024,
+                        help="tamano desde el que los archivos de la cache se mapean con mmap")
+    parser.add_argument("--hilos-busqueda", type=int, default=HILOS_BUSQUEDA,
+                        help="hilos que recorren archivos para BUSCAR")
+    parser.add_argument("--indice-busqueda-mb", type=int, default=INDICE_BUSQUEDA_PRESUPUESTO // (1024 * 1024),
+                        help="memoria para el indice de trigramas de BUSCAR (0 lo desactiva)")
+    parser.add_argument("--metricas-puerto", type=int,
+                        help="sirve las metricas en formato Prometheus en http://127.0.0.1:PUERTO/metrics")
+    args = parser.parse_args()
+    registro_log.durabilidad = args.durabilidad_log
+    cupo_seguimientos.maximo = args.max_seguimientos
+    COMPRESIONES = tuple(c.strip() for c in args.compresion.split(",") if c.strip() in compresion.CODECS)
+    if args.deduplicar:
+        almacen_procesados = almacen.AlmacenContenido(BLOBS_DIR)
+    if args.cache_mb > 0:
+        cache_contenido = cache_archivos.CacheArchivos(args.cache_mb * 1024 * 1024, args.cache_mmap_kb * 1024)
+    else:
+        cache_contenido = None
+    buscador = busqueda.Buscador(args.hilos_busqueda)
+    if args.indice_busqueda_mb > 0:
+        buscador.indice = busqueda.IndiceTrigramas(args.indice_busqueda_mb * 1024 * 1024)
+    if args.metricas_puerto and args.modo != "procesos":
+        metricas.iniciar_http(metricas_servidor, args.metricas_puerto)
+        print(f"Metricas en http://127.0.0.1:{args.metricas_puerto}/metrics")
+    
+    if args.modo in ("async", "procesos"):
+        # servidor_async y servidor_procesos importan "servidor": que usen
+        # este mismo modulo (con la configuracion de arriba) y no una segunda
+        # copia sin configurar
+        sys.modules.setdefault("servidor", sys.modules[__name__])
+    if args.modo == "procesos":
+        import servidor_procesos
+        servidor_procesos.iniciar_servidor_procesos(args.procesos or servidor_procesos.PROCESOS, args.hilos,
+                                                    args.cola, args.timeout, args.metricas_puerto)
+    elif args.modo == "async":
+        import servidor_async
+        servidor_async.iniciar_servidor_async(args.hilos)
+    else:
+        iniciar_servidor(args.hilos, args.cola, args.timeout)
\ No newline at end of file
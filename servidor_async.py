@@ -0,0 +1,254 @@
+import asyncio
+import concurrent.futures
+import resource
+
+import protocolo
+import servidor
+
+# Hilos para el trabajo bloqueante (disco y transferencias). Las conexiones
+# inactivas no ocupan ningun hilo: solo esperan en el event loop.
+HILOS_DISCO = 32
+# Cola de conexiones pendientes del socket de escucha
+BACKLOG = 1024
+
+
+class ConexionPuente(protocolo.Conexion):
+    """Conexion del protocolo que se usa desde un hilo del executor.
+
+    Cada operacion sobre el socket se ejecuta en el event loop y el hilo
+    espera el resultado, asi los manejadores de servidor.py funcionan igual
+    que en el servidor con hilos.
+    """
+
+    def __init__(self, reader, writer, loop):
+        super().__init__(writer.get_extra_info('socket'))
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+
+    def _esperar(self, corrutina):
+        return asyncio.run_coroutine_threadsafe(corrutina, self.loop).result()
+
+    def _recv(self, n):
+        datos = self._esperar(self.reader.read(n))
+        self.bytes_recibidos += len(datos)
+        return datos
+
+    def _recv_into(self, vista, n):
+        datos = self._esperar(self.reader.read(n))
+        vista[:len(datos)] = datos
+        self.bytes_recibidos += len(datos)
+        return len(datos)
+
+    async def _escribir(self, datos):
+        self.writer.write(datos)
+        await self.writer.drain()
+
+    def enviar(self, datos):
+        self._esperar(self._escribir(datos))
+        self.bytes_enviados += len(datos)
+
+    def enviar_desde_archivo(self, archivo, offset, cantidad):
+        enviados = self._esperar(self.loop.sendfile(self.writer.transport, archivo, offset, cantidad))
+        self.bytes_enviados += enviados
+        return enviados
+
+    def esperar_datos(self, timeout):
+        if self._pendiente:
+            return True
+        try:
+            datos = self._esperar(asyncio.wait_for(self.reader.read(1), timeout))
+        except asyncio.TimeoutError:
+            return False
+        self.devolver(datos)
+        return True
+
+
+async def leer_cabecera(reader, conexion):
+    """Version async de Conexion.recibir_cabecera (None si el cliente cerro)"""
+    # Lo que quedo leido al esperar datos durante un seguimiento
+    datos = conexion.recibir(len(conexion._pendiente)) if conexion._pendiente else b""
+    try:
+        datos += await reader.readexactly(protocolo.tamano_cabecera(conexion.version) - len(datos))
+    except asyncio.IncompleteReadError as e:
+        if not e.partial and not datos:
+            return None
+        raise ConnectionError("Conexion cerrada a mitad de una trama")
+    opcode, flags, largo_nombre, largo_payload, *id_solicitud = protocolo.desempaquetar_cabecera(datos)
+    conexion.id_recibido = id_solicitud[0] if id_solicitud else 0
+    nombre = (await reader.readexactly(largo_nombre)).decode('utf-8') if largo_nombre else ""
+    return opcode, flags, nombre, largo_payload
+
+
+async def negociar(reader, writer):
+    """Saludo del lado del servidor.
+
+    Devuelve (version, inicio): version es None si el cliente usa el
+    protocolo de texto y en ese caso inicio son los bytes ya leidos.
+    """
+    inicio = b""
+    while protocolo.es_posible_saludo(inicio):
+        byte = await reader.read(1)
+        if not byte:
+            return None, inicio
+        inicio += byte
+    if len(inicio) <= len(protocolo.MAGIA) or not inicio.startswith(protocolo.MAGIA):
+        return None, inicio
+
+    version = protocolo.elegir_version(inicio[-1])
+    writer.write(protocolo.MAGIA + bytes([version]))
+    await writer.drain()
+    if not version:
+        raise protocolo.ErrorProtocolo(f"Version de protocolo no soportada: {inicio[-1]}")
+    return version, b""
+
+
+class ServidorAsync:
+    def __init__(self, hilos_disco=HILOS_DISCO):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=hilos_disco, thread_name_prefix="disco")
+        self.conexiones_activas = 0
+        self.loop = None
+        # Se reemplaza al despertar: quien espera tiene el anterior, ya activado
+        self.novedades = None
+        self._avisado = False
+
+    def despertar(self):
+        """Hace que los seguimientos revisen sus generadores ya (desde cualquier hilo)"""
+        if not self._avisado:
+            self._avisado = True
+            self.loop.call_soon_threadsafe(self._despertar)
+
+    def _despertar(self):
+        self._avisado = False
+        self.novedades.set()
+        self.novedades = asyncio.Event()
+
+    async def _en_executor(self, funcion, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, funcion, *args)
+
+    async def atender(self, reader, writer):
+        """Atiende una conexion: espera comandos en el loop y los ejecuta en el executor"""
+        addr = writer.get_extra_info('peername')
+        direccion_cliente = f"{addr[0]}:{addr[1]}"
+        loop = asyncio.get_running_loop()
+        conexion = ConexionPuente(reader, writer, loop)
+        self.conexiones_activas += 1
+        servidor.metricas_servidor.conexion_abierta()
+        await self._en_executor(servidor.registrar_operacion, f"Nueva conexion establecida: {direccion_cliente}")
+
+        try:
+            version, inicio = await negociar(reader, writer)
+            if version:
+                conexion.version = version
+                await self._en_executor(servidor.registrar_operacion,
+                                        f"Protocolo binario v{version} negociado con {direccion_cliente}")
+                while True:
+                    cabecera = await leer_cabecera(reader, conexion)
+                    if cabecera is None:
+                        break
+                    if not await self._en_executor(servidor.atender_comando_binario,
+                                                   conexion, direccion_cliente, cabecera):
+                        if conexion.seguimiento is None or not await self.seguir(conexion):
+                            break
+            else:
+                while True:
+                    # Los bytes leidos durante el saludo son el comienzo del primer comando
+                    data = inicio + await reader.read(servidor.BUFFER_SIZE - len(inicio))
+                    inicio = b""
+                    if not data:
+                        break
+                    await self._en_executor(servidor.atender_comando_texto, conexion, direccion_cliente, data)
+
+        except Exception as e:
+            await self._en_executor(servidor.registrar_operacion,
+                                    f"Error en la conexion con {direccion_cliente}: {str(e)}")
+        finally:
+            self.conexiones_activas -= 1
+            servidor.metricas_servidor.conexion_cerrada()
+            writer.close()
+            await self._en_executor(servidor.registrar_operacion, f"Conexion cerrada: {direccion_cliente}")
+
+    async def seguir(self, conexion):
+        """Envia conexion.seguimiento desde el loop.
+
+        El executor solo se usa para sacar bloques del generador (leer el
+        log); mientras no hay nada nuevo no se ocupa ningun hilo. Si el
+        cliente manda una trama se corta el flujo, como en
+        Conexion.enviar_flujo. Devuelve False si hay que cerrar la conexion.
+        """
+        flujo, conexion.seguimiento = conexion.seguimiento, None
+        lectura = asyncio.ensure_future(conexion.reader.read(1))
+        try:
+            while not flujo.terminado or flujo.salida:
+                if lectura.done() and not flujo.terminado:
+                    datos = lectura.result()
+                    if not datos:
+                        return False
+                    conexion.bytes_recibidos += len(datos)
+                    conexion.devolver(datos)
+                    flujo.terminar(cancelado=True)
+                nuevos = not flujo.terminado and await self._en_executor(flujo.producir)
+                if flujo.salida:
+                    conexion.writer.write(bytes(flujo.salida))
+                    flujo.enviado(len(flujo.salida))
+                    await asyncio.wait_for(conexion.writer.drain(), servidor.TIMEOUT_INACTIVIDAD)
+                elif not nuevos and not flujo.terminado:
+                    novedades = asyncio.ensure_future(self.novedades.wait())
+                    await asyncio.wait((lectura, novedades), timeout=servidor.INTERVALO_SEGUIR,
+                                       return_when=asyncio.FIRST_COMPLETED)
+                    novedades.cancel()
+        finally:
+            flujo.cerrar()
+            if not lectura.done():
+                lectura.cancel()
+            elif not flujo.cancelado and not lectura.cancelled() and not lectura.exception() and lectura.result():
+                # Llego justo al terminar el flujo: es el comienzo del proximo comando
+                conexion.bytes_recibidos += len(lectura.result())
+                conexion.devolver(lectura.result())
+        if flujo.cancelado:
+            # La trama con la que el cliente corto el flujo
+            await self._en_executor(conexion.recibir_trama, servidor.MAX_PAYLOAD_COMANDO)
+        return True
+
+    async def ejecutar(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        self.novedades = asyncio.Event()
+        # Los eventos de VIGILAR despiertan a los seguimientos del loop, no al difusor
+        servidor.eventos_archivos.avisar = self.despertar
+        srv = await asyncio.start_server(self.atender, host, port, backlog=BACKLOG, reuse_address=True)
+        servidor.registrar_operacion(f"Servidor (asyncio) iniciado en {host}:{port}")
+        print(f"[*] Servidor asyncio escuchando en {host}:{port}")
+        async with srv:
+            await srv.serve_forever()
+
+
+def subir_limite_descriptores():
+    """Sube el limite de archivos abiertos al maximo permitido (1 por conexion)"""
+    try:
+        _, maximo = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (maximo, maximo))
+        return maximo
+    except (ValueError, OSError):
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def iniciar_servidor_async(hilos_disco=HILOS_DISCO):
+    """Inicia el servidor con asyncio en lugar de un hilo por conexion"""
+    print("Verificando entorno...")
+    servidor.verificar_entorno()
+    limite = subir_limite_descriptores()
+    print(f"[*] Limite de descriptores abiertos: {limite}")
+
+    motor = ServidorAsync(hilos_disco)
+    try:
+        asyncio.run(motor.ejecutar(servidor.HOST, servidor.PORT))
+    except KeyboardInterrupt:
+        print("\n[*] Servidor detenido por el usuario")
+        servidor.registrar_operacion("Servidor detenido por el usuario")
+    except Exception as e:
+        print(f"[!] Error en el servidor: {str(e)}")
+        servidor.registrar_operacion(f"Error en el servidor: {str(e)}")
+    finally:
+        motor.executor.shutdown(wait=False)
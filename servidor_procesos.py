@@ -0,0 +1,184 @@
+import os
+import signal
+import socket
+import threading
+import time
+
+import bloqueos
+import metricas
+import servidor
+
+# Servidor con varios procesos (pre-fork).
+#
+# Un supervisor crea PROCESOS trabajadores con os.fork; cada uno es un
+# servidor con su propio pool de hilos, asi el trabajo de CPU (compresion,
+# sumas, decodificar texto) usa todos los nucleos en lugar de uno solo por
+# el GIL. Cada trabajador escucha el mismo puerto con SO_REUSEPORT y el
+# kernel le reparte las conexiones; sin SO_REUSEPORT comparten un unico
+# socket abierto por el supervisor.
+#
+# Lo que tiene que valer entre procesos: los locks por archivo pasan a
+# flock (ver bloqueos.py) y el log ya se escribe con O_APPEND bajo un flock.
+# La cache y los indices de LISTAR son de cada trabajador: la cache valida
+# cada acierto contra un stat y los indices se reconcilian con el disco,
+# igual que con los cambios del demonio. STATS y las metricas muestran solo
+# al trabajador que atiende (con --metricas-puerto, cada uno en PUERTO + n).
+
+PROCESOS = os.cpu_count() or 1
+# Cuanto se espera a las conexiones en curso al detener un trabajador
+ESPERA_DRENADO = 30
+# Un trabajador que se cae se vuelve a lanzar tras esta espera, que se
+# duplica (hasta REINICIO_MAXIMO) si se cae de nuevo antes de ESTABLE segundos
+REINICIO_MINIMO = 0.5
+REINICIO_MAXIMO = 30
+ESTABLE = 10
+INTERVALO_SUPERVISOR = 0.2
+
+
+class Drenar(Exception):
+    """Se lanza en el hilo principal de un trabajador al pedirle que termine"""
+
+
+def _pedir_drenado(senal, marco):
+    # Una sola vez: el SIGINT de la terminal y el SIGTERM del supervisor llegan juntos
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    raise Drenar()
+
+
+def vigilar_supervisor(supervisor):
+    """Si el supervisor muere sin avisar, el trabajador termina solo"""
+    while os.getppid() == supervisor:
+        time.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def trabajador(numero, hilos, cola, timeout, compartido, metricas_puerto):
+    """Cuerpo de un proceso trabajador; devuelve el codigo de salida"""
+    servidor.registro_log.despues_de_fork()
+    signal.signal(signal.SIGTERM, _pedir_drenado)
+    signal.signal(signal.SIGINT, _pedir_drenado)
+    threading.Thread(target=vigilar_supervisor, args=(os.getppid(),), name="supervisor", daemon=True).start()
+    pid = os.getpid()
+
+    escucha = None
+    pool = None
+    try:
+        servidor.verificar_entorno()
+        pool = servidor.PoolConexiones(hilos, cola, timeout)
+        threading.Thread(target=servidor.reportar_pool, args=(pool,), daemon=True).start()
+        servidor.metricas_servidor.agregar_fuente("pool", pool.estadisticas)
+        servidor.metricas_servidor.agregar_fuente("proceso", lambda: {"trabajador": numero, "pid": pid})
+        if metricas_puerto:
+            metricas.iniciar_http(servidor.metricas_servidor, metricas_puerto + numero)
+        escucha = compartido or servidor.crear_socket_servidor(reusar_puerto=True)
+        servidor.registrar_operacion(f"Trabajador {numero} (pid {pid}) escuchando ({hilos} hilos, cola de {cola})")
+        servidor.aceptar_conexiones(escucha, pool)
+    except Drenar:
+        pass
+    except Exception as e:
+        servidor.registrar_operacion(f"Error en el trabajador {numero} (pid {pid}): {str(e)}")
+        servidor.registro_log.vaciar()
+        return 1
+
+    if escucha is not None and escucha is not compartido:
+        # Lo que ya esta en la cola de este socket se perderia al cerrarlo:
+        # se atiende antes de dejar de escuchar
+        escucha.setblocking(False)
+        while True:
+            try:
+                cliente, addr = escucha.accept()
+            except OSError:
+                break
+            pool.despachar(cliente, addr)
+        escucha.close()
+    quedaron = pool.drenar(ESPERA_DRENADO) if pool is not None else 0
+    servidor.registrar_operacion(f"Trabajador {numero} (pid {pid}) detenido"
+                                 + (f", {quedaron} conexiones sin terminar" if quedaron else ""))
+    servidor.registro_log.vaciar()
+    return 0
+
+
+def lanzar(numero, hilos, cola, timeout, compartido, metricas_puerto):
+    pid = os.fork()
+    if pid:
+        return pid
+    codigo = 1
+    try:
+        codigo = trabajador(numero, hilos, cola, timeout, compartido, metricas_puerto)
+    finally:
+        # Nunca volver al codigo del supervisor
+        os._exit(codigo)
+
+
+def iniciar_servidor_procesos(procesos=PROCESOS, hilos=servidor.HILOS_TRABAJADORES, cola=servidor.COLA_CONEXIONES,
+                              timeout=servidor.TIMEOUT_INACTIVIDAD, metricas_puerto=None):
+    """Inicia el supervisor y sus trabajadores; vuelve cuando todos terminaron"""
+    # Antes del primer fork: los trabajadores heredan los locks entre procesos
+    servidor.bloqueos_archivos = bloqueos.GestorBloqueos(servidor.LOCKS_DIR)
+    compartido = None
+    if not hasattr(socket, "SO_REUSEPORT"):
+        compartido = servidor.crear_socket_servidor()
+
+    detener = []
+    signal.signal(signal.SIGTERM, lambda senal, marco: detener.append(senal))
+    signal.signal(signal.SIGINT, lambda senal, marco: detener.append(senal))
+
+    argumentos = (hilos, cola, timeout, compartido, metricas_puerto)
+    trabajadores = {}  # pid -> (numero, inicio)
+    esperas = [REINICIO_MINIMO] * procesos
+    relanzar = {}  # numero -> cuando
+    for numero in range(procesos):
+        trabajadores[lanzar(numero, *argumentos)] = (numero, time.monotonic())
+    servidor.registrar_operacion(f"Servidor iniciado en {servidor.HOST}:{servidor.PORT} con {procesos} procesos "
+                                 f"de {hilos} hilos (supervisor pid {os.getpid()})")
+    print(f"[*] Servidor escuchando en {servidor.HOST}:{servidor.PORT} con {procesos} procesos")
+
+    def recoger():
+        while trabajadores:
+            try:
+                pid, estado = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                trabajadores.clear()
+                return
+            if not pid:
+                return
+            if pid not in trabajadores:
+                continue
+            numero, inicio = trabajadores.pop(pid)
+            if detener:
+                continue
+            vivio = time.monotonic() - inicio
+            esperas[numero] = REINICIO_MINIMO if vivio >= ESTABLE else min(esperas[numero] * 2, REINICIO_MAXIMO)
+            relanzar[numero] = time.monotonic() + esperas[numero]
+            mensaje = (f"Trabajador {numero} (pid {pid}) termino con codigo {os.waitstatus_to_exitcode(estado)} "
+                       f"tras {vivio:.1f} s, se relanza en {esperas[numero]:.1f} s")
+            print(f"[!] {mensaje}")
+            servidor.registrar_operacion(mensaje)
+
+    while not detener:
+        time.sleep(INTERVALO_SUPERVISOR)
+        recoger()
+        for numero, cuando in list(relanzar.items()):
+            if not detener and time.monotonic() >= cuando:
+                del relanzar[numero]
+                trabajadores[lanzar(numero, *argumentos)] = (numero, time.monotonic())
+
+    print("\n[*] Deteniendo trabajadores...")
+    servidor.registrar_operacion(f"Servidor detenido, drenando {len(trabajadores)} trabajadores")
+    for pid in trabajadores:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    limite = time.monotonic() + ESPERA_DRENADO + 5
+    while trabajadores and time.monotonic() < limite:
+        recoger()
+        time.sleep(0.1)
+    for pid in list(trabajadores):
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    if compartido is not None:
+        compartido.close()
+    servidor.registrar_operacion("Servidor detenido por el usuario")
+    servidor.registro_log.vaciar()
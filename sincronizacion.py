@@ -0,0 +1,283 @@
+import collections
+import hashlib
+import json
+import os
+import queue
+import random
+import select
+import threading
+import time
+
+import protocolo
+from cliente import ClienteArchivos
+
+SUBIR = "subir"
+BAJAR = "bajar"
+CONEXIONES = 4
+# Estado de la ultima sincronizacion, dentro del directorio local
+MANIFIESTO = ".sincronizacion.json"
+BLOQUE = 1024 * 1024
+
+
+def suma_archivo(ruta):
+    suma = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for bloque in iter(lambda: f.read(BLOQUE), b""):
+            suma.update(bloque)
+    return suma.hexdigest()
+
+
+class Manifiesto:
+    """Lo que se sabe de cada archivo desde la ultima sincronizacion.
+
+    Por nombre guarda el tamano, el mtime y el SHA-256 de la copia local y el
+    tamano y la fecha que mostraba el servidor. Si nada de eso cambio el
+    archivo se saltea sin transferir nada.
+    """
+
+    def __init__(self, directorio):
+        self.ruta = os.path.join(directorio, MANIFIESTO)
+        self.mutex = threading.Lock()
+        try:
+            with open(self.ruta, encoding="utf-8") as f:
+                self.archivos = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.archivos = {}
+
+    def sin_cambios(self, nombre, ruta_local, remoto):
+        """True si la copia local y la del servidor son las de la ultima vez"""
+        previo = self.archivos.get(nombre)
+        if previo is None or remoto is None or previo["remoto"] != list(remoto):
+            return False
+        try:
+            estado = os.stat(ruta_local)
+        except FileNotFoundError:
+            return False
+        if estado.st_size != previo["tamano"]:
+            return False
+        if estado.st_mtime_ns == previo["mtime_ns"]:
+            return True
+        # Cambio la fecha pero no el tamano: decide el contenido
+        if suma_archivo(ruta_local) != previo["sha256"]:
+            return False
+        self.anotar(nombre, ruta_local, remoto, previo["sha256"])
+        return True
+
+    def anotar(self, nombre, ruta_local, remoto, suma=None):
+        estado = os.stat(ruta_local)
+        entrada = {"tamano": estado.st_size, "mtime_ns": estado.st_mtime_ns,
+                   "sha256": suma or suma_archivo(ruta_local), "remoto": list(remoto) if remoto else None}
+        with self.mutex:
+            self.archivos[nombre] = entrada
+
+    def guardar(self):
+        temporal = self.ruta + ".tmp"
+        with self.mutex:
+            with open(temporal, "w", encoding="utf-8") as f:
+                json.dump(self.archivos, f, ensure_ascii=False)
+        os.replace(temporal, self.ruta)
+
+
+class PoolClientes:
+    """Conexiones abiertas al servidor que se reusan entre archivos.
+
+    Antes de entregar una conexion se revisa que siga sana: una conexion
+    ociosa con algo para leer es que el servidor la cerro (por inactividad,
+    por ejemplo), y entonces se reconecta en lugar de fallar con el proximo
+    archivo.
+    """
+
+    def __init__(self, host, port, conexiones=CONEXIONES, codecs="zlib", nivel=None):
+        self.host = host
+        self.port = port
+        self.libres = queue.LifoQueue()
+        for _ in range(conexiones):
+            self.libres.put(ClienteArchivos(host, port, codecs, nivel))
+        self.reconexiones = 0
+
+    @staticmethod
+    def _sana(cliente):
+        if cliente.conexion is None or cliente.conexion._pendiente:
+            return False
+        try:
+            listos, _, _ = select.select([cliente.socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not listos
+
+    def obtener(self):
+        cliente = self.libres.get()
+        if not self._sana(cliente):
+            if cliente.conexion is not None:
+                self.reconexiones += 1
+            cliente.cerrar()
+            if not cliente.conectar() and not cliente._reconectar():
+                self.libres.put(cliente)
+                return None
+        return cliente
+
+    def devolver(self, cliente):
+        self.libres.put(cliente)
+
+    def cerrar(self):
+        while not self.libres.empty():
+            self.libres.get().cerrar()
+
+
+class RepartoConRobo:
+    """Reparte tareas entre trabajadores, cada uno con su propia cola.
+
+    Cada trabajador saca de la punta de su cola; cuando se queda sin nada
+    le roba del final de la cola de otro. Las tareas se reparten de mayor a
+    menor, asi lo ultimo que queda (y lo que se roba) son archivos chicos y
+    ningun trabajador termina mucho despues que los demas.
+    """
+
+    def __init__(self, tareas, trabajadores, tamano=lambda tarea: 0):
+        self.colas = [collections.deque() for _ in range(trabajadores)]
+        for i, tarea in enumerate(sorted(tareas, key=tamano, reverse=True)):
+            self.colas[i % trabajadores].append(tarea)
+        self.robos = 0
+
+    def tomar(self, trabajador):
+        try:
+            return self.colas[trabajador].popleft()
+        except IndexError:
+            pass
+        otros = [i for i in range(len(self.colas)) if i != trabajador]
+        random.shuffle(otros)
+        for otro in otros:
+            try:
+                tarea = self.colas[otro].pop()
+            except IndexError:
+                continue
+            self.robos += 1
+            return tarea
+        return None
+
+
+def listar_remoto(cliente):
+    """{nombre: (tamano, fecha)} de lo que ve DESCARGAR (entrada tapa a procesados)"""
+    remoto = {}
+    for directorio in ("procesados", "entrada"):
+        opciones = protocolo.empaquetar_info({"directorio": directorio, "detalle": 1})
+        respuesta = cliente.enviar_comando(protocolo.OP_LISTAR, payload=opciones)
+        if respuesta is None or not respuesta[0]:
+            raise ConnectionError("No se pudo listar el servidor")
+        for linea in respuesta[1].decode("utf-8").splitlines():
+            partes = linea.split("\t")
+            if len(partes) == 3:
+                remoto[partes[0]] = (int(partes[1]), partes[2])
+    return remoto
+
+
+def listar_local(directorio):
+    return {nombre: os.path.getsize(os.path.join(directorio, nombre)) for nombre in os.listdir(directorio)
+            if os.path.isfile(os.path.join(directorio, nombre))
+            and not nombre.startswith(MANIFIESTO) and not nombre.endswith((".parcial", ".etag"))}
+
+
+def sincronizar(host, port, directorio, sentido, conexiones=CONEXIONES, codecs="zlib", nivel=None):
+    """Deja el servidor igual al directorio local (subir) o al reves (bajar).
+
+    Los archivos que no cambiaron desde la ultima vez se saltean; el resto
+    se transfiere por `conexiones` conexiones en paralelo. Devuelve un
+    diccionario con el resumen.
+    """
+    if sentido not in (SUBIR, BAJAR):
+        raise ValueError(f"Sentido desconocido: {sentido} (subir o bajar)")
+    os.makedirs(directorio, exist_ok=True)
+    manifiesto = Manifiesto(directorio)
+    pool = PoolClientes(host, port, conexiones, codecs, nivel)
+    inicio = time.monotonic()
+    resumen = {"transferidos": 0, "salteados": 0, "errores": 0, "bytes": 0}
+    mutex = threading.Lock()
+
+    cliente = pool.obtener()
+    if cliente is None:
+        raise ConnectionError(f"No se pudo conectar a {host}:{port}")
+    try:
+        remoto = listar_remoto(cliente)
+    finally:
+        pool.devolver(cliente)
+
+    if sentido == SUBIR:
+        candidatos = listar_local(directorio)
+    else:
+        candidatos = {nombre: tamano for nombre, (tamano, _) in remoto.items()}
+    pendientes = []
+    for nombre, tamano in candidatos.items():
+        if manifiesto.sin_cambios(nombre, os.path.join(directorio, nombre), remoto.get(nombre)):
+            resumen["salteados"] += 1
+        else:
+            pendientes.append((nombre, tamano))
+    reparto = RepartoConRobo(pendientes, conexiones, tamano=lambda tarea: tarea[1])
+    subidos = []
+
+    def transferir(cliente, nombre, tamano):
+        ruta = os.path.join(directorio, nombre)
+        if sentido == SUBIR:
+            respuesta = cliente.subir(ruta, nombre)
+            if respuesta is not None and respuesta[0]:
+                subidos.append(nombre)
+                return respuesta[2]
+        else:
+            respuesta = cliente.descargar(nombre, ruta)
+            if respuesta is not None and respuesta[0]:
+                manifiesto.anotar(nombre, ruta, remoto[nombre])
+                return respuesta[1]
+        print(f"Error con {nombre}: {respuesta[1] if respuesta else 'se corto la conexion'}")
+        return None
+
+    def trabajador(numero):
+        while True:
+            tarea = reparto.tomar(numero)
+            if tarea is None:
+                return
+            cliente = pool.obtener()
+            if cliente is None:
+                enviados = None
+                print(f"Error con {tarea[0]}: sin conexion con el servidor")
+            else:
+                try:
+                    enviados = transferir(cliente, *tarea)
+                except Exception as e:
+                    print(f"Error con {tarea[0]}: {str(e)}")
+                    enviados = None
+                    cliente.cerrar()
+                finally:
+                    pool.devolver(cliente)
+            with mutex:
+                if enviados is None:
+                    resumen["errores"] += 1
+                else:
+                    resumen["transferidos"] += 1
+                    resumen["bytes"] += enviados
+
+    hilos = [threading.Thread(target=trabajador, args=(i,), name=f"sincronizar-{i}") for i in range(conexiones)]
+    try:
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        if subidos:
+            # La fecha que le puso el servidor a cada archivo recien se ve ahora
+            cliente = pool.obtener()
+            if cliente is not None:
+                try:
+                    remoto = listar_remoto(cliente)
+                finally:
+                    pool.devolver(cliente)
+                for nombre in subidos:
+                    manifiesto.anotar(nombre, os.path.join(directorio, nombre), remoto.get(nombre))
+    finally:
+        manifiesto.guardar()
+        pool.cerrar()
+
+    segundos = time.monotonic() - inicio
+    resumen.update({"segundos": round(segundos, 3), "robos": reparto.robos, "reconexiones": pool.reconexiones,
+                    "mb_por_segundo": round(resumen["bytes"] / max(segundos, 1e-6) / 1024 / 1024, 2)})
+    print(f"Sincronizacion ({sentido}) terminada en {segundos:.2f} s: {resumen['transferidos']} transferidos, "
+          f"{resumen['salteados']} sin cambios, {resumen['errores']} con error, "
+          f"{resumen['bytes']} bytes ({resumen['mb_por_segundo']} MB/s con {conexiones} conexiones)")
+    return resumen
@@ -0,0 +1,177 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+import directorios
+
+# Constantes de <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+EVENTO = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class VigilanteSondeo:
+    """Detecta archivos en un directorio revisandolo cada `intervalo` segundos.
+
+    Es el respaldo cuando no hay inotify (otros sistemas operativos).
+    directorio puede ser una ruta o un directorios.Directorio (plano o
+    repartido en subcarpetas).
+    """
+
+    tipo = "sondeo"
+
+    def __init__(self, directorio, intervalo=10):
+        if isinstance(directorio, str):
+            directorio = directorios.Directorio(directorio)
+        self.directorio = directorio
+        self.intervalo = intervalo
+        self._primera = True
+
+    def escanear(self):
+        """Todos los archivos que hay ahora en el directorio"""
+        return self.directorio.nombres()
+
+    def esperar(self):
+        """Bloquea hasta la proxima revision y devuelve los archivos encontrados"""
+        if self._primera:
+            self._primera = False
+        else:
+            time.sleep(self.intervalo)
+        return self.escanear()
+
+    def cerrar(self):
+        pass
+
+
+class VigilanteInotify(VigilanteSondeo):
+    """Detecta archivos nuevos en un directorio con inotify (Linux).
+
+    Reacciona a IN_CLOSE_WRITE (alguien termino de escribir el archivo) y a
+    IN_MOVED_TO (alguien lo movio adentro, como hace el servidor al terminar
+    una subida). Los eventos del mismo archivo que llegan seguidos se juntan:
+    un archivo se entrega recien cuando pasan `ventana` segundos sin eventos
+    nuevos para el. Si la cola de inotify del kernel se desborda se pierden
+    eventos, asi que en ese caso se revisa el directorio completo una vez.
+
+    En un directorio repartido se vigila cada subcarpeta ademas de la raiz;
+    si aparece la marca de reparto (una migracion en curso) se agregan las
+    subcarpetas nuevas.
+    """
+
+    tipo = "inotify"
+
+    def __init__(self, directorio, ventana=0.05, intervalo_respaldo=60):
+        super().__init__(directorio, intervalo_respaldo)
+        self.ventana = ventana
+        self.desbordes = 0
+        self._pendientes = {}  # nombre -> momento del ultimo evento
+        self._vigiladas = set()
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 fallo")
+        try:
+            self._vigilar_carpetas()
+        except OSError:
+            os.close(self._fd)
+            raise
+
+    def _vigilar_carpetas(self):
+        for carpeta in self.directorio.carpetas():
+            if carpeta in self._vigiladas:
+                continue
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(carpeta), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, f"inotify_add_watch fallo para {carpeta}")
+            self._vigiladas.add(carpeta)
+
+    def _leer_eventos(self):
+        """Lee lo disponible; devuelve True si hubo desborde"""
+        desborde = False
+        ahora = time.monotonic()
+        while True:
+            try:
+                datos = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            posicion = 0
+            while posicion < len(datos):
+                _, mascara, _, largo = EVENTO.unpack_from(datos, posicion)
+                posicion += EVENTO.size
+                nombre = datos[posicion:posicion + largo].rstrip(b"\0")
+                posicion += largo
+                if mascara & IN_Q_OVERFLOW:
+                    desborde = True
+                elif nombre and not mascara & (IN_ISDIR | IN_IGNORED):
+                    nombre = os.fsdecode(nombre)
+                    if nombre == directorios.MARCA:
+                        self.directorio.revisar(forzar=True)
+                        try:
+                            self._vigilar_carpetas()
+                        except OSError as e:
+                            # Sin esas carpetas queda la revision completa cada intervalo
+                            print(f"No se pudieron vigilar las subcarpetas: {str(e)}")
+                    elif not directorios.es_interno(nombre):
+                        self._pendientes[nombre] = ahora
+        return desborde
+
+    def esperar(self):
+        """Bloquea hasta que haya archivos listos y los devuelve.
+
+        La primera llamada devuelve lo que ya estaba en el directorio. Ademas
+        cada `intervalo` segundos se revisa el directorio completo por las
+        dudas, pero entre medio no se hace ningun listdir.
+        """
+        if self._primera:
+            self._primera = False
+            self._ultimo_escaneo = time.monotonic()
+            return self.escanear()
+
+        while True:
+            ahora = time.monotonic()
+            if ahora - self._ultimo_escaneo >= self.intervalo:
+                self._ultimo_escaneo = ahora
+                return self.escanear()
+
+            if self._pendientes:
+                # Hay eventos juntandose: esperamos como mucho hasta que se cumpla la ventana
+                timeout = max(0.0, min(self._pendientes.values()) + self.ventana - ahora)
+            else:
+                timeout = self.intervalo - (ahora - self._ultimo_escaneo)
+            listos, _, _ = select.select([self._fd], [], [], timeout)
+            if listos and self._leer_eventos():
+                self.desbordes += 1
+                self._pendientes.clear()
+                self._ultimo_escaneo = time.monotonic()
+                return self.escanear()
+
+            ahora = time.monotonic()
+            terminados = [n for n, momento in self._pendientes.items() if ahora - momento >= self.ventana]
+            for nombre in terminados:
+                del self._pendientes[nombre]
+            # Puede que ya no este (por ejemplo, se movio de nuevo)
+            terminados = [n for n in terminados if self.directorio.existe(n)]
+            if terminados:
+                return terminados
+
+    def cerrar(self):
+        os.close(self._fd)
+
+
+def crear_vigilante(directorio, intervalo_sondeo=10, ventana=0.05):
+    """Vigilante con inotify si esta disponible; si no, por sondeo"""
+    try:
+        return VigilanteInotify(directorio, ventana, intervalo_respaldo=max(60, intervalo_sondeo))
+    except (OSError, AttributeError):
+        # AttributeError: la libc no tiene inotify (no es Linux)
+        return VigilanteSondeo(directorio, intervalo_sondeo)